@@ -0,0 +1,300 @@
+# coding=utf-8
+"""
+Reproducible benchmark of ingest, search and suggest against a local Postgres.
+
+    python benchmark.py --documents 20000 --vocabulary 50000 --skew 1.1 --output results.json
+    python benchmark.py --corpus input.txt --compare results.json
+
+The benchmark database (--database, created when missing) is wiped by create_index(): never point it
+at a database holding an index you want to keep. Results are written as JSON; --compare prints the
+change of every latency percentile and throughput against an earlier run.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+
+import psycopg2
+
+from server.analysis import term_frequencies
+from server.config import DB_HOST, DB_PORT, DB_PASSWORD, DB_USER, DB_NAME
+from server.indexer import Indexer
+
+PERCENTILES = (50, 90, 99)
+_CONSONANTS = "bcdfghjklmnprstvz"
+_VOWELS = "aeiou"
+
+
+@contextmanager
+def _quiet():
+    # keeps the output of an Indexer built with the print_timings hook out of the timings
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _word(generator):
+    return "".join(generator.choice(_CONSONANTS) + generator.choice(_VOWELS)
+                   for _ in range(generator.randint(2, 5)))
+
+
+def synthetic_corpus(documents, vocabulary, skew, length, seed):
+    """
+    Returns documents made of words drawn from a vocabulary of pseudo-words whose frequencies follow
+    a Zipf distribution with exponent skew; document lengths are uniform in [length / 2, 3 * length / 2].
+    """
+    generator = random.Random(seed)
+    words = set()
+    while len(words) < vocabulary:
+        words.add(_word(generator))
+    words = sorted(words)
+    generator.shuffle(words)
+    cumulative = []
+    total = 0.0
+    for rank in range(1, vocabulary + 1):
+        total += 1.0 / rank ** skew
+        cumulative.append(total)
+    corpus = []
+    for _ in range(documents):
+        size = generator.randint(max(1, length // 2), max(1, 3 * length // 2))
+        corpus.append(" ".join(words[bisect_left(cumulative, generator.random() * total)] for _ in range(size)))
+    return corpus
+
+
+def file_corpus(path, documents):
+    corpus = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                corpus.append(line)
+                if documents and len(corpus) >= documents:
+                    break
+    return corpus
+
+
+def query_sets(corpus, queries, seed):
+    """
+    Single term queries draw from the terms of the corpus, multi term queries take 2 or 3 terms of the
+    same document so they match something, common term queries use the 10 most frequent terms and
+    suggest queries are 2 to 4 character prefixes of single terms.
+    """
+    generator = random.Random(seed)
+    frequencies = Counter()
+    documents = []
+    for data in corpus:
+        terms = list(term_frequencies(data))
+        frequencies.update(terms)
+        documents.append(terms)
+    terms = sorted(frequencies)
+    common = [term for term, frequency in frequencies.most_common(10)]
+    single = [generator.choice(terms) for _ in range(queries)]
+    multi = []
+    while len(multi) < queries:
+        document = generator.choice(documents)
+        if len(document) >= 2:
+            multi.append(" ".join(generator.sample(document, min(len(document), generator.randint(2, 3)))))
+    return {
+        "single": single,
+        "multi": multi,
+        "common": [common[i % len(common)] for i in range(queries)],
+        "suggest": [term[:generator.randint(2, 4)] for term in single],
+    }
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    summary = dict(("p{0}".format(p), latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))])
+                   for p in PERCENTILES)
+    summary["mean"] = sum(latencies) / len(latencies)
+    summary["max"] = latencies[-1]
+    summary["queries"] = len(latencies)
+    return summary
+
+
+def measure(run, queries, repeat, warmup):
+    """
+    Calls run(query) for every query, repeat times after warmup untimed calls, and returns the
+    latency percentiles in milliseconds.
+    """
+    for query in queries[:warmup]:
+        run(query)
+    latencies = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.time()
+            run(query)
+            latencies.append((time.time() - start) * 1000)
+    return percentiles(latencies)
+
+
+def ensure_database(arguments):
+    connection = psycopg2.connect(host=arguments.host, port=arguments.port, password=arguments.password,
+                                  user=arguments.user, database="postgres")
+    connection.autocommit = True
+    cursor = connection.cursor()
+    cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", [arguments.database])
+    if cursor.fetchone() is None:
+        cursor.execute('CREATE DATABASE "{0}"'.format(arguments.database.replace('"', '""')))
+    connection.close()
+
+
+def ingest(indexer, corpus, single):
+    """
+    Indexes the first single documents one by one through index() and the rest through index_many().
+    """
+    results = {}
+    with _quiet():
+        start = time.time()
+        for data in corpus[:single]:
+            indexer.index(data)
+        seconds = time.time() - start
+    if single:
+        results["index"] = {"documents": len(corpus[:single]), "seconds": seconds,
+                            "documents_per_second": len(corpus[:single]) / seconds if seconds else None}
+    rest = corpus[single:]
+    if rest:
+        with _quiet():
+            start = time.time()
+            indexer.index_many(rest)
+            seconds = time.time() - start
+        results["index_many"] = {"documents": len(rest), "seconds": seconds,
+                                 "documents_per_second": len(rest) / seconds if seconds else None}
+    return results
+
+
+def classical_search(cursor, query, limit):
+    # the LIKE scan of search.py's classical_search(), every word having to occur
+    words = query.split()
+    cursor.execute("SELECT * FROM data.original WHERE " +
+                   " AND ".join(["data LIKE '%%' || %s || '%%'"] * len(words)) + " LIMIT %s", words + [limit])
+    return cursor.fetchall()
+
+
+def run(arguments):
+    if arguments.corpus:
+        corpus = file_corpus(arguments.corpus, arguments.documents)
+        source = {"corpus": arguments.corpus}
+    else:
+        corpus = synthetic_corpus(arguments.documents, arguments.vocabulary, arguments.skew, arguments.length,
+                                  arguments.seed)
+        source = {"vocabulary": arguments.vocabulary, "skew": arguments.skew, "length": arguments.length}
+    queries = query_sets(corpus, arguments.queries, arguments.seed)
+    ensure_database(arguments)
+    indexer = Indexer(deepindexing=arguments.deepindexing, block_size=arguments.block_size, host=arguments.host,
+                      port=arguments.port, password=arguments.password, user=arguments.user,
+                      database=arguments.database)
+    indexer.create_index()
+    print "Indexing {0} documents...".format(len(corpus))
+    results = {"ingest": ingest(indexer, corpus, arguments.single)}
+    for name, values in sorted(results["ingest"].iteritems()):
+        print "{0}: {1:.1f} documents/second".format(name, values["documents_per_second"] or 0)
+
+    def search(query):
+        return list(indexer.search(query, limit=arguments.limit))
+
+    def ranked_search(query):
+        return list(indexer.search(query, limit=arguments.limit, ranked=True))
+
+    def suggest(query):
+        return list(indexer.suggest(query, limit=arguments.limit))
+
+    connection = psycopg2.connect(host=arguments.host, port=arguments.port, password=arguments.password,
+                                  user=arguments.user, database=arguments.database)
+    baseline = connection.cursor()
+    benchmarks = [("search", search, ("single", "multi", "common")),
+                  ("ranked_search", ranked_search, ("single", "multi", "common")),
+                  ("suggest", suggest, ("suggest",)),
+                  ("classical_search", lambda query: classical_search(baseline, query, arguments.limit),
+                   ("single", "multi", "common"))]
+    latencies = {}
+    for name, function, kinds in benchmarks:
+        for kind in kinds:
+            with _quiet():
+                latencies["{0}.{1}".format(name, kind)] = measure(function, queries[kind], arguments.repeat,
+                                                                  arguments.warmup)
+    connection.close()
+    results["latency_ms"] = latencies
+    results["parameters"] = dict(source, documents=len(corpus), queries=arguments.queries, repeat=arguments.repeat,
+                                 limit=arguments.limit, seed=arguments.seed, deepindexing=arguments.deepindexing,
+                                 block_size=arguments.block_size)
+    results["environment"] = environment()
+    return results
+
+
+def environment():
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {"revision": revision, "python": platform.python_version(), "platform": platform.platform(),
+            "timestamp": int(time.time())}
+
+
+def report(results, previous=None):
+    print "{0:<32}{1:>10}{2:>10}{3:>10}{4:>10}".format("latency (ms)", "p50", "p90", "p99", "mean")
+    for name, values in sorted(results["latency_ms"].iteritems()):
+        line = "{0:<32}{1:>10.2f}{2:>10.2f}{3:>10.2f}{4:>10.2f}".format(name, values["p50"], values["p90"],
+                                                                        values["p99"], values["mean"])
+        before = previous["latency_ms"].get(name) if previous else None
+        if before and before["p50"]:
+            line += "   p50 {0:+.1f}%".format(100.0 * (values["p50"] - before["p50"]) / before["p50"])
+        print line
+    if previous:
+        for name, values in sorted(results["ingest"].iteritems()):
+            before = previous["ingest"].get(name)
+            if before and before["documents_per_second"] and values["documents_per_second"]:
+                print "{0}: {1:+.1f}% documents/second".format(
+                    name, 100.0 * (values["documents_per_second"] - before["documents_per_second"]) /
+                    before["documents_per_second"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks ingest, search and suggest.")
+    parser.add_argument("--corpus", help="text file with one document per line instead of a synthetic corpus")
+    parser.add_argument("--documents", type=int, default=10000, help="documents to index")
+    parser.add_argument("--vocabulary", type=int, default=20000, help="distinct words of the synthetic corpus")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of the word frequencies")
+    parser.add_argument("--length", type=int, default=100, help="mean words per synthetic document")
+    parser.add_argument("--single", type=int, default=200, help="documents indexed one by one through index()")
+    parser.add_argument("--queries", type=int, default=100, help="queries of every kind")
+    parser.add_argument("--repeat", type=int, default=3, help="times every query is timed")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed queries of every kind")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--deepindexing", action="store_true")
+    parser.add_argument("--block-size", type=int)
+    parser.add_argument("--host", default=DB_HOST)
+    parser.add_argument("--port", type=int, default=DB_PORT)
+    parser.add_argument("--user", default=DB_USER)
+    parser.add_argument("--password", default=DB_PASSWORD)
+    parser.add_argument("--database", default=DB_NAME + "_benchmark", help="wiped and rebuilt by the benchmark")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    arguments = parser.parse_args()
+    if arguments.database == DB_NAME:
+        parser.error("the benchmark wipes --database, it can not be the configured DB_NAME")
+    previous = None
+    if arguments.compare:
+        with open(arguments.compare) as f:
+            previous = json.load(f)
+    results = run(arguments)
+    with open(arguments.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    report(results, previous)
+    print "Results written to {0}".format(arguments.output)
+
+
+if __name__ == '__main__':
+    main()
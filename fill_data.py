@@ -1,57 +1,20 @@
-from time import sleep
-
-import wikipedia
-from requests import ConnectionError
+import re
 
+from server.crawler import Crawler
 from server.indexer import Indexer
 
-counter = 0
+WIKI = "https://ro.wikipedia.org/wiki/"
+# articles only: no Special:, Categorie:, Discutie: pages
+ARTICLE = re.compile(r'^' + re.escape(WIKI) + r'[^:?]+$')
 
 
 def search():
-    global counter
-    resolved = []
-    for ii in "abcdefghijklmnopqrstuvwxyz"[::-1]:
-        while True:
-            try:
-                s = wikipedia.search(ii)
-                break
-            except ConnectionError:
-                sleep(10)
-        for i in s:
-            while True:
-                try:
-                    page = wikipedia.page(i)
-                    break
-                except ConnectionError:
-                    sleep(10)
-            for j in page.content:
-                while True:
-                    try:
-                        s2 = wikipedia.search(j)
-                        break
-                    except ConnectionError:
-                        sleep(10)
-                for k in s2:
-                    while True:
-                        try:
-                            page2 = wikipedia.page(k)
-                            content = page2.content
-                            title = page2.title
-                            break
-                        except ConnectionError:
-                            sleep(10)
-                        except wikipedia.DisambiguationError:
-                            continue
-                    if k not in resolved:
-                        resolved.append(k)
-                        indexer.index(content, fields={"title": title})
-                        counter += 1
-                        print counter
+    crawler = Crawler(indexer, connections=8, delay=1.0, depth=2, accept=ARTICLE.match)
+    counter = crawler.crawl([WIKI + letter.upper() for letter in "abcdefghijklmnopqrstuvwxyz"[::-1]])
+    print "Indexed {0} pages {1}".format(counter, crawler.stats)
 
 
 if __name__ == '__main__':
     indexer = Indexer(deepindexing=True)
     # indexer.create_index()
-    wikipedia.set_lang("ro")
     search()
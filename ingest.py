@@ -0,0 +1,46 @@
+"""
+Streams a text, JSONL or JSON array file into the index, resuming an interrupted load of the same file.
+
+    python ingest.py input.txt
+    python ingest.py sample.json --create-index --fields country_name,county_name,street_name
+"""
+import argparse
+import time
+
+from server.config import DB_HOST, DB_PORT, DB_PASSWORD, DB_USER, DB_NAME
+from server.indexer import Indexer
+from server.sources import FORMATS
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Indexes a file in batches, checkpointing its offset.")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=sorted(FORMATS), help="defaults to the extension of the file")
+    parser.add_argument("--batch-size", type=int, default=1000, help="documents committed together")
+    parser.add_argument("--text", help="key of the JSON records holding the text, instead of all their strings")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint of an earlier load")
+    parser.add_argument("--create-index", action="store_true", help="wipe the index and create it first")
+    parser.add_argument("--fields", help="comma separated fields declared to create_index()")
+    parser.add_argument("--deepindexing", action="store_true", help="option of a new index, an existing one keeps its own")
+    parser.add_argument("--positional", action="store_true", help="option of a new index")
+    parser.add_argument("--block-size", type=int, help="option of a new index")
+    parser.add_argument("--host", default=DB_HOST)
+    parser.add_argument("--port", type=int, default=DB_PORT)
+    parser.add_argument("--user", default=DB_USER)
+    parser.add_argument("--password", default=DB_PASSWORD)
+    parser.add_argument("--database", default=DB_NAME)
+    arguments = parser.parse_args()
+    indexer = Indexer(deepindexing=arguments.deepindexing, positional=arguments.positional,
+                      block_size=arguments.block_size, host=arguments.host, port=arguments.port,
+                      password=arguments.password, user=arguments.user, database=arguments.database)
+    if arguments.create_index:
+        indexer.create_index(arguments.fields.split(",") if arguments.fields else None)
+    start = time.time()
+    counter = indexer.index_file(arguments.path, arguments.format, arguments.batch_size, arguments.text,
+                                 arguments.restart)
+    stop = time.time()
+    print "Indexed {0} documents in {1} seconds".format(counter, stop - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,4 @@
 # coding=utf-8
-import json
 import msvcrt
 import os
 import sys
@@ -35,12 +34,8 @@ def suggest(data, node=None):
 def index1():
     indexer = Indexer(deepindexing=True)
     indexer.create_index()
-    data = open("input.txt").readlines()
-    data[0] = data[0][3:]
-    counter = 0
     start = time.time()
-    for row in data:
-        counter += indexer.index(row)
+    counter = indexer.index_file("input.txt")
     stop = time.time()
     print "Indexed {0} elements in {1} seconds".format(counter, stop - start)
 
@@ -48,13 +43,21 @@ def index1():
 def index2():
     indexer = Indexer()
     indexer.create_index(["country_name", "county_name", "street_name"])
-    data = json.load(open("sample.json"))
     start = time.time()
-    counter = indexer.index(data)
+    counter = indexer.index_file("sample.json")
     stop = time.time()
     print "Indexed {0} elements in {1} seconds".format(counter, stop - start)
 
 
+def facets(fields, data=None, filters=None):
+    indexer = Indexer()
+    for field, counts in indexer.facets(fields, data, filters).iteritems():
+        print field
+        for value, count in counts:
+            print "   ", value, count
+    print
+
+
 def classical_search(term):
     database = psycopg2.connect(host=DB_HOST, port=DB_PORT, password=DB_PASSWORD, user=DB_USER,
                                 database=DB_NAME)
@@ -113,6 +116,7 @@ if __name__ == '__main__':
     # index1()
     # index2()
     # suggest("mp")
+    # facets(["county_name"], filters={"country_name": "Romania"})
     dynamic_search()
     # search('craiul')
     # classical_search("paianjen")
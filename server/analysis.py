@@ -0,0 +1,132 @@
+import re
+import unicodedata
+from collections import Counter
+
+SYMBOLS = '!@#&()|[{}]:;\',?/*`~$^+=<>".-_'
+
+
+def flatten_diacritics(data):
+    try:
+        data = unicode(data).decode('unicode-escape')
+    finally:
+        return unicodedata.normalize("NFKD", data).encode("ascii", "ignore")
+
+
+_TOKEN = re.compile(r'[a-zA-Z0-9\-\'"]+')
+_NON_ASCII = re.compile(u'[^\x00-\x7f]+')
+
+
+class Tokenizer:
+    """
+    Single pass tokenizer producing the same tokens as term_frequencies() used to. The document is
+    folded to ascii once (ascii documents are not normalized at all) and lowercased once, tokens come
+    from one precompiled pattern and are counted as they are found.
+    """
+
+    def __init__(self, diacritics_sensitive=False, symbols=SYMBOLS):
+        self._diacritics_sensitive = diacritics_sensitive
+        self._symbols = symbols
+
+    def _text(self, data):
+        try:
+            data = data.decode("utf8")
+        except UnicodeEncodeError:
+            pass
+        if self._diacritics_sensitive is False and u"\\" in data:
+            # flatten_diacritics() resolves escape sequences of ascii documents first
+            try:
+                data = data.encode("ascii").decode("unicode-escape")
+            except UnicodeError:
+                pass
+        try:
+            text = data.encode("ascii")
+        except UnicodeEncodeError:
+            if self._diacritics_sensitive is False:
+                text = unicodedata.normalize("NFKD", data).encode("ascii", "ignore")
+            else:
+                # only ascii characters make tokens, the others separate them
+                text = _NON_ASCII.sub(u" ", data).encode("ascii")
+        return text.lower()
+
+    def normalize(self, data):
+        """
+        Folds data the way tokens() sees it, with its whitespace collapsed, e.g. for exact field values.
+        """
+        return " ".join(self._text(data).split())
+
+    def tokens(self, data):
+        symbols = self._symbols
+        for match in _TOKEN.finditer(self._text(data)):
+            token = match.group().strip(symbols)
+            if token and token != "u":
+                yield token
+
+    def terms(self, data, positions=False):
+        """
+        Yields (term, frequency, positions) for every distinct term of data. positions lists the
+        positions of the term among the kept tokens, or is None unless asked for.
+        """
+        symbols = self._symbols
+        found = {}
+        if positions:
+            position = 0
+            for token in _TOKEN.findall(self._text(data)):
+                token = token.strip(symbols)
+                if token and token != "u":
+                    if token in found:
+                        found[token].append(position)
+                    else:
+                        found[token] = [position]
+                    position += 1
+            for term, term_positions in found.iteritems():
+                yield term, len(term_positions), term_positions
+        else:
+            get = found.get
+            for token in _TOKEN.findall(self._text(data)):
+                token = token.strip(symbols)
+                if token and token != "u":
+                    found[token] = get(token, 0) + 1
+            for term, frequency in found.iteritems():
+                yield term, frequency, None
+
+
+def term_frequencies(data, diacritics_sensitive=False, symbols=SYMBOLS):
+    return Counter(dict((term, frequency)
+                        for term, frequency, _ in Tokenizer(diacritics_sensitive, symbols).terms(data)))
+
+
+def ngrams(term, gram_size=None):
+    if gram_size:
+        return list(set(term[j:j + i] for i in range(1, min(gram_size, len(term)) + 1)
+                        for j in range(len(term) - i + 1)))
+    result = []
+    for i in range(1, len(term)):
+        for j in range(len(term) - i + 1):
+            result.append(term[j:j + i])
+    result.append(term)
+    return list(set(result))
+
+
+def analyze_batch(batch, diacritics_sensitive=False, symbols=SYMBOLS, deepindexing=False, gram_size=None,
+                  positional=False):
+    """
+    Tokenizes a batch of (data, fields) documents. Returns the postings and frequencies of every term
+    as positions in the batch, the length of every document, with deepindexing the n-grams of every
+    term and with positional the word positions of every term, parallel to its postings.
+    """
+    postings = {}
+    frequencies = {}
+    positions = {} if positional else None
+    lengths = []
+    tokenizer = Tokenizer(diacritics_sensitive, symbols)
+    for position, (data, fields) in enumerate(batch):
+        length = 0
+        for term, frequency, term_positions in tokenizer.terms(data, positional):
+            postings.setdefault(term, []).append(position)
+            frequencies.setdefault(term, []).append(frequency)
+            if positional:
+                positions.setdefault(term, []).append(term_positions)
+            length += frequency
+        lengths.append(length)
+    grams = dict((term, ngrams(term, gram_size)) for term in postings) if deepindexing else None
+    return postings, frequencies, lengths, grams, positions
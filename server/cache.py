@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+    """
+    Size bounded LRU cache with a time to live. Every entry is registered under the dependencies it
+    was computed from so a write can invalidate exactly the entries it makes stale.
+    """
+
+    def __init__(self, size=1024, ttl=60):
+        self._size = size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._dependents = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _discard(self, key):
+        expires, dependencies, value = self._entries.pop(key)
+        for dependency in dependencies:
+            keys = self._dependents.get(dependency)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._dependents[dependency]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self._ttl and entry[0] < time.time()):
+                if entry is not None:
+                    self._discard(key)
+                self.misses += 1
+                return None
+            self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, dependencies, value):
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            while len(self._entries) >= self._size:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = (time.time() + self._ttl, dependencies, value)
+            for dependency in dependencies:
+                self._dependents.setdefault(dependency, set()).add(key)
+
+    def invalidate(self, dependencies):
+        with self._lock:
+            for dependency in dependencies:
+                for key in list(self._dependents.get(dependency, ())):
+                    self._discard(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dependents.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
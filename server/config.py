@@ -4,3 +4,20 @@ DB_PORT = 5432
 DB_PASSWORD = ''
 DB_USER = 'postgres'
 DB_NAME = 'licenta'
+# when set, serve.py spreads the index over these databases, e.g. ['dbname=shard0 user=postgres', ...],
+# instead of DB_NAME; the list must not change once documents are indexed
+SHARD_DSNS = []
+
+# COMPACTION
+# serve.py purges the documents deleted with deferred=True every this many seconds; 0 leaves it to others
+COMPACTION_INTERVAL = 60
+
+# SNAPSHOT
+# when set, serve.py answers search and suggest from this file written by Indexer.export_snapshot()
+SNAPSHOT_PATH = ''
+
+# INSTRUMENTATION
+# operations slower than this many seconds are logged, as JSON, to the indexer.slow_queries logger
+SLOW_QUERY_SECONDS = 0.5
+# file the slow operations are also appended to, when set
+SLOW_QUERY_LOG = ''
@@ -0,0 +1,316 @@
+import heapq
+import httplib
+import multiprocessing
+import socket
+import threading
+import time
+import urllib2
+from HTMLParser import HTMLParseError, HTMLParser
+from Queue import Empty, Queue
+from urlparse import urldefrag, urljoin, urlparse
+
+import html2text
+
+HTML_TYPES = ("text/html", "application/xhtml+xml")
+RETRIED_STATUSES = (429, 500, 502, 503, 504)
+USER_AGENT = "indexer-crawler/1.0"
+
+
+def _host(url):
+    return urlparse(url).netloc.lower()
+
+
+class _PageParser(HTMLParser):
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = []
+        self.title = []
+        self._in_title = False
+
+    def handle_starttag(self, tag, attributes):
+        if tag == "a":
+            self.links.extend(value for name, value in attributes if name == "href" and value)
+        elif tag == "title":
+            self._in_title = True
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self._in_title = False
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title.append(data)
+
+
+def html_to_text(arguments):
+    """
+    Converts a fetched (url, content, charset, html) page to (text, title, links), links being absolute
+    http(s) URLs without fragments. Runs in the worker processes of a Crawler.
+    """
+    url, content, charset, html = arguments
+    try:
+        content = content.decode(charset or "utf8", "replace")
+    except LookupError:
+        content = content.decode("utf8", "replace")
+    if not html:
+        return content, None, []
+    parser = _PageParser()
+    try:
+        parser.feed(content)
+        parser.close()
+    except HTMLParseError:
+        # whatever was parsed before the broken markup is kept
+        pass
+    converter = html2text.HTML2Text()
+    converter.ignore_links = True
+    converter.ignore_images = True
+    links = [urldefrag(urljoin(url, link))[0] for link in parser.links]
+    return (converter.handle(content), " ".join("".join(parser.title).split()) or None,
+            [link for link in links if link.startswith(("http://", "https://"))])
+
+
+class _Frontier:
+    """
+    URLs waiting to be fetched, handed out in the order of the time they may be fetched at. get()
+    returns None once nothing is waiting and no URL being visited can add more.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = 0
+        self._visiting = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def put(self, url, depth, attempt=0, ready=0):
+        with self._condition:
+            heapq.heappush(self._heap, (ready, self._sequence, url, depth, attempt))
+            self._sequence += 1
+            self._condition.notify()
+
+    def get(self):
+        with self._condition:
+            while not self._closed:
+                if self._heap:
+                    wait = self._heap[0][0] - time.time()
+                    if wait <= 0:
+                        ready, sequence, url, depth, attempt = heapq.heappop(self._heap)
+                        self._visiting += 1
+                        return url, depth, attempt
+                    self._condition.wait(wait)
+                elif self._visiting:
+                    self._condition.wait()
+                else:
+                    self._closed = True
+                    self._condition.notify_all()
+            return None
+
+    def done(self):
+        with self._condition:
+            self._visiting -= 1
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class Crawler:
+    """
+    Crawls from seed URLs into an indexer (an Indexer or anything with its index_many()).
+
+    connections fetcher threads bound the open connections. Requests to one host start at least delay
+    seconds apart, and a host that fails or answers 429/5xx is left alone for delay * backoff ** attempt
+    seconds (or its Retry-After) before the page is retried, at most retries times; waiting pages go
+    back to the frontier instead of holding a connection. Every URL is fetched once, the seen URLs
+    being kept in a set. Pages are converted to text by a pool of worker processes, and the
+    documents, with their url and title as fields, are indexed in batches of batch_size by a writer
+    thread; at most queue_size batches wait for it, so fetching slows down when indexing falls behind.
+    A batch that is not full is indexed after flush_interval seconds without new documents. A page that
+    cannot be fetched or converted only counts as failed; an indexing error stops the crawl.
+
+    Links are followed up to depth links away from the seeds, on the hosts of the seeds unless
+    same_host is False, and only when accept(url) holds if given; max_pages bounds the URLs fetched.
+    A Crawler crawls once.
+    """
+
+    def __init__(self, indexer, connections=8, delay=1.0, backoff=2.0, retries=3, timeout=10, workers=None,
+                 batch_size=100, queue_size=4, flush_interval=5, depth=2, same_host=True, accept=None,
+                 max_pages=None, user_agent=USER_AGENT):
+        self._indexer = indexer
+        self._connections = connections
+        self._delay = delay
+        self._backoff = backoff
+        self._retries = retries
+        self._timeout = timeout
+        self._workers = workers or multiprocessing.cpu_count()
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._depth = depth
+        self._same_host = same_host
+        self._accept = accept
+        self._max_pages = max_pages
+        self._user_agent = user_agent
+        self._frontier = _Frontier()
+        self._documents = Queue(batch_size * queue_size)
+        self._seen = set()
+        self._seeds = set()
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._error = None
+        self.stats = dict((name, 0) for name in ("fetched", "retried", "failed", "skipped", "indexed"))
+
+    def _record(self, name, count=1):
+        with self._lock:
+            self.stats[name] += count
+
+    def _fail(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._frontier.close()
+
+    def _admit(self, url, depth):
+        host = _host(url)
+        if depth and (self._same_host and host not in self._seeds or self._accept and not self._accept(url)):
+            return
+        with self._lock:
+            if url in self._seen or (self._max_pages and len(self._seen) >= self._max_pages):
+                return
+            self._seen.add(url)
+        self._frontier.put(url, depth)
+
+    def _slot(self, host):
+        """
+        Reserves the next request to host: returns 0 when it may start now, else when to try again.
+        """
+        with self._lock:
+            now = time.time()
+            ready = self._hosts.get(host, 0)
+            if ready > now:
+                return ready
+            self._hosts[host] = now + self._delay
+            return 0
+
+    def _retry(self, url, depth, attempt, host, retry_after=None):
+        if attempt >= self._retries:
+            self._record("failed")
+            return
+        wait = self._delay * self._backoff ** (attempt + 1)
+        if retry_after and retry_after.isdigit():
+            wait = max(wait, int(retry_after))
+        with self._lock:
+            ready = self._hosts[host] = max(self._hosts.get(host, 0), time.time() + wait)
+        self._record("retried")
+        self._frontier.put(url, depth, attempt + 1, ready)
+
+    def _fetch(self, url):
+        response = urllib2.urlopen(urllib2.Request(url, headers={"User-Agent": self._user_agent}),
+                                   timeout=self._timeout)
+        try:
+            info = response.info()
+            return response.read(), info.getparam("charset"), info.gettype()
+        finally:
+            response.close()
+
+    def _visit(self, url, depth, attempt):
+        host = _host(url)
+        ready = self._slot(host)
+        if ready:
+            self._frontier.put(url, depth, attempt, ready)
+            return
+        try:
+            content, charset, kind = self._fetch(url)
+        except urllib2.HTTPError as error:
+            if error.code in RETRIED_STATUSES:
+                self._retry(url, depth, attempt, host, error.info().get("Retry-After"))
+            else:
+                self._record("failed")
+            return
+        except (urllib2.URLError, httplib.HTTPException, socket.error):
+            self._retry(url, depth, attempt, host)
+            return
+        self._record("fetched")
+        if kind not in HTML_TYPES and kind != "text/plain":
+            self._record("skipped")
+            return
+        text, title, links = self._pool.apply(html_to_text, [(url, content, charset, kind in HTML_TYPES)])
+        if depth < self._depth:
+            for link in links:
+                self._admit(link, depth + 1)
+        text = text.strip()
+        if text:
+            fields = {"url": url, "title": title} if title else {"url": url}
+            # blocks while queue_size batches wait for the writer
+            self._documents.put((text, fields))
+
+    def _fetcher(self):
+        while True:
+            item = self._frontier.get()
+            if item is None:
+                return
+            try:
+                self._visit(*item)
+            except Exception:
+                # a page that breaks the conversion, e.g. in html2text, only loses that page
+                self._record("failed")
+            finally:
+                self._frontier.done()
+
+    def _write(self, batch):
+        if self._error is None:
+            try:
+                self._indexer.index_many(batch, self._batch_size)
+                self._record("indexed", len(batch))
+            except Exception as error:
+                self._fail(error)
+
+    def _writer(self):
+        batch = []
+        while True:
+            try:
+                document = self._documents.get(timeout=self._flush_interval)
+            except Empty:
+                if batch:
+                    self._write(batch)
+                    batch = []
+                continue
+            if document is None:
+                break
+            batch.append(document)
+            if len(batch) >= self._batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def crawl(self, urls):
+        """
+        Crawls from urls until no page is left to fetch. Returns the number of indexed documents;
+        stats also counts the fetched, retried, failed and skipped pages.
+        """
+        urls = [urldefrag(url)[0] for url in urls]
+        self._seeds.update(_host(url) for url in urls)
+        for url in urls:
+            self._admit(url, 0)
+        self._pool = multiprocessing.Pool(self._workers)
+        writer = threading.Thread(target=self._writer)
+        writer.start()
+        fetchers = [threading.Thread(target=self._fetcher) for _ in range(self._connections)]
+        try:
+            for fetcher in fetchers:
+                fetcher.daemon = True
+                fetcher.start()
+            for fetcher in fetchers:
+                fetcher.join()
+        finally:
+            self._frontier.close()
+            self._documents.put(None)
+            writer.join()
+            self._pool.close()
+            self._pool.join()
+        if self._error is not None:
+            raise self._error
+        return self.stats["indexed"]
@@ -0,0 +1,60 @@
+# ids read from the postings of every gram, or terms scanned without n-grams, per query term
+CANDIDATE_BUDGET = 1024
+# variants kept per query term, fewest edits first
+MAX_VARIANTS = 64
+
+
+def max_edits(term):
+    """
+    Edits tolerated for a query term: none for up to 2 characters, 1 for up to 5, 2 beyond.
+    """
+    if len(term) <= 2:
+        return 0
+    if len(term) <= 5:
+        return 1
+    return 2
+
+
+def candidate_grams(term, gram_size, edits):
+    """
+    Returns the distinct grams of term used to find its variants and how many of them a variant
+    within edits edits shares at least: every edit destroys at most gram_size grams, so the grams
+    are shortened until that bound is positive.
+    """
+    size = max(1, min(gram_size or 3, len(term) // (edits + 1)))
+    grams = set(term[i:i + size] for i in range(len(term) - size + 1))
+    return list(grams), max(1, len(grams) - edits * size)
+
+
+def distance(first, second, limit):
+    """
+    Levenshtein distance between first and second, or None when it is larger than limit. Only the
+    band of 2 * limit + 1 diagonals is computed and it stops as soon as a whole row exceeds limit.
+    """
+    if abs(len(first) - len(second)) > limit:
+        return None
+    if len(first) > len(second):
+        first, second = second, first
+    beyond = limit + 1
+    previous = [j if j <= limit else beyond for j in range(len(second) + 1)]
+    for i in range(1, len(first) + 1):
+        low = max(1, i - limit)
+        high = min(len(second), i + limit)
+        current = [beyond] * (len(second) + 1)
+        if i <= limit:
+            current[0] = i
+        character = first[i - 1]
+        for j in range(low, high + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (character != second[j - 1]),
+                             beyond)
+        if min(current[low - 1:high + 1]) > limit:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= limit else None
+
+
+def weight(edits):
+    """
+    Score multiplier of a term variant edits edits away from the query term.
+    """
+    return 1.0 / (1 + edits)
@@ -1,104 +1,507 @@
 # coding=utf-8
 import json
+import logging
+import os
+import random
 import re
+import threading
 import time
-import unicodedata
 import urllib2
+import weakref
+from binascii import hexlify
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from contextlib import contextmanager
+from cStringIO import StringIO
+from itertools import chain
 
 import psycopg2
 from psycopg2 import sql
 
 import html2text
 
+from analysis import SYMBOLS, Tokenizer, analyze_batch, flatten_diacritics, ngrams
+from cache import QueryCache
 from config import DB_HOST, DB_PORT, DB_PASSWORD, DB_USER, DB_NAME
+from fuzzy import CANDIDATE_BUDGET, MAX_VARIANTS, candidate_grams, distance, max_edits, weight
+from metrics import DISABLED, TimedCursor
+from paging import Page, from_cursor, snippet
+from pipeline import IngestPipeline
+from pool import ConnectionPool
+from postings import decode_block, encode_block, intersect, intersect_all
+from query import (MAX_EXPANSIONS, Intersection, PostingIterator, QueryError, Union, compile_plan,
+                   constraint_terms, execute, is_boolean, leaves, parse, parse_boolean, satisfied)
+from ranking import BM25, DocumentLengths, TermCursor, top_k
+from snapshot import SnapshotWriter
+from sources import file_format, fingerprint, read, record_document
+from trie import SuggestionTrie
+
+# generations of changes kept in index._changes; an Indexer further behind reloads its trie
+CHANGE_LOG_SIZE = 10000
 
 
 class Indexer:
-    def __init__(self, diacritics_sensitive=False, deepindexing=False,
-                 host=DB_HOST, port=DB_PORT, password=DB_PASSWORD, user=DB_USER,
-                 database=DB_NAME):
-        self._database = psycopg2.connect(host=host, port=port, password=password, user=user,
-                                          database=database)
-        self._cursor = self._database.cursor()
-        self._symbols = '!@#&()|[{}]:;\',?/*`~$^+=<>".-_'
-        self._diacritics_sensitive = diacritics_sensitive
-        self._deepindexing = deepindexing
+    def __init__(self, diacritics_sensitive=False, deepindexing=False, gram_size=3,
+                 autocomplete=False, autocomplete_size=20, cache_size=0, cache_ttl=60, sync_interval=1,
+                 pool_size=4, replicas=None, block_size=None, positional=False, instrumentation=None,
+                 shard=None, host=DB_HOST, port=DB_PORT, password=DB_PASSWORD, user=DB_USER,
+                 database=DB_NAME, dsn=None):
+        """
+        With deepindexing the n-gram node keeps, for every term, its substrings of at most gram_size
+        characters; longer substrings are answered by intersecting their grams and verifying the
+        candidates. gram_size=None keeps every substring of every term instead.
+
+        With autocomplete the terms of the general index are loaded into an in-memory trie keeping the
+        autocomplete_size most frequent completions of every prefix; prefix suggestions are answered
+        from it. Every write records the terms it changed in index._changes, and a daemon thread applies
+        the changes made by any process to the trie every sync_interval seconds, so a suggestion never
+        waits on the database.
+
+        With cache_size search and suggest results are kept in an LRU cache for cache_ttl seconds. The
+        same thread drops the results depending on a term changed in index._changes, whichever process
+        made the change; a cache hit costs no round-trip.
+
+        Every operation checks a connection out of a pool of at most pool_size connections, so one
+        Indexer can be shared between threads. replicas is a list of DSNs of read-only replicas which,
+        when given, serve search and suggest.
+
+        With block_size the postings of the general index are stored in index._general_blocks as blocks
+        of at most block_size delta and varint encoded ids instead of growing INT[] arrays; indexing only
+        rewrites the last block of a term and search only decodes the blocks it needs.
+
+        With positional the positions of every term in every document are kept in index._positions, and
+        search() understands "quoted phrases" and a NEAR/n b (b at most n words away from a).
+
+        instrumentation is a metrics.Instrumentation timing every index, search and suggest call by
+        stage (tokenize, lookup, intersection, ranking, hydration, db round-trips); without it no
+        timing is done at all.
+
+        diacritics_sensitive, deepindexing, gram_size, block_size and positional are the options
+        create_index() creates the index with and stores in index._options; an Indexer opened on an
+        existing index uses the stored options instead.
+
+        shard=(i, n) makes this Indexer shard i of the n of a sharding.ShardedIndexer: create_index()
+        numbers its documents i + 1, i + 1 + n, ... so that every id tells its shard. dsn, when given,
+        replaces host, port, password, user and database.
+        """
+        if dsn:
+            self._pool = ConnectionPool(pool_size, dsn=dsn)
+        else:
+            self._pool = ConnectionPool(pool_size, host=host, port=port, password=password, user=user,
+                                        database=database)
+        self._replicas = [ConnectionPool(pool_size, dsn=dsn) for dsn in replicas or []]
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._instrumentation = instrumentation
+        self._shard = shard
+        self._symbols = SYMBOLS
+        self._create_options = {
+            "diacritics_sensitive": diacritics_sensitive,
+            "deepindexing": deepindexing,
+            "gram_size": gram_size,
+            "block_size": block_size,
+            "positional": positional,
+        }
+        self._use_options(dict(self._create_options, **self._load_options()))
+        self._autocomplete_size = autocomplete_size
+        self._trie = SuggestionTrie(self._autocomplete_size) if autocomplete else None
+        self._cache = QueryCache(cache_size, cache_ttl) if cache_size else None
+        self._epoch = None
+        self._generation = 0
+        self._sync()
+        self._fields = self._load_fields()
+        if sync_interval and (self._trie is not None or self._cache is not None):
+            self._start_sync(sync_interval)
 
     def __del__(self):
-        self._database.close()
+        for pool in [self._pool] + self._replicas:
+            pool.close()
+
+    @contextmanager
+    def _connection(self, read_only=False):
+        pool = random.choice(self._replicas) if read_only and self._replicas else self._pool
+        with pool.connection() as connection:
+            if self._instrumentation is None:
+                yield connection.cursor()
+            else:
+                yield TimedCursor(connection.cursor(), self._instrumentation)
+
+    def _operation(self, name, **details):
+        if self._instrumentation is None:
+            return DISABLED
+        return self._instrumentation.start(name, **details)
+
+    def _stage(self, name):
+        if self._instrumentation is None:
+            return DISABLED
+        return self._instrumentation.stage(name)
+
+    def _annotate(self, **details):
+        if self._instrumentation is not None:
+            self._instrumentation.annotate(**details)
 
     @staticmethod
     def _flatten_diacritics(data):
-        try:
-            data = unicode(data).decode('unicode-escape')
-        finally:
-            return unicodedata.normalize("NFKD", data).encode("ascii", "ignore")
+        return flatten_diacritics(data)
 
     def delete_schema(self):
+        with self._connection() as cursor:
+            self._delete_schema(cursor)
+
+    def _delete_schema(self, cursor):
         try:
-            self._cursor.execute('''DROP SCHEMA index CASCADE''')
+            cursor.execute('''DROP SCHEMA index CASCADE''')
         except psycopg2.ProgrammingError:
-            self._database.rollback()
-        self._cursor.execute('''CREATE SCHEMA index''')
-        self._cursor.execute('''GRANT ALL ON SCHEMA index TO postgres''')
-        self._cursor.execute('''GRANT ALL ON SCHEMA index TO public''')
-        self._database.commit()
+            cursor.connection.rollback()
+        cursor.execute('''CREATE SCHEMA index''')
+        cursor.execute('''GRANT ALL ON SCHEMA index TO postgres''')
+        cursor.execute('''GRANT ALL ON SCHEMA index TO public''')
+        cursor.connection.commit()
         try:
-            self._cursor.execute('''DROP SCHEMA data CASCADE''')
+            cursor.execute('''DROP SCHEMA data CASCADE''')
         except psycopg2.ProgrammingError:
-            self._database.rollback()
-        self._cursor.execute('''CREATE SCHEMA data''')
-        self._cursor.execute('''GRANT ALL ON SCHEMA data TO postgres''')
-        self._cursor.execute('''GRANT ALL ON SCHEMA data TO public''')
-        self._database.commit()
-
-    def _create_schema(self):
-        self._cursor.execute('''
+            cursor.connection.rollback()
+        cursor.execute('''CREATE SCHEMA data''')
+        cursor.execute('''GRANT ALL ON SCHEMA data TO postgres''')
+        cursor.execute('''GRANT ALL ON SCHEMA data TO public''')
+        cursor.connection.commit()
+
+    def _create_schema(self, cursor):
+        cursor.execute('''
                            CREATE TABLE data.original (
                                id BIGSERIAL CONSTRAINT PK_original PRIMARY KEY,
                                data TEXT,
                                fields JSONB,
-                               timestamp INT)''')
-        self._cursor.execute('''
+                               timestamp INT,
+                               length INT)''')
+        cursor.execute('''
                     CREATE TABLE index._general_index (
                       id BIGSERIAL CONSTRAINT PK_general_index PRIMARY KEY,
                       term TEXT CONSTRAINT UNIQUE_general_index_term UNIQUE,
-                      inverted_index INT[])''')
-        self._cursor.execute('''CREATE UNIQUE INDEX term_idx_general_index ON index._general_index USING btree(term)''')
-        self._cursor.execute('''
+                      inverted_index INT[],
+                      frequencies INT[],
+                      max_frequency INT,
+                      document_frequency INT,
+                      tombstoned INT DEFAULT 0)''')
+        cursor.execute('''CREATE UNIQUE INDEX term_idx_general_index ON index._general_index USING btree(term)''')
+        cursor.execute('''
                     CREATE TABLE index._ngram_index(
                       id BIGSERIAL CONSTRAINT PK_ngram_index PRIMARY KEY,
                       term TEXT CONSTRAINT UNIQUE_ngram_index_term UNIQUE,
                       inverted_index INT[])''')
-        self._cursor.execute('''CREATE INDEX term_idx_ngram_index ON index._ngram_index USING hash(term)''')
-        self._database.commit()
+        cursor.execute('''CREATE INDEX term_idx_ngram_index ON index._ngram_index USING hash(term)''')
+        cursor.execute('''
+                    CREATE TABLE index._general_blocks(
+                      term TEXT,
+                      block INT,
+                      first_id INT,
+                      last_id INT,
+                      count INT,
+                      postings BYTEA,
+                      CONSTRAINT PK_general_blocks PRIMARY KEY (term, block))''')
+        cursor.execute('''
+                    CREATE TABLE index._statistics(
+                      id INT CONSTRAINT PK_statistics PRIMARY KEY DEFAULT 1,
+                      documents BIGINT,
+                      length BIGINT,
+                      epoch BIGINT,
+                      generation BIGINT)''')
+        cursor.execute(
+            sql.SQL('''INSERT INTO index._statistics (documents, length, epoch, generation) VALUES (0, 0, {epoch}, 0)''').format(
+                epoch=sql.Literal(random.getrandbits(62))
+            )
+        )
+        cursor.execute('''
+                    CREATE TABLE index._changes(
+                      generation BIGINT CONSTRAINT PK_changes PRIMARY KEY,
+                      terms TEXT[],
+                      deltas INT[],
+                      field_terms TEXT[],
+                      timestamp INT)''')
+        cursor.execute('''
+                    CREATE TABLE index._positions(
+                      term TEXT,
+                      id INT,
+                      positions INT[],
+                      CONSTRAINT PK_positions PRIMARY KEY (term, id))''')
+        cursor.execute('''
+                    CREATE TABLE index._options(
+                      name TEXT CONSTRAINT PK_options PRIMARY KEY,
+                      value JSONB)''')
+        cursor.execute('''
+                    CREATE TABLE index._fields(
+                      name TEXT CONSTRAINT PK_fields PRIMARY KEY)''')
+        cursor.execute('''
+                    CREATE TABLE index._field_index(
+                      id BIGSERIAL CONSTRAINT PK_field_index PRIMARY KEY,
+                      term TEXT CONSTRAINT UNIQUE_field_index_term UNIQUE,
+                      inverted_index INT[])''')
+        cursor.execute('''CREATE INDEX term_idx_field_index ON index._field_index USING btree(term text_pattern_ops)''')
+        cursor.execute('''
+                    CREATE TABLE data.tombstones(
+                      id BIGINT CONSTRAINT PK_tombstones PRIMARY KEY,
+                      timestamp INT)''')
+        self._create_checkpoints(cursor)
+        if self._shard is not None:
+            shard, shards = self._shard
+            cursor.execute(
+                sql.SQL('''ALTER SEQUENCE data.original_id_seq INCREMENT BY {shards} RESTART WITH {first}''').format(
+                    shards=sql.Literal(shards),
+                    first=sql.Literal(shard + 1)
+                )
+            )
+        cursor.connection.commit()
+
+    @staticmethod
+    def _create_checkpoints(cursor):
+        cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS data.checkpoints(
+                      source TEXT CONSTRAINT PK_checkpoints PRIMARY KEY,
+                      position BIGINT,
+                      documents BIGINT,
+                      timestamp INT)''')
+        # checkpoints saved before fingerprints existed are resumed without a check
+        cursor.execute('''ALTER TABLE data.checkpoints ADD COLUMN IF NOT EXISTS fingerprint TEXT''')
+
+    def create_index(self, fields=None):
+        """
+        fields names the keys of the fields given to index() that get their own postings in
+        index._field_index: one per token of the value, searched as field:token, and one per whole
+        value, used by the filters of search() and by facets().
+        """
+        fields = [self._field_name(field) for field in fields or []]
+        for field in fields:
+            if not field or ":" in field or "=" in field:
+                raise Exception("{0} is not a valid field name!".format(field))
+        with self._connection() as cursor:
+            self._delete_schema(cursor)
+            self._create_schema(cursor)
+            cursor.execute(
+                sql.SQL(
+                    '''INSERT INTO index._options (name, value) SELECT * FROM UNNEST({names}::TEXT[], {values}::JSONB[])'''
+                ).format(
+                    names=sql.Literal(self._create_options.keys()),
+                    values=sql.Literal([json.dumps(value) for value in self._create_options.values()])
+                )
+            )
+            if fields:
+                cursor.execute(
+                    sql.SQL('''INSERT INTO index._fields (name) SELECT DISTINCT UNNEST({fields}::TEXT[])''').format(
+                        fields=sql.Literal(fields)
+                    )
+                )
+            cursor.connection.commit()
+        self._use_options(self._create_options)
+        self._fields = set(fields)
+        self._sync()
+
+    def _load_options(self):
+        with self._connection() as cursor:
+            try:
+                cursor.execute('''SELECT name, value FROM index._options''')
+                return dict((str(name), value) for name, value in cursor.fetchall())
+            except psycopg2.ProgrammingError:
+                return {}
+
+    def _use_options(self, options):
+        self._diacritics_sensitive = options["diacritics_sensitive"]
+        self._tokenizer = Tokenizer(self._diacritics_sensitive, self._symbols)
+        self._deepindexing = options["deepindexing"]
+        self._gram_size = options["gram_size"]
+        self._block_size = options["block_size"]
+        self._positional = options["positional"]
+
+    def cache_stats(self):
+        return self._cache.stats() if self._cache is not None else None
+
+    def _load_autocomplete(self, cursor):
+        """
+        Returns ((epoch, generation), trie) with the terms of the general index, or None without an index.
+        """
+        # the generation is read in the snapshot of the terms, so no change is applied twice or missed
+        cursor.execute('''SELECT statistics.epoch, statistics.generation, terms.term, terms.frequency
+                            FROM index._statistics AS statistics LEFT JOIN (
+                              SELECT term, COALESCE(document_frequency, cardinality(inverted_index)) - tombstoned
+                              AS frequency FROM index._general_index) AS terms ON TRUE''')
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        trie = SuggestionTrie(self._autocomplete_size)
+        trie.build((term, frequency) for epoch, generation, term, frequency in chain([row], cursor)
+                   if term is not None)
+        return tuple(row[:2]), trie
+
+    def _sync(self):
+        """
+        Applies to the trie and the cache the changes published by every Indexer on the index since the
+        last call. When the log no longer reaches back that far, or the index was created again, the
+        trie is reloaded and the cache cleared instead.
+        """
+        if self._trie is None and self._cache is None:
+            return
+        with self._sync_lock, self._connection() as cursor:
+            try:
+                cursor.execute(
+                    sql.SQL(
+                        '''SELECT statistics.epoch, statistics.generation, changes.generation, changes.terms,
+                            changes.deltas, changes.field_terms FROM index._statistics AS statistics
+                            LEFT JOIN index._changes AS changes ON changes.generation > {generation}
+                            ORDER BY changes.generation'''
+                    ).format(
+                        generation=sql.Literal(self._generation)
+                    )
+                )
+            except psycopg2.ProgrammingError:
+                return
+            rows = cursor.fetchall()
+            if not rows or rows[0][:2] == (self._epoch, self._generation):
+                return
+            if rows[0][0] != self._epoch or rows[0][2] != self._generation + 1:
+                version, trie = tuple(rows[0][:2]), self._trie
+                if trie is not None:
+                    version, trie = self._load_autocomplete(cursor) or (version, trie)
+                with self._lock:
+                    self._trie = trie
+                    self._epoch, self._generation = version
+                    if self._cache is not None:
+                        self._cache.clear()
+                return
+            with self._lock:
+                for row in rows:
+                    if self._trie is not None:
+                        for term, delta in zip(row[3], row[4]):
+                            self._trie.add(term, delta)
+                    self._invalidate(row[3], row[5])
+                self._generation = rows[0][1]
+
+    def _start_sync(self, interval):
+        """
+        Runs _sync() every interval seconds in a daemon thread, which stops once the Indexer is collected.
+        """
+        reference = weakref.ref(self)
 
-    def create_index(self):
-        self.delete_schema()
-        self._create_schema()
+        def synchronization():
+            while True:
+                time.sleep(interval)
+                indexer = reference()
+                if indexer is None:
+                    return
+                try:
+                    indexer._sync()
+                except Exception:
+                    # retried at the next interval
+                    logging.getLogger("indexer").exception("Applying the change log failed")
+                del indexer
+
+        thread = threading.Thread(target=synchronization)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _read_version(self, cursor):
+        """
+        Returns the (epoch, generation) of the database cursor reads from, e.g. a lagging replica, which
+        the results it reads next reflect at least. Read before them so _cache_put() can check it.
+        """
+        if self._cache is None:
+            return None
+        cursor.execute('''SELECT epoch, generation FROM index._statistics''')
+        return cursor.fetchone()
+
+    def _cache_put(self, key, dependencies, value, version):
+        # a result missing a change whose invalidation was applied already would stay stale
+        with self._lock:
+            if version is not None and version[0] == self._epoch and version[1] >= self._generation:
+                self._cache.put(key, dependencies, value)
+
+    def _load_fields(self):
+        with self._connection() as cursor:
+            try:
+                cursor.execute('''SELECT name FROM index._fields''')
+                return set(row[0] for row in cursor.fetchall())
+            except psycopg2.ProgrammingError:
+                return set()
+
+    @staticmethod
+    def _field_name(field):
+        return field.encode("utf8") if isinstance(field, unicode) else field
+
+    def _field_value(self, field, value):
+        if not isinstance(value, basestring):
+            value = json.dumps(value)
+        return field + "=" + self._tokenizer.normalize(value)
+
+    def _field_terms(self, fields):
+        """
+        Returns the field:token and field=value terms of the declared fields of a document.
+        """
+        terms = set()
+        if not self._fields or not isinstance(fields, dict):
+            return terms
+        for field, value in fields.iteritems():
+            field = self._field_name(field)
+            if field not in self._fields or value is None:
+                continue
+            for item in value if isinstance(value, list) else [value]:
+                if item is None:
+                    continue
+                term = self._field_value(field, item)
+                if term != field + "=":
+                    terms.add(term)
+                terms.update(field + ":" + token for token in self._tokenizer.tokens(term[len(field) + 1:]))
+        return terms
+
+    def _publish(self, cursor, changes, field_terms=()):
+        """
+        Records in index._changes, in the transaction of a write, how the document frequency of its terms
+        changed and which field terms it touched, under the next generation of the index.
+        """
+        if not changes and not field_terms:
+            return
+        cursor.execute(
+            sql.SQL(
+                '''WITH statistics AS (UPDATE index._statistics SET generation = generation + 1 RETURNING generation),
+                    trimmed AS (DELETE FROM index._changes
+                      WHERE generation <= (SELECT generation FROM statistics) - {size})
+                    INSERT INTO index._changes (generation, terms, deltas, field_terms, timestamp)
+                    SELECT generation, {terms}::TEXT[], {deltas}::INT[], {field_terms}::TEXT[], {timestamp}
+                    FROM statistics'''
+            ).format(
+                size=sql.Literal(CHANGE_LOG_SIZE),
+                terms=sql.Literal(changes.keys()),
+                deltas=sql.Literal(changes.values()),
+                field_terms=sql.Literal(list(field_terms)),
+                timestamp=sql.Literal(int(time.time()))
+            )
+        )
+
+    def _invalidate(self, terms, field_terms=()):
+        if self._cache is None:
+            return
+        dependencies = [dependency for term in terms for dependency in self._cache_dependencies(term)]
+        if field_terms:
+            dependencies += list(field_terms) + [("field", field) for field in
+                                                 set(re.split(r'[:=]', term, 1)[0] for term in field_terms)]
+        self._cache.invalidate(dependencies)
 
     def _tokenize(self, data):
-        try:
-            data = data.decode("utf8")
-        except UnicodeEncodeError:
-            pass
-        if self._diacritics_sensitive is False:
-            data = self._flatten_diacritics(unicode(data))
-        data = re.findall('([a-zA-Z0-9\-\'\"]*)', data)
-        data = list(set(data))
-        for i in range(len(data)):
-            data[i] = data[i].lower().strip(self._symbols)
-        data = list(set(data))
-        data.remove("")
-        try:
-            data.remove("u")
-        except ValueError:
-            pass
-        return data
+        return [term for term, frequency, positions in self._tokenizer.terms(data)]
+
+    def _term_frequencies(self, data):
+        return dict((term, frequency) for term, frequency, positions in self._tokenizer.terms(data))
 
-    def _full_text_index(self, data, fields):
+    def _analysis_options(self):
+        return {
+            "diacritics_sensitive": self._diacritics_sensitive,
+            "symbols": self._symbols,
+            "deepindexing": self._deepindexing,
+            "gram_size": self._gram_size,
+            "positional": self._positional,
+        }
+
+    def _full_text_index(self, cursor, data, fields):
         try:
-            self._cursor.execute(
+            cursor.execute(
                 sql.SQL(
                     '''INSERT INTO data.original(data, fields, timestamp) 
                         VALUES({data}, {fields}, {timestamp}) RETURNING id''').format(
@@ -107,69 +510,557 @@ class Indexer:
                     timestamp=sql.Literal(time.time())
                 )
             )
-            original_content_id = self._cursor.fetchone()[0]
-            self._database.commit()
-            return self._index_data(data, original_content_id)
+            original_content_id = cursor.fetchone()[0]
+            cursor.connection.commit()
+            self._index_data(cursor, data, original_content_id)
+            self._index_fields(cursor, fields, original_content_id)
         except psycopg2.ProgrammingError:
             raise Exception(
                 "There is not index created! Please call create_index() function from indexer before indexing.")
 
-    def _index_term_in_node_with_id(self, term, node, original_content_id):
-        self._cursor.execute(
+    def _index_term_in_node_with_id(self, cursor, term, node, original_content_id, frequency=None):
+        if frequency is None:
+            cursor.execute(
+                sql.SQL(
+                    '''INSERT INTO index.{table_name} (term, inverted_index) VALUES({term}, {id_array})
+                        ON CONFLICT(term) DO UPDATE SET 
+                        inverted_index = array_append(index.{table_name}.inverted_index, {id})
+                        RETURNING id'''
+                ).format(
+                    table_name=sql.Identifier(node),
+                    term=sql.Literal(term),
+                    id_array=sql.Literal("{" + str(original_content_id) + "}"),
+                    id=sql.Literal(str(original_content_id)),
+                )
+            )
+        elif self._block_size:
+            cursor.execute(
+                sql.SQL(
+                    '''INSERT INTO index.{table_name} (term, document_frequency, max_frequency)
+                        VALUES({term}, 1, {frequency})
+                        ON CONFLICT(term) DO UPDATE SET 
+                        document_frequency = index.{table_name}.document_frequency + 1,
+                        max_frequency = GREATEST(index.{table_name}.max_frequency, {frequency})
+                        RETURNING id'''
+                ).format(
+                    table_name=sql.Identifier(node),
+                    term=sql.Literal(term),
+                    frequency=sql.Literal(frequency),
+                )
+            )
+        else:
+            cursor.execute(
+                sql.SQL(
+                    '''INSERT INTO index.{table_name} (term, inverted_index, frequencies, max_frequency)
+                        VALUES({term}, {id_array}, {frequency_array}, {frequency})
+                        ON CONFLICT(term) DO UPDATE SET 
+                        inverted_index = array_append(index.{table_name}.inverted_index, {id}),
+                        frequencies = array_append(index.{table_name}.frequencies, {frequency}),
+                        max_frequency = GREATEST(index.{table_name}.max_frequency, {frequency})
+                        RETURNING id'''
+                ).format(
+                    table_name=sql.Identifier(node),
+                    term=sql.Literal(term),
+                    id_array=sql.Literal("{" + str(original_content_id) + "}"),
+                    id=sql.Literal(str(original_content_id)),
+                    frequency_array=sql.Literal("{" + str(frequency) + "}"),
+                    frequency=sql.Literal(frequency),
+                )
+            )
+        inserted_id = cursor.fetchone()[0]
+        if frequency is not None and self._block_size:
+            self._add_to_blocks(cursor, term, original_content_id, frequency)
+        cursor.connection.commit()
+        return inserted_id
+
+    def _write_block(self, cursor, term, block, ids, frequencies):
+        cursor.execute(
             sql.SQL(
-                '''INSERT INTO index.{table_name} (term, inverted_index) VALUES({term}, {id_array})
-                    ON CONFLICT(term) DO UPDATE SET 
-                    inverted_index = array_append(index.{table_name}.inverted_index, {id})
-                    RETURNING id'''
+                '''INSERT INTO index._general_blocks (term, block, first_id, last_id, count, postings)
+                    VALUES({term}, {block}, {first_id}, {last_id}, {count}, {postings})
+                    ON CONFLICT(term, block) DO UPDATE SET
+                    first_id = EXCLUDED.first_id, last_id = EXCLUDED.last_id,
+                    count = EXCLUDED.count, postings = EXCLUDED.postings'''
             ).format(
-                table_name=sql.Identifier(node),
                 term=sql.Literal(term),
-                id_array=sql.Literal("{" + str(original_content_id) + "}"),
-                id=sql.Literal(str(original_content_id)),
+                block=sql.Literal(block),
+                first_id=sql.Literal(ids[0]),
+                last_id=sql.Literal(ids[-1]),
+                count=sql.Literal(len(ids)),
+                postings=sql.Literal(psycopg2.Binary(str(encode_block(ids, frequencies))))
             )
         )
-        inserted_id = self._cursor.fetchone()[0]
-        self._database.commit()
-        return inserted_id
 
-    def _get_id_of_term_from_node(self, term, node):
-        self._cursor.execute(
+    def _add_to_blocks(self, cursor, term, posting, frequency):
+        # the block holding posting is the last one starting at or before it, or else the first one
+        cursor.execute(
+            sql.SQL(
+                '''SELECT block, last_id, count, postings,
+                    block = (SELECT max(block) FROM index._general_blocks WHERE term = {term})
+                    FROM index._general_blocks WHERE term = {term}
+                    ORDER BY CASE WHEN first_id <= {id} THEN block ELSE -block END DESC
+                    LIMIT 1 FOR UPDATE'''
+            ).format(
+                term=sql.Literal(term),
+                id=sql.Literal(posting)
+            )
+        )
+        row = cursor.fetchone()
+        if row is None:
+            self._write_block(cursor, term, 0, [posting], [frequency])
+            return
+        block, last_id, count, postings, last = row
+        if last and posting > last_id:
+            if count >= self._block_size:
+                self._write_block(cursor, term, block + 1, [posting], [frequency])
+                return
+            cursor.execute(
+                sql.SQL(
+                    '''UPDATE index._general_blocks
+                        SET postings = postings || {postings}, last_id = {id}, count = count + 1
+                        WHERE term = {term} AND block = {block}'''
+                ).format(
+                    postings=sql.Literal(psycopg2.Binary(str(encode_block([posting], [frequency], last_id)))),
+                    id=sql.Literal(posting),
+                    term=sql.Literal(term),
+                    block=sql.Literal(block)
+                )
+            )
+            return
+        # an id older than the end of the term, e.g. from a concurrent batch: its block is rewritten
+        ids, frequencies = decode_block(postings)
+        position = bisect_left(ids, posting)
+        if position < len(ids) and ids[position] == posting:
+            return
+        ids.insert(position, posting)
+        frequencies.insert(position, frequency)
+        self._write_block(cursor, term, block, ids, frequencies)
+
+    def _merge_blocks(self, cursor, postings, frequencies):
+        """
+        Bulk version of _add_to_blocks: rewrites the last block of every term together with the new
+        blocks it needs in a single statement.
+        """
+        cursor.execute(
+            sql.SQL(
+                '''SELECT DISTINCT ON (term) term, block, last_id, count, postings FROM index._general_blocks
+                    WHERE term = ANY({terms}) ORDER BY term, block DESC'''
+            ).format(
+                terms=sql.Literal(postings.keys())
+            )
+        )
+        last_blocks = dict((row[0], row[1:]) for row in cursor.fetchall())
+        rows = []
+        late = []
+        for term, ids in postings.iteritems():
+            pairs = sorted(zip(ids, frequencies[term]))
+            block = 0
+            block_ids = []
+            block_frequencies = []
+            if term in last_blocks:
+                block, last_id, count, data = last_blocks[term]
+                late += [(term, posting, frequency) for posting, frequency in pairs if posting <= last_id]
+                pairs = [(posting, frequency) for posting, frequency in pairs if posting > last_id]
+                if not pairs:
+                    continue
+                if count < self._block_size:
+                    block_ids, block_frequencies = decode_block(data)
+                else:
+                    block += 1
+            for posting, frequency in pairs:
+                block_ids.append(posting)
+                block_frequencies.append(frequency)
+            for start in range(0, len(block_ids), self._block_size):
+                chunk_ids = block_ids[start:start + self._block_size]
+                chunk_frequencies = block_frequencies[start:start + self._block_size]
+                rows.append((term, block, chunk_ids[0], chunk_ids[-1], len(chunk_ids),
+                             encode_block(chunk_ids, chunk_frequencies)))
+                block += 1
+        if rows:
+            cursor.execute(
+                '''CREATE TEMPORARY TABLE IF NOT EXISTS _staging_blocks (
+                    term TEXT, block INT, first_id INT, last_id INT, count INT, postings BYTEA) ON COMMIT DROP''')
+            self._copy_rows(cursor, sql.SQL('_staging_blocks'),
+                            ('term', 'block', 'first_id', 'last_id', 'count', 'postings'), rows)
+            cursor.execute(
+                '''INSERT INTO index._general_blocks (term, block, first_id, last_id, count, postings)
+                    SELECT term, block, first_id, last_id, count, postings FROM _staging_blocks
+                    ON CONFLICT(term, block) DO UPDATE SET
+                    first_id = EXCLUDED.first_id, last_id = EXCLUDED.last_id,
+                    count = EXCLUDED.count, postings = EXCLUDED.postings''')
+            cursor.execute('''TRUNCATE _staging_blocks''')
+        for term, posting, frequency in late:
+            self._add_to_blocks(cursor, term, posting, frequency)
+
+    def _get_id_of_term_from_node(self, cursor, term, node):
+        cursor.execute(
             sql.SQL('''SELECT id FROM index.{table_name} WHERE term = {term}''').format(
                 table_name=sql.Identifier(node),
                 term=sql.Literal(term)
             )
         )
-        return self._cursor.fetchone()
+        return cursor.fetchone()
+
+    def _ngrams(self, term):
+        return ngrams(term, self._gram_size)
 
-    def _index_data(self, data, original_content_id):
+    def _update_statistics(self, cursor, documents, length):
+        cursor.execute(
+            sql.SQL(
+                '''UPDATE index._statistics SET documents = documents + {documents}, length = length + {length}'''
+            ).format(
+                documents=sql.Literal(documents),
+                length=sql.Literal(length)
+            )
+        )
+
+    def _cache_dependencies(self, term):
+        dependencies = [term]
+        if self._deepindexing:
+            dependencies += [("substring", term[j:i]) for j in range(len(term)) for i in range(j + 1, len(term) + 1)]
+        else:
+            dependencies += [("prefix", term[:i]) for i in range(len(term) + 1)]
+        return dependencies
+
+    def _write_positions(self, cursor, original_content_id, terms):
+        cursor.execute(
+            sql.SQL('''INSERT INTO index._positions (term, id, positions) VALUES {rows}''').format(
+                rows=sql.SQL(', ').join(
+                    sql.SQL('({term}, {id}, {positions})').format(
+                        term=sql.Literal(term),
+                        id=sql.Literal(original_content_id),
+                        positions=sql.Literal(positions)
+                    ) for term, frequency, positions in terms
+                )
+            )
+        )
+
+    def _index_data(self, cursor, data, original_content_id):
         counter = 0
-        tokenized_data = self._tokenize(data)
-        for term in tokenized_data:
+        with self._stage("tokenize"):
+            terms = list(self._tokenizer.terms(data, positions=self._positional))
+        frequencies = dict((term, frequency) for term, frequency, positions in terms)
+        length = sum(frequencies.itervalues())
+        cursor.execute(
+            sql.SQL('''UPDATE data.original SET length = {length} WHERE id = {id}''').format(
+                length=sql.Literal(length),
+                id=sql.Literal(original_content_id)
+            )
+        )
+        self._update_statistics(cursor, 1, length)
+        if self._positional and terms:
+            self._write_positions(cursor, original_content_id, terms)
+        cursor.connection.commit()
+        for term, frequency in frequencies.iteritems():
             counter += 1
-            term_already_exists = self._get_id_of_term_from_node(term, "_general_index")
-            general_index_id = self._index_term_in_node_with_id(term, "_general_index", original_content_id)
+            term_already_exists = self._get_id_of_term_from_node(cursor, term, "_general_index")
+            general_index_id = self._index_term_in_node_with_id(cursor, term, "_general_index", original_content_id,
+                                                                frequency)
             ngram_flag = not term_already_exists and self._deepindexing
             if ngram_flag:
-                ngrams = []
-                for i in range(1, len(term)):
-                    for j in range(len(term) - i + 1):
-                        ngram = term[j:j + i]
-                        ngrams.append(ngram)
-                ngrams.append(term)
-                ngrams = list(set(ngrams))
-                for ngram in ngrams:
-                    self._index_term_in_node_with_id(ngram, "_ngram_index", general_index_id)
+                for ngram in self._ngrams(term):
+                    self._index_term_in_node_with_id(cursor, ngram, "_ngram_index", general_index_id)
+        self._publish(cursor, dict((term, 1) for term in frequencies))
+        cursor.connection.commit()
         return counter
 
+    def _index_fields(self, cursor, fields, original_content_id):
+        terms = self._field_terms(fields)
+        for term in terms:
+            self._index_term_in_node_with_id(cursor, term, "_field_index", original_content_id)
+        self._publish(cursor, {}, terms)
+        cursor.connection.commit()
+
+    @staticmethod
+    def _copy_value(value):
+        if value is None:
+            return '\\N'
+        if isinstance(value, bytearray):
+            return '\\\\x' + hexlify(value)
+        if isinstance(value, list):
+            return '{' + ','.join(str(item) for item in value) + '}'
+        if isinstance(value, unicode):
+            value = value.encode("utf8")
+        else:
+            value = str(value)
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def _copy_rows(self, cursor, table, columns, rows):
+        buffer = StringIO()
+        for row in rows:
+            buffer.write('\t'.join(self._copy_value(value) for value in row) + '\n')
+        buffer.seek(0)
+        cursor.copy_expert(
+            sql.SQL('''COPY {table_name} ({columns}) FROM STDIN''').format(
+                table_name=table,
+                columns=sql.SQL(', ').join(sql.Identifier(column) for column in columns)
+            ),
+            buffer
+        )
+
+    def _merge_postings(self, cursor, node, postings, frequencies=None):
+        """
+        Bulk version of _index_term_in_node_with_id: stages every (term, id) pair with COPY and merges
+        them into the node with a single statement. Returns {term: id} for the terms that were new.
+        frequencies, when given, holds the term frequency lists parallel to postings.
+        """
+        cursor.execute(
+            '''CREATE TEMPORARY TABLE IF NOT EXISTS _staging_postings (term TEXT, posting INT, frequency INT)
+                ON COMMIT DROP''')
+        if frequencies is None:
+            self._copy_rows(cursor, sql.SQL('_staging_postings'), ('term', 'posting'),
+                            ((term, posting) for term, ids in postings.iteritems() for posting in ids))
+            cursor.execute(
+                sql.SQL(
+                    '''INSERT INTO index.{table_name} AS target (term, inverted_index)
+                        SELECT term, array_agg(posting ORDER BY posting) FROM _staging_postings GROUP BY term
+                        ON CONFLICT(term) DO UPDATE SET
+                        inverted_index = target.inverted_index || EXCLUDED.inverted_index
+                        RETURNING id, term, xmax = 0'''
+                ).format(
+                    table_name=sql.Identifier(node)
+                )
+            )
+        elif self._block_size:
+            self._copy_rows(cursor, sql.SQL('_staging_postings'), ('term', 'frequency'),
+                            ((term, frequency) for term, term_frequencies in frequencies.iteritems()
+                             for frequency in term_frequencies))
+            cursor.execute(
+                sql.SQL(
+                    '''INSERT INTO index.{table_name} AS target (term, document_frequency, max_frequency)
+                        SELECT term, count(*), max(frequency) FROM _staging_postings GROUP BY term
+                        ON CONFLICT(term) DO UPDATE SET
+                        document_frequency = target.document_frequency + EXCLUDED.document_frequency,
+                        max_frequency = GREATEST(target.max_frequency, EXCLUDED.max_frequency)
+                        RETURNING id, term, xmax = 0'''
+                ).format(
+                    table_name=sql.Identifier(node)
+                )
+            )
+        else:
+            self._copy_rows(cursor, sql.SQL('_staging_postings'), ('term', 'posting', 'frequency'),
+                            ((term, posting, frequency) for term, ids in postings.iteritems()
+                             for posting, frequency in zip(ids, frequencies[term])))
+            cursor.execute(
+                sql.SQL(
+                    '''INSERT INTO index.{table_name} AS target (term, inverted_index, frequencies, max_frequency)
+                        SELECT term, array_agg(posting ORDER BY posting), array_agg(frequency ORDER BY posting),
+                        max(frequency) FROM _staging_postings GROUP BY term
+                        ON CONFLICT(term) DO UPDATE SET
+                        inverted_index = target.inverted_index || EXCLUDED.inverted_index,
+                        frequencies = target.frequencies || EXCLUDED.frequencies,
+                        max_frequency = GREATEST(target.max_frequency, EXCLUDED.max_frequency)
+                        RETURNING id, term, xmax = 0'''
+                ).format(
+                    table_name=sql.Identifier(node)
+                )
+            )
+        new_terms = dict((term, inserted_id) for inserted_id, term, inserted in cursor.fetchall() if inserted)
+        cursor.execute('''TRUNCATE _staging_postings''')
+        if frequencies is not None and self._block_size:
+            self._merge_blocks(cursor, postings, frequencies)
+        return new_terms
+
+    def _batch_analysis_options(self):
+        # inline, n-grams are generated by _write_batch for the terms that turn out to be new only
+        options = self._analysis_options()
+        options["deepindexing"] = False
+        return options
+
+    def _index_batch(self, cursor, batch, checkpoint=None):
+        with self._stage("tokenize"):
+            analysis = analyze_batch(batch, **self._batch_analysis_options())
+        return self._write_batch(cursor, batch, analysis, checkpoint)
+
+    def _write_batch(self, cursor, batch, analysis, checkpoint=None):
+        """
+        Writes a batch analyzed by analyze_batch in a single transaction and returns its number of
+        documents. Only the n-grams of the terms that turn out to be new are written, taken from the
+        analysis when it carries them, as from the workers of index_pipelined, and else generated here.
+        A (source, position, fingerprint) checkpoint is saved in the same transaction.
+        """
+        try:
+            cursor.execute(
+                sql.SQL('''SELECT nextval('data.original_id_seq') FROM generate_series(1, {count})''').format(
+                    count=sql.Literal(len(batch))
+                )
+            )
+        except psycopg2.ProgrammingError:
+            cursor.connection.rollback()
+            raise Exception(
+                "There is not index created! Please call create_index() function from indexer before indexing.")
+        ids = [row[0] for row in cursor.fetchall()]
+        timestamp = int(time.time())
+        positions, frequencies, lengths, grams, term_positions = analysis
+        postings = dict((term, [ids[position] for position in batch_positions])
+                        for term, batch_positions in positions.iteritems())
+        self._copy_rows(cursor, sql.SQL('data.original'), ('id', 'data', 'fields', 'timestamp', 'length'),
+                        ((original_content_id, data, json.dumps(fields), timestamp, length)
+                         for original_content_id, (data, fields), length in zip(ids, batch, lengths)))
+        self._update_statistics(cursor, len(batch), sum(lengths))
+        if term_positions is not None:
+            self._copy_rows(cursor, sql.SQL('index._positions'), ('term', 'id', 'positions'),
+                            ((term, original_content_id, document_positions)
+                             for term, term_postings in postings.iteritems()
+                             for original_content_id, document_positions in zip(term_postings, term_positions[term])))
+        new_terms = self._merge_postings(cursor, "_general_index", postings, frequencies)
+        if self._deepindexing and new_terms:
+            ngram_postings = {}
+            for term, general_index_id in new_terms.iteritems():
+                for ngram in grams[term] if grams is not None else self._ngrams(term):
+                    ngram_postings.setdefault(ngram, []).append(general_index_id)
+            self._merge_postings(cursor, "_ngram_index", ngram_postings)
+        field_postings = {}
+        for original_content_id, (data, fields) in zip(ids, batch):
+            for term in self._field_terms(fields):
+                field_postings.setdefault(term, []).append(original_content_id)
+        if field_postings:
+            self._merge_postings(cursor, "_field_index", field_postings)
+        if checkpoint is not None:
+            self._save_checkpoint(cursor, checkpoint, len(batch))
+        self._publish(cursor, dict((term, len(term_postings)) for term, term_postings in postings.iteritems()),
+                      field_postings.keys())
+        cursor.connection.commit()
+        return len(batch)
+
     def index(self, data, fields=None):
-        start = time.time()
+        """
+        Indexes one document. Returns the number of documents indexed, like index_many().
+        """
         if isinstance(data, basestring):
             data = data.strip()
         else:
             return 0
-        counter = self._full_text_index(data, fields)
-        stop = time.time()
-        print "TOOK " + str(stop - start) + " SECONDS!"
+        with self._operation("index"), self._connection() as cursor:
+            self._full_text_index(cursor, data, fields)
+        return 1
+
+    def index_many(self, iterable, batch_size=1000):
+        """
+        Indexes an iterable of documents (strings or (data, fields) tuples), committing once per
+        batch_size documents instead of once per term. Returns the number of documents indexed.
+        """
+        counter = 0
+        batch = []
+        for item in iterable:
+            if isinstance(item, basestring):
+                data, fields = item, None
+            else:
+                data, fields = item
+            if not isinstance(data, basestring):
+                continue
+            batch.append((data.strip(), fields))
+            if len(batch) >= batch_size:
+                with self._operation("index_batch", documents=len(batch)), self._connection() as cursor:
+                    counter += self._index_batch(cursor, batch)
+                batch = []
+        if batch:
+            with self._operation("index_batch", documents=len(batch)), self._connection() as cursor:
+                counter += self._index_batch(cursor, batch)
+        return counter
+
+    def _checkpoint(self, cursor, source):
+        """
+        Returns the (position, fingerprint) of the checkpoint of source, or (0, None).
+        """
+        cursor.execute(
+            sql.SQL('''SELECT position, fingerprint FROM data.checkpoints WHERE source = {source}''').format(
+                source=sql.Literal(source)
+            )
+        )
+        row = cursor.fetchone()
+        return row if row is not None else (0, None)
+
+    def _save_checkpoint(self, cursor, checkpoint, documents):
+        source, position, fingerprint = checkpoint
+        cursor.execute(
+            sql.SQL(
+                '''INSERT INTO data.checkpoints (source, position, documents, timestamp, fingerprint)
+                    VALUES ({source}, {position}, {documents}, {timestamp}, {fingerprint})
+                    ON CONFLICT(source) DO UPDATE SET position = EXCLUDED.position,
+                    documents = checkpoints.documents + EXCLUDED.documents, timestamp = EXCLUDED.timestamp,
+                    fingerprint = EXCLUDED.fingerprint''').format(
+                source=sql.Literal(source),
+                position=sql.Literal(position),
+                documents=sql.Literal(documents),
+                timestamp=sql.Literal(int(time.time())),
+                fingerprint=sql.Literal(fingerprint)
+            )
+        )
+
+    def _index_source_batch(self, batch, checkpoint):
+        with self._operation("index_batch", documents=len(batch)), self._connection() as cursor:
+            if batch:
+                return self._index_batch(cursor, batch, checkpoint)
+            self._save_checkpoint(cursor, checkpoint, 0)
+            cursor.connection.commit()
+            return 0
+
+    def index_file(self, path, format=None, batch_size=1000, text=None, restart=False):
+        """
+        Streams the documents of path into the index: the lines of a text file, the records of a JSONL
+        file (one per line) or the records of a JSON array, format ("text", "jsonl" or "json") following
+        the extension by default. Only one batch and one chunk of the file are held in memory.
+
+        Every batch_size documents are committed together with the offset the file was read up to, in
+        data.checkpoints, so calling index_file() again after an interruption resumes right after the
+        last committed batch; restart=True reads the file from the start. The checkpoint also keeps a
+        fingerprint of the file read so far, and a file changed other than by appending to it is not
+        resumed. A JSON record becomes a
+        document with the record as its fields and its text key, or all its string values, as data.
+        Returns the number of documents indexed by this call.
+        """
+        source = os.path.abspath(path)
+        with self._connection() as cursor:
+            try:
+                self._create_checkpoints(cursor)
+            except psycopg2.ProgrammingError:
+                cursor.connection.rollback()
+                raise Exception(
+                    "There is not index created! Please call create_index() function from indexer before indexing.")
+            cursor.connection.commit()
+            offset, saved_fingerprint = (0, None) if restart else self._checkpoint(cursor, source)
+        if offset > os.path.getsize(path):
+            raise Exception("{0} is shorter than its checkpoint, index it with restart=True!".format(path))
+        counter = 0
+        batch = []
+        position = saved = offset
+        with open(path, "rb") as f, open(path, "rb") as head:
+            if saved_fingerprint is not None and fingerprint(head, offset) != saved_fingerprint:
+                raise Exception("{0} changed since its checkpoint, index it with restart=True!".format(path))
+            for item, position in read(f, format or file_format(path), offset):
+                data, fields = record_document(item, text)
+                if isinstance(data, basestring) and data.strip():
+                    batch.append((data.strip(), fields))
+                if len(batch) >= batch_size:
+                    self._index_source_batch(batch, (source, position, fingerprint(head, position)))
+                    counter += len(batch)
+                    batch = []
+                    saved = position
+            if batch or position > saved:
+                self._index_source_batch(batch, (source, position, fingerprint(head, position)))
+                counter += len(batch)
+        return counter
+
+    def _write_analyzed_batch(self, batch, analysis):
+        with self._operation("index_batch", documents=len(batch)), self._connection() as cursor:
+            return self._write_batch(cursor, batch, analysis)
+
+    def index_pipelined(self, iterable, workers=None, batch_size=1000, queue_size=4, report=None):
+        """
+        Like index_many, but tokenization and, with deepindexing, n-gram generation run in a pool of
+        worker processes while a writer thread keeps the database busy, writing the grams of the new
+        terms only. The throughput of every stage is annotated on the index_pipelined operation and,
+        when report is a dict, also written to it.
+        """
+        with self._operation("index_pipelined") as operation:
+            pipeline = IngestPipeline(self._write_analyzed_batch, self._analysis_options(), workers,
+                                      batch_size, queue_size)
+            counter = pipeline.run(iterable)
+            stages = pipeline.report()
+            if report is not None:
+                report.update(stages)
+            operation.annotate(documents=counter, stages=stages)
         return counter
 
     def index_web_page(self, url):
@@ -179,34 +1070,375 @@ class Indexer:
         result = h.handle(content.decode("utf8"))
         self.index(result, {"url": url})
 
-    def remove_content_from_index(self, original_id):
-        self._cursor.execute(
+    def remove_content_from_index(self, original_id, deferred=False):
+        """
+        With deferred=True the document only gets a tombstone, which search and suggest filter out,
+        and its postings are purged later by compact(). Returns True, or False when there is no such document
+        (deferred, also when it already has a tombstone).
+        """
+        with self._operation("remove", deferred=deferred), self._connection() as cursor:
+            if deferred:
+                return self._tombstone(cursor, original_id)
+            return self._remove_content_from_index(cursor, original_id)
+
+    def _tombstone(self, cursor, original_id):
+        cursor.execute(
+            sql.SQL(
+                '''WITH tombstone AS (
+                        INSERT INTO data.tombstones (id, timestamp)
+                        SELECT id, {timestamp} FROM data.original WHERE id = {id}
+                        ON CONFLICT(id) DO NOTHING
+                        RETURNING id)
+                    SELECT data, fields FROM data.original WHERE id IN (SELECT id FROM tombstone)'''
+            ).format(
+                id=sql.Literal(original_id),
+                timestamp=sql.Literal(int(time.time()))
+            )
+        )
+        content = cursor.fetchone()
+        if not content:
+            cursor.connection.commit()
+            return False
+        terms = set(self._tokenize(content[0]))
+        field_terms = self._field_terms(content[1])
+        cursor.execute(
+            sql.SQL('''UPDATE index._general_index SET tombstoned = tombstoned + 1 WHERE term = ANY({terms})''').format(
+                terms=sql.Literal(list(terms))
+            )
+        )
+        self._publish(cursor, dict((term, -1) for term in terms), field_terms)
+        cursor.connection.commit()
+        return True
+
+    def _untombstone(self, cursor, original_id, terms):
+        """
+        Drops the tombstone of a document removed right away, if it has one. Returns whether it had.
+        """
+        cursor.execute(
+            sql.SQL('''DELETE FROM data.tombstones WHERE id = {id} RETURNING id''').format(id=sql.Literal(original_id))
+        )
+        if cursor.fetchone() is None:
+            return False
+        cursor.execute(
+            sql.SQL('''UPDATE index._general_index SET tombstoned = tombstoned - 1 WHERE term = ANY({terms})''').format(
+                terms=sql.Literal(list(terms))
+            )
+        )
+        return True
+
+    def _live(self, cursor, ids):
+        """
+        Leaves the tombstoned documents out of ids, looking only ids up in data.tombstones.
+        """
+        if not ids:
+            return ids
+        cursor.execute(
+            sql.SQL('''SELECT id FROM data.tombstones WHERE id = ANY({ids})''').format(ids=sql.Literal(ids))
+        )
+        tombstoned = set(row[0] for row in cursor.fetchall())
+        return [doc for doc in ids if doc not in tombstoned] if tombstoned else ids
+
+    def _execute_live(self, cursor, plan, limit=None, after=None):
+        """
+        execute() without the tombstoned documents: the plan is run limit documents at a time until
+        limit live ones are found, so only the documents returned are looked up.
+        """
+        results = self._live(cursor, execute(plan, limit, after))
+        while limit and len(results) < limit and plan.doc is not None:
+            results += self._live(cursor, execute(plan, limit - len(results)))
+        return results
+
+    def compact(self, batch_size=1000):
+        """
+        Purges up to batch_size tombstoned documents from the posting lists and the stored data in a
+        single transaction. Returns the number of purged documents.
+        """
+        with self._operation("compact"), self._connection() as cursor:
+            # concurrent compactions purge disjoint batches
+            cursor.execute(
+                sql.SQL('''SELECT id FROM data.tombstones ORDER BY id LIMIT {limit} FOR UPDATE SKIP LOCKED''').format(
+                    limit=sql.Literal(batch_size)
+                )
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                return 0
+            cursor.execute(
+                sql.SQL('''SELECT data, length FROM data.original WHERE id = ANY({ids})''').format(
+                    ids=sql.Literal(ids)
+                )
+            )
+            terms = Counter()
+            length = 0
+            documents = cursor.fetchall()
+            for data, document_length in documents:
+                terms.update(set(self._tokenize(data)))
+                length += document_length or 0
+            self._update_statistics(cursor, -len(documents), -length)
+            if terms:
+                cursor.execute(
+                    sql.SQL(
+                        '''UPDATE index._general_index AS target SET tombstoned = target.tombstoned - purged.count
+                            FROM UNNEST({terms}, {counts}) AS purged(term, count) WHERE target.term = purged.term'''
+                    ).format(
+                        terms=sql.Literal(terms.keys()),
+                        counts=sql.Literal(terms.values())
+                    )
+                )
+            if self._block_size:
+                emptied = self._purge_blocks(cursor, ids, terms)
+            else:
+                # the terms of the purged documents lead to their posting rows through the term index
+                cursor.execute(
+                    sql.SQL(
+                        '''DELETE FROM index._general_index WHERE term = ANY({terms}) AND inverted_index <@ {ids}::INT[]
+                            RETURNING id, term'''
+                    ).format(
+                        terms=sql.Literal(terms.keys()),
+                        ids=sql.Literal(ids)
+                    )
+                )
+                emptied = cursor.fetchall()
+                cursor.execute(
+                    sql.SQL('''
+                        UPDATE index._general_index
+                        SET frequencies = ARRAY(
+                            SELECT frequency FROM UNNEST(inverted_index, frequencies) WITH ORDINALITY
+                            AS posting(id, frequency, position) WHERE posting.id <> ALL({ids}::INT[])
+                            ORDER BY position),
+                        inverted_index = ARRAY(
+                            SELECT id FROM UNNEST(inverted_index) WITH ORDINALITY
+                            AS posting(id, position) WHERE posting.id <> ALL({ids}::INT[])
+                            ORDER BY position)
+                        WHERE term = ANY({terms}) AND inverted_index && {ids}::INT[]
+                    ''').format(
+                        terms=sql.Literal(terms.keys()),
+                        ids=sql.Literal(ids)
+                    )
+                )
+            if self._deepindexing and emptied:
+                self._purge_ngrams(cursor, emptied)
+            field_terms = self._purge_fields(cursor, ids)
+            cursor.execute(
+                sql.SQL('''DELETE FROM index._positions WHERE id = ANY({ids})''').format(ids=sql.Literal(ids))
+            )
+            cursor.execute(
+                sql.SQL('''DELETE FROM data.original WHERE id = ANY({ids})''').format(ids=sql.Literal(ids))
+            )
+            cursor.execute(
+                sql.SQL('''DELETE FROM data.tombstones WHERE id = ANY({ids})''').format(ids=sql.Literal(ids))
+            )
+            self._publish(cursor, {}, field_terms)
+            cursor.connection.commit()
+        return len(ids)
+
+    def _purge_ngrams(self, cursor, emptied):
+        """
+        Removes the (id, term) rows deleted from the general index from the postings of the n-grams of
+        their terms.
+        """
+        general_index_ids = [row[0] for row in emptied]
+        grams = list(set(gram for general_index_id, term in emptied for gram in self._ngrams(term)))
+        cursor.execute(
+            sql.SQL(
+                '''DELETE FROM index._ngram_index WHERE term = ANY({grams}) AND inverted_index <@ {ids}::INT[]'''
+            ).format(
+                grams=sql.Literal(grams),
+                ids=sql.Literal(general_index_ids)
+            )
+        )
+        cursor.execute(
+            sql.SQL('''
+                UPDATE index._ngram_index
+                SET inverted_index = ARRAY(
+                    SELECT id FROM UNNEST(inverted_index) WITH ORDINALITY
+                    AS posting(id, position) WHERE posting.id <> ALL({ids}::INT[])
+                    ORDER BY position)
+                WHERE term = ANY({grams}) AND inverted_index && {ids}::INT[]
+            ''').format(
+                grams=sql.Literal(grams),
+                ids=sql.Literal(general_index_ids)
+            )
+        )
+
+    def _purge_fields(self, cursor, ids):
+        """
+        Removes the documents from the postings of their field terms, found from their stored fields,
+        and deletes the terms left without postings. Returns the field terms.
+        """
+        if not self._fields:
+            return []
+        cursor.execute(
+            sql.SQL('''SELECT fields FROM data.original WHERE id = ANY({ids})''').format(ids=sql.Literal(ids))
+        )
+        terms = set()
+        for row in cursor.fetchall():
+            terms.update(self._field_terms(row[0]))
+        if not terms:
+            return []
+        cursor.execute(
+            sql.SQL('''
+                UPDATE index._field_index
+                SET inverted_index = ARRAY(
+                    SELECT id FROM UNNEST(inverted_index) WITH ORDINALITY
+                    AS posting(id, position) WHERE posting.id <> ALL({ids}::INT[])
+                    ORDER BY position)
+                WHERE term = ANY({terms}) AND inverted_index && {ids}::INT[]
+            ''').format(
+                ids=sql.Literal(ids),
+                terms=sql.Literal(list(terms))
+            )
+        )
+        cursor.execute(
+            sql.SQL('''DELETE FROM index._field_index WHERE term = ANY({terms}) AND cardinality(inverted_index) = 0''').format(
+                terms=sql.Literal(list(terms))
+            )
+        )
+        return list(terms)
+
+    def _purge_blocks(self, cursor, ids, terms):
+        """
+        Removes the documents from the blocks of terms, the terms of their stored data, and deletes the
+        terms left without postings. Returns the (id, term) rows of the deleted terms.
+        """
+        if not terms:
+            return []
+        ids = sorted(ids)
+        removed_ids = set(ids)
+        cursor.execute(
+            sql.SQL(
+                '''SELECT term, block, first_id, last_id, postings FROM index._general_blocks
+                    WHERE term = ANY({terms}) AND first_id <= {last_id} AND last_id >= {first_id}
+                    FOR UPDATE'''
+            ).format(
+                terms=sql.Literal(list(terms)),
+                first_id=sql.Literal(ids[0]),
+                last_id=sql.Literal(ids[-1])
+            )
+        )
+        removed = {}
+        for term, block, first_id, last_id, postings in cursor.fetchall():
+            if bisect_left(ids, first_id) == bisect_right(ids, last_id):
+                continue
+            block_ids, block_frequencies = decode_block(postings)
+            kept = [(posting, frequency) for posting, frequency in zip(block_ids, block_frequencies)
+                    if posting not in removed_ids]
+            if len(kept) == len(block_ids):
+                continue
+            removed[term] = removed.get(term, 0) + len(block_ids) - len(kept)
+            if kept:
+                self._write_block(cursor, term, block, [posting for posting, frequency in kept],
+                                  [frequency for posting, frequency in kept])
+            else:
+                cursor.execute(
+                    sql.SQL('''DELETE FROM index._general_blocks WHERE term = {term} AND block = {block}''').format(
+                        term=sql.Literal(term),
+                        block=sql.Literal(block)
+                    )
+                )
+        if not removed:
+            return []
+        cursor.execute(
+            sql.SQL(
+                '''UPDATE index._general_index AS target
+                    SET document_frequency = target.document_frequency - removed.count
+                    FROM UNNEST({terms}, {counts}) AS removed(term, count) WHERE target.term = removed.term'''
+            ).format(
+                terms=sql.Literal(removed.keys()),
+                counts=sql.Literal(removed.values())
+            )
+        )
+        cursor.execute(
+            sql.SQL(
+                '''DELETE FROM index._general_index WHERE term = ANY({terms}) AND document_frequency <= 0
+                    RETURNING id, term'''
+            ).format(
+                terms=sql.Literal(removed.keys())
+            )
+        )
+        return cursor.fetchall()
+
+    def start_compaction(self, interval=60, batch_size=1000):
+        """
+        Runs compact() every interval seconds in a daemon thread, until no tombstones are left each time.
+        """
+        def compaction():
+            while True:
+                time.sleep(interval)
+                try:
+                    while self.compact(batch_size) == batch_size:
+                        pass
+                except psycopg2.Error:
+                    # retried at the next interval
+                    logging.getLogger("indexer").exception("Compaction failed")
+
+        thread = threading.Thread(target=compaction)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _remove_content_from_blocks(self, cursor, original_id):
+        cursor.execute(
+            sql.SQL('''SELECT data, length FROM data.original WHERE id = {id}''').format(id=sql.Literal(original_id))
+        )
+        content = cursor.fetchone()
+        if not content:
+            return False
+        terms = set(self._tokenize(content[0]))
+        tombstoned = self._untombstone(cursor, original_id, terms)
+        self._update_statistics(cursor, -1, -(content[1] or 0))
+        emptied = self._purge_blocks(cursor, [original_id], terms)
+        if self._deepindexing and emptied:
+            self._purge_ngrams(cursor, emptied)
+        field_terms = self._purge_fields(cursor, [original_id])
+        cursor.execute(
+            sql.SQL('''DELETE FROM index._positions WHERE id = {id}''').format(id=sql.Literal(original_id))
+        )
+        cursor.execute(
+            sql.SQL('''DELETE FROM data.original WHERE id = {id}''').format(id=sql.Literal(original_id))
+        )
+        # a tombstoned document was already taken out of the suggestions
+        self._publish(cursor, dict((term, 0 if tombstoned else -1) for term in terms), field_terms)
+        cursor.connection.commit()
+        return True
+
+    def _remove_content_from_index(self, cursor, original_id):
+        if self._block_size:
+            return self._remove_content_from_blocks(cursor, original_id)
+        cursor.execute(
             sql.SQL('''
             SELECT data FROM data.original WHERE id = {id}
         ''').format(id=sql.Literal(original_id))
         )
-        content = self._cursor.fetchone()
+        content = cursor.fetchone()
         if not content:
             return False
         content = content[0]
-        tokenized_data = self._tokenize(content)
-        for term in tokenized_data:
-            self._cursor.execute(
+        frequencies = self._term_frequencies(content)
+        tombstoned = self._untombstone(cursor, original_id, frequencies)
+        self._update_statistics(cursor, -1, -sum(frequencies.itervalues()))
+        changes = {}
+        for term in frequencies:
+            # max_frequency is left untouched: it stays a valid upper bound for ranking
+            cursor.execute(
                 sql.SQL('''
                     UPDATE index._general_index 
-                    SET inverted_index = ARRAY_REMOVE(inverted_index, {original_id}) 
-                    WHERE term = {term}
+                    SET frequencies = frequencies[:ARRAY_POSITION(inverted_index, {original_id}) - 1]
+                        || frequencies[ARRAY_POSITION(inverted_index, {original_id}) + 1:],
+                    inverted_index = ARRAY_REMOVE(inverted_index, {original_id}) 
+                    WHERE term = {term} AND {original_id} = ANY(inverted_index)
                     RETURNING id
                 ''').format(
                     original_id=sql.Literal(original_id),
                     term=sql.Literal(term)
                 )
             )
-            general_index_id = self._cursor.fetchone()
+            general_index_id = cursor.fetchone()
             if not general_index_id:
                 continue
             general_index_id = general_index_id[0]
-            self._cursor.execute(
+            changes[term] = 0 if tombstoned else -1
+            cursor.execute(
                 sql.SQL('''
                             DELETE FROM index._general_index
                             WHERE id = {general_index_id}
@@ -216,15 +1448,8 @@ class Indexer:
                 )
             )
             if self._deepindexing:
-                ngrams = []
-                for i in range(1, len(term)):
-                    for j in range(len(term) - i + 1):
-                        ngram = term[j:j + i]
-                        ngrams.append(ngram)
-                ngrams.append(term)
-                ngrams = list(set(ngrams))
-                for ngram in ngrams:
-                    self._cursor.execute(
+                for ngram in self._ngrams(term):
+                    cursor.execute(
                         sql.SQL('''
                             UPDATE index._ngram_index 
                             SET inverted_index = ARRAY_REMOVE(inverted_index, {general_index_id}) 
@@ -235,11 +1460,11 @@ class Indexer:
                             term=sql.Literal(ngram)
                         )
                     )
-                    ngram_index_id = self._cursor.fetchone()
+                    ngram_index_id = cursor.fetchone()
                     if not ngram_index_id:
                         continue
                     ngram_index_id = ngram_index_id[0]
-                    self._cursor.execute(
+                    cursor.execute(
                         sql.SQL('''
                                 DELETE FROM index._ngram_index
                                 WHERE id = {ngram_index_id}
@@ -248,115 +1473,863 @@ class Indexer:
                             ngram_index_id=sql.Literal(ngram_index_id),
                         )
                     )
-        self._cursor.execute(
+        field_terms = self._purge_fields(cursor, [original_id])
+        cursor.execute(
+            sql.SQL('''DELETE FROM index._positions WHERE id = {original_id}''').format(
+                original_id=sql.Literal(original_id)
+            )
+        )
+        cursor.execute(
             sql.SQL(
                 '''DELETE FROM data.original WHERE id = {original_id}'''
             ).format(
                 original_id=sql.Literal(original_id)
             )
         )
-        self._database.commit()
+        self._publish(cursor, changes, field_terms)
+        cursor.connection.commit()
+        return True
 
-    def search(self, data, node="_general_index", limit=None):
-        if self._diacritics_sensitive is False:
-            data = self._flatten_diacritics(data)
-        print "Searching {0}...".format(data)
-        data = data.split()
-        start = time.time()
-        results = set()
+    def _document_lengths(self, cursor, ids):
+        # tombstoned documents get no length, so ranking skips them
+        cursor.execute(
+            sql.SQL(
+                '''SELECT id, COALESCE(length, 0) FROM data.original AS original WHERE id = ANY({ids})
+                    AND NOT EXISTS (SELECT 1 FROM data.tombstones AS tombstones WHERE tombstones.id = original.id)'''
+            ).format(
+                ids=sql.Literal(ids)
+            )
+        )
+        return dict(cursor.fetchall())
+
+    def _decoded_blocks(self, cursor, terms):
+        cursor.execute(
+            sql.SQL(
+                '''SELECT blocks.term, blocks.postings, terms.max_frequency FROM index._general_blocks AS blocks
+                    JOIN index._general_index AS terms ON terms.term = blocks.term
+                    WHERE blocks.term = ANY({terms}) ORDER BY blocks.term, blocks.first_id''').format(
+                terms=sql.Literal(terms)
+            )
+        )
+        rows = {}
+        for term, postings, max_frequency in cursor.fetchall():
+            ids, frequencies = decode_block(postings)
+            row = rows.setdefault(term, (term, [], [], max_frequency))
+            row[1].extend(ids)
+            row[2].extend(frequencies)
+        return rows.values()
 
-        for token in data:
-            self._cursor.execute(
+    def _block_search(self, cursor, terms):
+        """
+        Intersects the block postings starting from the term with the fewest postings; for the other
+        terms only the blocks whose id range holds a remaining candidate are fetched and decoded.
+        """
+        cursor.execute(
+            sql.SQL(
+                '''SELECT term, block, first_id, last_id, count FROM index._general_blocks
+                    WHERE term = ANY({terms})''').format(
+                terms=sql.Literal(terms)
+            )
+        )
+        blocks = {}
+        for term, block, first_id, last_id, count in cursor.fetchall():
+            blocks.setdefault(term, []).append((first_id, last_id, count, block))
+        if len(blocks) < len(terms):
+            return []
+        results = None
+        for term in sorted(blocks, key=lambda term: sum(block[2] for block in blocks[term])):
+            needed = sorted(blocks[term])
+            if results is not None:
+                needed = [block for block in needed
+                          if bisect_left(results, block[0]) < bisect_right(results, block[1])]
+            if not needed:
+                return []
+            cursor.execute(
                 sql.SQL(
-                    '''SELECT inverted_index FROM index.{table_name} WHERE term = {term}''').format(
-                    table_name=sql.Identifier(node),
-                    term=sql.Literal(token),
+                    '''SELECT postings FROM index._general_blocks WHERE term = {term} AND block = ANY({blocks})
+                        ORDER BY first_id''').format(
+                    term=sql.Literal(term),
+                    blocks=sql.Literal([block[3] for block in needed])
                 )
             )
-            rows = self._cursor.fetchone()
-            if rows is not None:
-                if len(results) != 0:
-                    results = results.intersection(set(rows[0]))
-                else:
-                    results = set(rows[0])
+            ids = []
+            for row in cursor.fetchall():
+                ids.extend(decode_block(row[0])[0])
+            results = ids if results is None else intersect(results, ids)
+            if not results:
+                return []
+        return results
+
+    def _ranked_search(self, cursor, terms, node, limit, included=None, weights=None, scores=None,
+                       conjunctive=False):
+        """
+        Scores the documents holding any of the terms, or all of them when conjunctive, with BM25.
+        """
+        with self._stage("lookup"):
+            cursor.execute('''SELECT documents, length FROM index._statistics''')
+            documents, length = cursor.fetchone()
+            if self._block_size and node == "_general_index":
+                rows = self._decoded_blocks(cursor, terms)
             else:
-                print "No results!"
-                return
+                cursor.execute(
+                    sql.SQL(
+                        '''SELECT term, inverted_index, frequencies, max_frequency FROM index.{table_name}
+                            WHERE term = ANY({terms})''').format(
+                        table_name=sql.Identifier(node),
+                        terms=sql.Literal(terms),
+                    )
+                )
+                rows = []
+                for term, postings, frequencies, max_frequency in cursor.fetchall():
+                    # appended batches and concurrent writers leave the arrays out of id order
+                    pairs = sorted(zip(postings, frequencies or [1] * len(postings)))
+                    rows.append((term, [pair[0] for pair in pairs], [pair[1] for pair in pairs], max_frequency))
+        if conjunctive and len(rows) < len(set(terms)):
+            return []
+        bm25 = BM25(documents, float(length) / documents if documents else 0)
+        cursors = []
+        for term, postings, frequencies, max_frequency in rows:
+            idf = bm25.idf(len(postings))
+            if weights is not None:
+                idf *= weights[term]
+            cursors.append(TermCursor(postings, frequencies, idf, bm25.upper_bound(idf, max_frequency)))
+        with self._stage("ranking"):
+            ranked = top_k(cursors, limit, bm25, DocumentLengths(lambda ids: self._document_lengths(cursor, ids)),
+                           included=included, conjunctive=conjunctive)
+        if scores is not None:
+            scores.update((doc, score) for score, doc in ranked)
+        return [doc for score, doc in ranked]
 
-        stop = time.time()
-        if len(results) == 0:
-            print "No results!"
-            return
+    def _matching_ids(self, cursor, terms, node):
+        if self._block_size and node == "_general_index":
+            with self._stage("lookup"):
+                results = self._block_search(cursor, terms)
         else:
-            self._cursor.execute(
+            with self._stage("lookup"):
+                cursor.execute(
+                    sql.SQL(
+                        '''SELECT inverted_index FROM index.{table_name} WHERE term = ANY({terms})''').format(
+                        table_name=sql.Identifier(node),
+                        terms=sql.Literal(terms),
+                    )
+                )
+                rows = cursor.fetchall()
+            if len(rows) < len(terms):
+                return []
+            with self._stage("intersection"):
+                results = intersect_all([sorted(row[0]) for row in rows])
+        return results
+
+    def _positional_matches(self, cursor, terms, constraints):
+        """
+        Returns the documents holding all the terms whose positions satisfy every constraint.
+        """
+        if not self._positional:
+            raise QueryError("Phrase and NEAR queries need an Indexer created with positional=True!")
+        candidates = self._matching_ids(cursor, terms, "_general_index")
+        if not candidates:
+            return []
+        constrained = set(term for constraint in constraints for term in constraint_terms(constraint))
+        with self._stage("positions"):
+            return self._verified(cursor, candidates, constrained, constraints)
+
+    def _verified(self, cursor, candidates, constrained, constraints):
+        cursor.execute(
+            sql.SQL(
+                '''SELECT id, term, positions FROM index._positions
+                    WHERE term = ANY({terms}) AND id = ANY({candidates})''').format(
+                terms=sql.Literal(list(constrained)),
+                candidates=sql.Literal(candidates)
+            )
+        )
+        positions = {}
+        for doc, term, term_positions in cursor.fetchall():
+            positions.setdefault(doc, {})[term] = term_positions
+        return [doc for doc in candidates
+                if all(satisfied(constraint, positions.get(doc, {})) for constraint in constraints)]
+
+    def _term_postings(self, cursor, terms, node):
+        """
+        Returns {term: sorted postings} for the terms found in the node.
+        """
+        if self._block_size and node == "_general_index":
+            cursor.execute(
                 sql.SQL(
-                    '''SELECT * FROM data.original WHERE id IN {id_list}''').format(
-                    id_list=sql.Literal(tuple(results))
+                    '''SELECT term, postings FROM index._general_blocks WHERE term = ANY({terms})
+                        ORDER BY term, first_id''').format(
+                    terms=sql.Literal(terms)
                 )
             )
-            results = self._cursor.fetchall()
-            if limit:
-                results = results[:limit]
-            for result in results:
-                yield result
-            print "Found {0} results in {1} seconds for {2}!".format(len(results), stop - start, data)
+            postings = {}
+            for term, block in cursor.fetchall():
+                postings.setdefault(term, []).extend(decode_block(block)[0])
+            return postings
+        cursor.execute(
+            sql.SQL('''SELECT term, inverted_index FROM index.{table_name} WHERE term = ANY({terms})''').format(
+                table_name=sql.Identifier(node),
+                terms=sql.Literal(terms)
+            )
+        )
+        return dict((term, sorted(postings)) for term, postings in cursor.fetchall())
 
-    def suggest(self, data, node="_general_index", limit=None, relevant_suggestions=True):
+    def _expand(self, cursor, pattern, node):
+        """
+        Returns up to MAX_EXPANSIONS terms of the node matching a wild*card pattern, the most frequent
+        first. With deepindexing the candidates come from the n-grams of its longest literal part.
+        """
+        pieces = pattern.split("*")
+        longest = max(pieces, key=len)
+        candidates = sql.SQL('')
+        order = sql.SQL('cardinality(inverted_index)')
+        if node == "_general_index":
+            order = sql.SQL('COALESCE(document_frequency, cardinality(inverted_index))')
+            if self._deepindexing and self._gram_size:
+                candidates = sql.SQL(''' AND id IN ({ids})''').format(ids=self._gram_candidates(longest))
+        cursor.execute(
+            sql.SQL(
+                '''SELECT term FROM index.{table_name} WHERE term LIKE {pattern}{candidates}
+                    ORDER BY {order} DESC LIMIT {limit}''').format(
+                table_name=sql.Identifier(node),
+                pattern=sql.Literal("%".join(piece.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                                             for piece in pieces)),
+                candidates=candidates,
+                order=order,
+                limit=sql.Literal(MAX_EXPANSIONS)
+            )
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def _boolean_search(self, cursor, tree, node, limit, ranked, restriction=None, after=None, scores=None):
+        """
+        Runs a parsed boolean query as a plan of lazy posting iterators, stopping after limit matches.
+        Ranked, the matches are scored with BM25 over the terms that are not negated. field:value
+        words are matched against the field index and not scored.
+        """
+        found = list(leaves(tree))
+        with self._stage("expansion"):
+            expansions = dict((leaf[1], self._expand(cursor, leaf[1], node))
+                              for leaf, negated in found if leaf[0] == "wildcard")
+        scopes = dict((leaf[1], self._scope(leaf[1])) for leaf, negated in found if leaf[0] == "term")
+        scoped = set(leaf for leaf, field_terms in scopes.iteritems() if field_terms is not None)
+        terms = set(scopes) - scoped
+        with self._stage("lookup"):
+            postings = self._term_postings(cursor, list(terms.union(*expansions.values())), node)
+            field_postings = self._term_postings(cursor, list(set(term for leaf in scoped for term in scopes[leaf])),
+                                                 "_field_index") if scoped else {}
+
+        def resolve(leaf):
+            if leaf[0] == "term" and leaf[1] in scoped:
+                return intersect_all([field_postings.get(term, []) for term in scopes[leaf[1]]])
+            if leaf[0] == "term":
+                return postings.get(leaf[1], [])
+            if leaf[0] == "wildcard":
+                return [postings[term] for term in expansions[leaf[1]] if term in postings]
+            return self._positional_matches(cursor, list(set(constraint_terms(leaf))), [leaf])
+
+        plan = compile_plan(tree, resolve)
+        if restriction is not None:
+            plan = Intersection([plan, PostingIterator(restriction)])
+        with self._stage("intersection"):
+            results = self._execute_live(cursor, plan, None if ranked else limit, None if ranked else after)
+        if not ranked:
+            return results
+        if not results:
+            return []
+        scored = set()
+        for leaf, negated in found:
+            if not negated and not (leaf[0] == "term" and leaf[1] in scoped):
+                scored.update([leaf[1]] if leaf[0] == "term" else
+                              expansions[leaf[1]] if leaf[0] == "wildcard" else constraint_terms(leaf))
+        if not scored:
+            return results[:limit] if limit else results
+        ranked = self._ranked_search(cursor, list(scored), node, limit, set(results), scores=scores)
+        if limit and len(ranked) >= limit:
+            return ranked
+        # matches holding none of the scored terms, e.g. only a field:value of an OR, come last
+        found = set(ranked)
+        unscored = [doc for doc in results if doc not in found]
+        unscored = unscored[:limit - len(ranked)] if limit else unscored
+        if scores is not None:
+            scores.update((doc, 0.0) for doc in unscored)
+        return ranked + unscored
+
+    def _fuzzy_variants(self, cursor, term):
+        """
+        Returns {variant: edits} for the MAX_VARIANTS terms of the general index with the fewest edits,
+        at most max_edits(term), from term. Without n-grams the trie is walked as a Levenshtein
+        automaton, or else the terms starting with the first character of term are scanned. With
+        deepindexing the candidates come from the rarest grams a variant has to share with term, at
+        most CANDIDATE_BUDGET postings of each.
+        """
+        edits = max_edits(term)
+        variants = {term: 0}
+        if self._deepindexing:
+            grams, shared = candidate_grams(term, self._gram_size, edits)
+            cursor.execute(
+                sql.SQL(
+                    '''SELECT term, cardinality(inverted_index) FROM index._ngram_index WHERE term = ANY({grams})'''
+                ).format(
+                    grams=sql.Literal(grams)
+                )
+            )
+            counts = dict(cursor.fetchall())
+            # a variant holds shared of the grams, so one of any len(grams) - shared + 1 of them; missing
+            # grams are the rarest of all and need no lookup
+            rarest = sorted(grams, key=lambda gram: counts.get(gram, 0))[:len(grams) - shared + 1]
+            rarest = [gram for gram in rarest if gram in counts]
+            candidates = []
+            if rarest:
+                cursor.execute(
+                    sql.SQL(
+                        '''SELECT DISTINCT terms.term FROM (
+                                SELECT UNNEST(inverted_index[1:{budget}]) AS id FROM index._ngram_index
+                                WHERE term = ANY({grams})) AS candidates
+                            JOIN index._general_index AS terms ON terms.id = candidates.id
+                            WHERE length(terms.term) BETWEEN {shortest} AND {longest}''').format(
+                        grams=sql.Literal(rarest),
+                        shortest=sql.Literal(len(term) - edits),
+                        longest=sql.Literal(len(term) + edits),
+                        budget=sql.Literal(CANDIDATE_BUDGET)
+                    )
+                )
+                candidates = [row[0] for row in cursor.fetchall()]
+        elif self._trie is not None:
+            with self._lock:
+                variants.update(self._trie.within(term, edits))
+            candidates = []
+        else:
+            cursor.execute(
+                sql.SQL(
+                    '''SELECT term FROM index._general_index
+                        WHERE term LIKE {prefix} AND length(term) BETWEEN {shortest} AND {longest}
+                        LIMIT {budget}''').format(
+                    prefix=sql.Literal(term[0].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"),
+                    shortest=sql.Literal(len(term) - edits),
+                    longest=sql.Literal(len(term) + edits),
+                    budget=sql.Literal(CANDIDATE_BUDGET)
+                )
+            )
+            candidates = [row[0] for row in cursor.fetchall()]
+        for candidate in candidates:
+            candidate_edits = distance(candidate, term, edits)
+            if candidate_edits is not None:
+                variants[candidate] = candidate_edits
+        return dict(sorted(variants.iteritems(), key=lambda pair: (pair[1], pair[0]))[:MAX_VARIANTS])
+
+    def _fuzzy_search(self, cursor, terms, limit, ranked, restriction=None, after=None, scores=None):
+        """
+        Matches the documents holding a variant of every term; ranked, a variant scores
+        weight(edits) of what the exact term would.
+        """
+        with self._stage("expansion"):
+            variants = [self._fuzzy_variants(cursor, term) for term in terms]
+        with self._stage("lookup"):
+            postings = self._term_postings(cursor, list(set(variant for group in variants for variant in group)),
+                                           "_general_index")
+        plan = Intersection([Union([PostingIterator(postings[variant]) for variant in group if variant in postings])
+                             for group in variants])
+        if restriction is not None:
+            plan = Intersection([plan, PostingIterator(restriction)])
+        with self._stage("intersection"):
+            results = self._execute_live(cursor, plan, None if ranked else limit, None if ranked else after)
+        if not ranked:
+            return results
+        if not results:
+            return []
+        weights = {}
+        for group in variants:
+            for variant, edits in group.iteritems():
+                weights[variant] = max(weights.get(variant, 0), weight(edits))
+        return self._ranked_search(cursor, [variant for variant in weights if variant in postings], "_general_index",
+                                   limit, set(results), weights, scores)
+
+    def _query_dependencies(self, tree):
+        dependencies = []
+        for leaf, negated in leaves(tree):
+            if leaf[0] == "term":
+                dependencies.append(leaf[1])
+            elif leaf[0] == "wildcard":
+                pieces = leaf[1].split("*")
+                dependencies.append(("substring", max(pieces, key=len)) if self._deepindexing else ("prefix", pieces[0]))
+            else:
+                dependencies.extend(constraint_terms(leaf))
+        return dependencies
+
+    def _scope(self, term):
+        """
+        Returns the field terms a field:value query word matches, or None unless field is declared.
+        """
+        field, separator, value = term.partition(":")
+        if not separator or field not in self._fields:
+            return None
+        return [field + ":" + token for token in self._tokenizer.tokens(value)] or [term]
+
+    def _filter_groups(self, filters):
+        """
+        Turns {field: value or [values]} into a list of field=value term groups, any of which matches.
+        """
+        groups = []
+        for field, values in sorted((filters or {}).iteritems()):
+            field = self._field_name(field)
+            if field not in self._fields:
+                raise QueryError("{0} is not an indexed field! Please pass it to create_index().".format(field))
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            groups.append(tuple(sorted(set(self._field_value(field, value) for value in values))))
+        return groups
+
+    def _restriction(self, cursor, groups):
+        """
+        Returns the sorted documents matching a term of every group of field terms.
+        """
+        with self._stage("lookup"):
+            postings = self._term_postings(cursor, list(set(term for group in groups for term in group)),
+                                           "_field_index")
+        with self._stage("intersection"):
+            return execute(Intersection([Union([PostingIterator(postings[term]) for term in group
+                                                      if term in postings])
+                                         for group in groups]))
+
+    def _search_ids(self, cursor, terms, node, limit, ranked, constraints=(), tree=None, fuzzy=False,
+                    restriction=None, after=None, scores=None):
+        """
+        Returns the ids of the first limit matches, best first when ranked and else in id order after
+        the id after. Ranked, the score of every scored id is put in scores when given.
+        """
+        if not terms and tree is None:
+            results = restriction or []
+        elif fuzzy:
+            return self._fuzzy_search(cursor, terms, limit, ranked, restriction, after, scores)
+        elif tree is not None:
+            return self._boolean_search(cursor, tree, node, limit, ranked, restriction, after, scores)
+        elif constraints:
+            results = self._positional_matches(cursor, terms, constraints)
+            if restriction is not None:
+                results = intersect_all([results, restriction])
+            if ranked and results:
+                return self._ranked_search(cursor, terms, node, limit, set(results), scores=scores)
+        elif ranked:
+            # ranking orders the documents plain search matches, all of the terms, it does not add any
+            return self._ranked_search(cursor, terms, node, limit,
+                                       set(restriction) if restriction is not None else None, scores=scores,
+                                       conjunctive=True)
+        else:
+            results = self._matching_ids(cursor, terms, node)
+            if restriction is not None:
+                results = intersect_all([results, restriction])
+        return self._execute_live(cursor, PostingIterator(results), limit, after)
+
+    def _highlighted(self, terms, constraints, tree):
+        if tree is None:
+            return list(terms) + [term for constraint in constraints for term in constraint_terms(constraint)]
+        highlighted = []
+        for leaf, negated in leaves(tree):
+            if negated or (leaf[0] == "term" and self._scope(leaf[1]) is not None):
+                continue
+            if leaf[0] == "term":
+                highlighted.append(leaf[1])
+            elif leaf[0] == "wildcard":
+                highlighted.append(max(leaf[1].split("*"), key=len))
+            else:
+                highlighted.extend(constraint_terms(leaf))
+        return highlighted
+
+    def _hydrate(self, cursor, ids, page, highlighted):
+        """
+        Fetches the rows of ids, in their order, with the columns of the page. With a snippet the excerpt
+        is cut out by the database, so whole documents never leave it.
+        """
+        if page.columns is None:
+            columns = sql.SQL('original.*')
+        else:
+            columns = sql.SQL(', ').join(sql.SQL('original.{column}').format(column=sql.Identifier(column))
+                                         for column in page.columns)
+        if page.snippet:
+            cursor.execute(
+                sql.SQL(
+                    '''SELECT {columns}, substr(original.data, excerpt.start, {length}), excerpt.start > 1,
+                        char_length(original.data) >= excerpt.start + {length}
+                        FROM data.original AS original, LATERAL (
+                            SELECT GREATEST(1, COALESCE(min(position), 1) - {before}) AS start FROM (
+                                SELECT strpos(lower(original.data), term) AS position
+                                FROM UNNEST({terms}::TEXT[]) AS term) AS positions
+                            WHERE position > 0) AS excerpt
+                        WHERE original.id = ANY({ids})''').format(
+                    columns=columns,
+                    length=sql.Literal(page.snippet),
+                    before=sql.Literal(page.snippet // 4),
+                    terms=sql.Literal([term.lower() for term in highlighted]),
+                    ids=sql.Literal(list(ids))
+                )
+            )
+            rows = [row[:-3] + (snippet(row[-3] or "", row[-2], row[-1], highlighted),) for row in cursor.fetchall()]
+        else:
+            cursor.execute(
+                sql.SQL('''SELECT {columns} FROM data.original AS original WHERE original.id = ANY({ids})''').format(
+                    columns=columns,
+                    ids=sql.Literal(list(ids))
+                )
+            )
+            rows = cursor.fetchall()
+        order = dict((doc, position) for position, doc in enumerate(ids))
+        return sorted(rows, key=lambda row: order[row[0]])
+
+    def _search(self, cursor, terms, node, page, ranked, constraints=(), tree=None, fuzzy=False, groups=()):
+        """
+        Only the ids of the page are hydrated: the limit and the offset are applied to the matching ids.
+        """
+        if ranked and page.after is not None:
+            raise QueryError("Ranked results are paged by offset!")
+        restriction = None
+        if groups:
+            restriction = self._restriction(cursor, groups)
+            if not restriction:
+                return []
+        scores = {} if page.scores else None
+        results = self._search_ids(cursor, terms, node, page.window, ranked, constraints, tree, fuzzy, restriction,
+                                   page.after, scores)
+        results = results[page.offset:]
+        if len(results) == 0:
+            return []
+        with self._stage("hydration"):
+            rows = self._hydrate(cursor, results, page, self._highlighted(terms, constraints, tree))
+        if scores is not None:
+            rows = [tuple(row) + (scores.get(row[0], 0.0),) for row in rows]
+        return rows
+
+    def _query(self, data, node, fuzzy, filters):
+        """
+        Parses a flattened query. Returns (terms, constraints, tree, groups, key, dependencies), groups
+        holding the field terms its field:value words and the filters restrict the results to.
+        """
+        groups = self._filter_groups(filters)
+        if is_boolean(data) and not fuzzy:
+            tree = parse_boolean(data, self._tokenizer.tokens)
+            terms, constraints = [], ()
+            dependencies = self._query_dependencies(tree)
+            for leaf, negated in leaves(tree):
+                if leaf[0] == "term":
+                    dependencies.extend(self._scope(leaf[1]) or [])
+        else:
+            tree = None
+            if fuzzy:
+                terms, constraints = list(set(data.split())), ()
+            else:
+                terms, constraints = parse(data, self._tokenizer.tokens)
+            scopes = [self._scope(term) for term in terms]
+            groups += [(field_term,) for field_terms in scopes if field_terms for field_term in field_terms]
+            terms = [term for term, field_terms in zip(terms, scopes) if field_terms is None]
+            if fuzzy:
+                # a variant shares at least one character with its term; without n-grams any term can be one
+                dependencies = [("substring", character) for term in terms for character in set(term)] \
+                    if self._deepindexing else [("prefix", "")]
+            else:
+                dependencies = list(terms)
+        groups = sorted(set(groups))
+        dependencies += [term for group in groups for term in group]
+        key = ("fuzzy" if fuzzy else "search", tuple(sorted(terms)), tuple(constraints), tree, tuple(groups), node)
+        return terms, constraints, tree, groups, key, dependencies
+
+    def _results(self, data, node, page, ranked, fuzzy, filters):
+        with self._stage("parse"):
+            terms, constraints, tree, groups, key, dependencies = self._query(data, node, fuzzy, filters)
+        key += page.key() + (ranked,)
+        results = self._cache.get(key) if self._cache is not None else None
+        self._annotate(plan={"mode": "fuzzy" if fuzzy else "boolean" if tree is not None else
+                             "positional" if constraints else "terms", "terms": terms, "constraints": constraints,
+                             "tree": tree, "filters": groups, "ranked": ranked, "page": page.key(), "node": node},
+                       cached=results is not None)
+        if results is None:
+            results = []
+            version = None
+            if terms or tree is not None or groups:
+                with self._connection(read_only=True) as cursor:
+                    version = self._read_version(cursor)
+                    results = self._search(cursor, terms, node, page, ranked, constraints, tree, fuzzy, groups)
+            if self._cache is not None:
+                self._cache_put(key, dependencies, results, version)
+        self._annotate(results=len(results))
+        return results
+
+    def search(self, data, node="_general_index", limit=None, ranked=False, fuzzy=False, filters=None):
+        """
+        With ranked=True the documents containing any of the terms are scored with BM25 and only the
+        best limit of them are fetched, best first. With a positional index "quoted phrases" and
+        a NEAR/n b restrict the results to the documents where they occur.
+
+        Queries using OR, NOT, (groups) or wild*cards are compiled to a plan of posting iterators, e.g.
+        (ana OR mere) NOT pere*; wildcards expand to at most MAX_EXPANSIONS terms.
+
+        With fuzzy=True every word also matches the terms of the general index within max_edits() typos
+        of it, which rank lower the more edits they need.
+
+        A word like title:mere only matches documents whose title field holds mere, and filters, e.g.
+        {"country_name": ["Romania", "Moldova"]}, keeps the documents having one of the values of every
+        field; both need the fields to be declared to create_index().
+        """
+        with self._operation("search", query=data):
+            if self._diacritics_sensitive is False:
+                data = self._flatten_diacritics(data)
+            results = self._results(data, node, Page(limit), ranked, fuzzy, filters)
+        for result in results:
+            yield result
+
+    def page(self, data, limit=20, cursor=None, ranked=False, fuzzy=False, filters=None, columns=None, snippet=None,
+             node="_general_index", scores=False):
+        """
+        Returns one page of what search() finds as {"results": rows, "cursor": cursor}, cursor being what
+        to pass for the next page, or None after the last one. Only the rows of the page are fetched, with
+        the columns asked for (id always comes first) and, with snippet, an HTML excerpt of about snippet
+        characters around the first query term as the next column. With scores the BM25 score of every
+        ranked result comes last.
+        """
+        with self._operation("search", query=data, cursor=cursor):
+            if self._diacritics_sensitive is False:
+                data = self._flatten_diacritics(data)
+            page = from_cursor(cursor, limit, columns, snippet, scores)
+            results = self._results(data, node, page, ranked, fuzzy, filters)
+        return {"results": results, "cursor": page.next_cursor(results, ranked)}
+
+    def facets(self, fields, data=None, filters=None, limit=10, fuzzy=False):
+        """
+        Counts the documents matching the query data and the filters (all of them when both are missing)
+        per value of every one of the fields. Returns {field: [(value, count)]} with the limit most
+        frequent values, computed by intersecting the field=value postings with the matches.
+        """
+        with self._operation("facets", query=data, fields=fields, filters=filters):
+            return self._cached_facets(fields, data or "", filters, limit, fuzzy)
+
+    def _cached_facets(self, fields, data, filters, limit, fuzzy):
         if self._diacritics_sensitive is False:
             data = self._flatten_diacritics(data)
-        data = data.split()[-1]
+        terms, constraints, tree, groups, key, dependencies = self._query(data, "_general_index", fuzzy, filters)
+        fields = [self._field_name(field) for field in fields]
+        for field in fields:
+            if field not in self._fields:
+                raise QueryError("{0} is not an indexed field! Please pass it to create_index().".format(field))
+        key = ("facets", tuple(fields), limit) + key
+        dependencies += [("field", field) for field in fields]
+        results = self._cache.get(key) if self._cache is not None else None
+        if results is None:
+            with self._connection(read_only=True) as cursor:
+                version = self._read_version(cursor)
+                results = self._facets(cursor, fields, terms, constraints, tree, groups, limit, fuzzy)
+            if self._cache is not None:
+                self._cache_put(key, dependencies, results, version)
+        return results
+
+    def _facets(self, cursor, fields, terms, constraints, tree, groups, limit, fuzzy):
+        matches = None
+        if terms or tree is not None or groups:
+            restriction = self._restriction(cursor, groups) if groups else None
+            matches = self._search_ids(cursor, terms, "_general_index", None, False, constraints, tree, fuzzy,
+                                       restriction) if restriction != [] else []
+        results = {}
+        for field in fields:
+            prefix = sql.Literal(field.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "=%")
+            if matches is None:
+                # every live document counts
+                cursor.execute(
+                    sql.SQL(
+                        '''SELECT term, (SELECT count(*) FROM UNNEST(inverted_index) AS posting(id) WHERE NOT EXISTS
+                            (SELECT 1 FROM data.tombstones AS tombstones WHERE tombstones.id = posting.id))
+                            FROM index._field_index WHERE term LIKE {prefix}''').format(
+                        prefix=prefix
+                    )
+                )
+                counts = [(term[len(field) + 1:], count) for term, count in cursor.fetchall() if count]
+            else:
+                cursor.execute(
+                    sql.SQL('''SELECT term, inverted_index FROM index._field_index WHERE term LIKE {prefix}''').format(
+                        prefix=prefix
+                    )
+                )
+                counts = []
+                for term, postings in cursor.fetchall():
+                    count = len(intersect_all([sorted(postings), matches]))
+                    if count:
+                        counts.append((term[len(field) + 1:], count))
+            counts.sort(key=lambda pair: (-pair[1], pair[0]))
+            results[field] = counts[:limit] if limit else counts
+        return results
+
+    def _gram_candidates(self, data):
+        """
+        Returns a subquery of the ids of the terms holding every gram of data, so the intersection runs in
+        the database instead of shipping the postings of short, common grams out and back in.
+        """
+        if len(data) <= self._gram_size:
+            return sql.SQL('''SELECT UNNEST(inverted_index) FROM index._ngram_index WHERE term = {gram}''').format(
+                gram=sql.Literal(data)
+            )
+        grams = list(set(data[i:i + self._gram_size] for i in range(len(data) - self._gram_size + 1)))
+        return sql.SQL(
+            '''SELECT candidates.id FROM index._ngram_index AS grams, UNNEST(grams.inverted_index) AS candidates(id)
+                WHERE grams.term = ANY({grams}) GROUP BY candidates.id
+                HAVING count(DISTINCT grams.term) = {count}''').format(
+            grams=sql.Literal(grams),
+            count=sql.Literal(len(grams))
+        )
+
+    def _completes(self, node, limit):
+        return self._trie is not None and not self._deepindexing and node == "_general_index" \
+            and limit and limit <= self._autocomplete_size
+
+    def _suggest(self, cursor, data, node, limit, relevant_suggestions):
         results = []
-        start = time.time()
+        live = sql.SQL('')
+        if node == "_general_index":
+            # terms left only in tombstoned documents are not suggested
+            live = sql.SQL(''' AND COALESCE(document_frequency, cardinality(inverted_index)) > tombstoned''')
         if not self._deepindexing:
             s = sql.SQL('''SELECT DISTINCT(term) FROM index.{table_name}
-                            WHERE term LIKE {term}''').format(
+                            WHERE term LIKE {term}{live}''').format(
                 table_name=sql.Identifier(node),
                 term=sql.Literal(data + "%"),
-                limit=sql.Literal(limit)
+                limit=sql.Literal(limit),
+                live=live
+            )
+            if limit:
+                s += sql.SQL(''' LIMIT {limit}''').format(limit=sql.Literal(limit))
+            cursor.execute(s)
+            results = cursor.fetchall()
+        elif self._gram_size:
+            s = sql.SQL('''SELECT dterm FROM (SELECT DISTINCT(term) AS dterm, position({term} in term), length(term)
+                            FROM index.{node} WHERE id IN ({candidates}) AND position({term} in term) > 0{live}) Q1
+                            ORDER BY position, length''').format(
+                term=sql.Literal(data),
+                node=sql.Identifier(node),
+                candidates=self._gram_candidates(data),
+                live=live
             )
             if limit:
                 s += sql.SQL(''' LIMIT {limit}''').format(limit=sql.Literal(limit))
-            self._cursor.execute(s)
-            results = self._cursor.fetchall()
+            cursor.execute(s)
         else:
             if limit:
-                self._cursor.execute(
+                cursor.execute(
                     sql.SQL(
                         '''WITH Q1 AS (SELECT distinct(term) AS dterm, position ({term} in term), length(term)
                             FROM index.{node} WHERE id IN (SELECT UNNEST(inverted_index) FROM index._ngram_index
-                            WHERE term = {term} LIMIT {limit}) ORDER BY position, length) 
+                            WHERE term = {term} LIMIT {limit}){live} ORDER BY position, length) 
                             SELECT dterm FROM Q1''').format(
                         term=sql.Literal(data),
                         node=sql.Identifier(node),
-                        limit=sql.Literal(limit)
+                        limit=sql.Literal(limit),
+                        live=live
                     )
                 )
             else:
-                self._cursor.execute(
+                cursor.execute(
                     sql.SQL(
                         '''WITH Q1 AS (SELECT distinct(term) AS dterm, position ({term} in term), length(term)
                             FROM index.{node} WHERE id IN (SELECT UNNEST(inverted_index) FROM index._ngram_index
-                            WHERE term = {term}) ORDER BY position, length)
+                            WHERE term = {term}){live} ORDER BY position, length)
                             SELECT dterm''').format(
                         term=sql.Literal(data),
                         node=sql.Identifier(node),
+                        live=live
                     )
                 )
-        fetch_data = self._cursor.fetchall()
+        fetch_data = cursor.fetchall()
         if fetch_data:
             if relevant_suggestions:
                 results += [i for i in fetch_data if i not in results]
             else:
                 results = fetch_data
-        stop = time.time()
-        if not results:
-            print "No suggestion found for {0}".format(data)
-            return
-        print "Suggesting took {0} seconds!".format(stop - start)
         if limit:
             results = results[:limit]
+        return [result[0] for result in results]
+
+    def suggest(self, data, node="_general_index", limit=None, relevant_suggestions=True):
+        with self._operation("suggest", query=data) as operation:
+            if self._diacritics_sensitive is False:
+                data = self._flatten_diacritics(data)
+            data = data.split()[-1]
+            key = ("suggest", data, node, limit, relevant_suggestions)
+            if self._completes(node, limit):
+                with self._stage("lookup"):
+                    results = self._trie.complete(data, limit)
+            else:
+                results = self._cache.get(key) if self._cache is not None else None
+                operation.annotate(cached=results is not None)
+            if results is None:
+                with self._stage("lookup"), self._connection(read_only=True) as cursor:
+                    version = self._read_version(cursor)
+                    results = self._suggest(cursor, data, node, limit, relevant_suggestions)
+                if self._cache is not None:
+                    self._cache_put(key, [("substring" if self._deepindexing else "prefix", data)], results, version)
+            operation.annotate(results=len(results))
         for result in results:
-            yield result[0]
+            yield result
+
+    def _exported_terms(self, cursor):
+        """
+        Streams (id, term, postings, frequencies, max_frequency) in byte order of the terms.
+        """
+        if self._block_size:
+            cursor.execute(
+                '''SELECT terms.id, terms.term, terms.max_frequency, blocks.postings FROM index._general_index AS terms
+                    JOIN index._general_blocks AS blocks ON blocks.term = terms.term
+                    ORDER BY terms.term COLLATE "C", blocks.first_id'''
+            )
+            row = None
+            for general_index_id, term, max_frequency, postings in cursor:
+                if row is not None and row[1] != term:
+                    yield row
+                    row = None
+                if row is None:
+                    row = (general_index_id, term, [], [], max_frequency)
+                ids, frequencies = decode_block(postings)
+                row[2].extend(ids)
+                row[3].extend(frequencies)
+            if row is not None:
+                yield row
+        else:
+            cursor.execute(
+                '''SELECT id, term, inverted_index, frequencies, max_frequency FROM index._general_index
+                    ORDER BY term COLLATE "C"'''
+            )
+            for general_index_id, term, postings, frequencies, max_frequency in cursor:
+                pairs = sorted(zip(postings, frequencies or [1] * len(postings)))
+                yield general_index_id, term, [pair[0] for pair in pairs], [pair[1] for pair in pairs], max_frequency
+
+    def export_snapshot(self, path):
+        """
+        Writes the general index, the n-gram index and the stored documents to an immutable snapshot
+        file which snapshot.Snapshot serves read-only. Tombstoned documents are left out. Returns the
+        number of exported terms.
+        """
+        writer = SnapshotWriter(path, self._diacritics_sensitive, self._deepindexing, self._gram_size)
+        with self._connection(read_only=True) as cursor:
+            cursor.execute('''SELECT id FROM data.tombstones''')
+            tombstones = set(row[0] for row in cursor.fetchall())
+            ordinals = {}
+            rows = cursor.connection.cursor("snapshot_terms")
+            for general_index_id, term, postings, frequencies, max_frequency in self._exported_terms(rows):
+                if tombstones:
+                    pairs = [pair for pair in zip(postings, frequencies) if pair[0] not in tombstones]
+                    postings, frequencies = [pair[0] for pair in pairs], [pair[1] for pair in pairs]
+                if postings:
+                    ordinals[general_index_id] = writer.add_term(term, postings, frequencies, max_frequency)
+            rows.close()
+            writer.end_terms()
+            if self._deepindexing:
+                rows = cursor.connection.cursor("snapshot_ngrams")
+                rows.execute('''SELECT term, inverted_index FROM index._ngram_index ORDER BY term COLLATE "C"''')
+                for term, postings in rows:
+                    terms = sorted(ordinals[i] for i in postings if i in ordinals)
+                    if terms:
+                        writer.add_ngram(term, terms)
+                rows.close()
+            writer.end_ngrams()
+            rows = cursor.connection.cursor("snapshot_documents")
+            rows.execute('''SELECT id, data, fields, timestamp, length FROM data.original ORDER BY id''')
+            for row in rows:
+                if row[0] not in tombstones:
+                    writer.add_document(row)
+            rows.close()
+        writer.close()
+        return len(ordinals)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,264 @@
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_QUERIES = logging.getLogger("indexer.slow_queries")
+SLOW_QUERIES.addHandler(logging.NullHandler())
+# the slow query logs written by some Instrumentation, each by one handler however many there are
+_slow_query_logs = set()
+_slow_query_lock = threading.Lock()
+
+
+def _labels(labels):
+    return tuple(sorted(labels.iteritems())) if labels else ()
+
+
+def _render_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+
+class Metrics:
+    """
+    Thread safe counters, gauges and histograms, rendered in the Prometheus text format by render().
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self._buckets = buckets
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, labels=None, value=1):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            self._gauges[(name, _labels(labels))] = value
+
+    def observe(self, name, value, labels=None):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self._buckets) + 1), 0.0]
+            histogram[0][bisect_left(self._buckets, value)] += 1
+            histogram[1] += value
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.iteritems())
+            gauges = sorted(self._gauges.iteritems())
+            histograms = sorted((key, (list(counts), total)) for key, (counts, total) in self._histograms.iteritems())
+        lines = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            typed = set()
+            for (name, labels), value in values:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append("# TYPE {0} {1}".format(name, kind))
+                lines.append("{0}{1} {2}".format(name, _render_labels(labels), value))
+        typed = set()
+        for (name, labels), (counts, total) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {0} histogram".format(name))
+            cumulative = 0
+            for bound, count in zip(list(self._buckets) + ["+Inf"], counts):
+                cumulative += count
+                lines.append("{0}_bucket{1} {2}".format(name, _render_labels(labels, [("le", bound)]), cumulative))
+            lines.append("{0}_sum{1} {2}".format(name, _render_labels(labels), total))
+            lines.append("{0}_count{1} {2}".format(name, _render_labels(labels), cumulative))
+        return "\n".join(lines) + "\n"
+
+
+class _Stage(object):
+    __slots__ = ('_operation', '_name', '_start')
+
+    def __init__(self, operation, name):
+        self._operation = operation
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self._operation.record(self._name, time.time() - self._start)
+
+
+class Operation(object):
+    """
+    One timed call: its total seconds, the seconds spent in every named stage (stages may nest, e.g.
+    "db" round-trips happen inside "lookup"), its database round-trips and details such as its plan.
+    """
+
+    def __init__(self, instrumentation, name, details):
+        self.name = name
+        self.details = details
+        self.stages = {}
+        self.roundtrips = 0
+        self.seconds = None
+        self.failed = False
+        self.parent = None
+        self._instrumentation = instrumentation
+        self._start = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.failed = kind is not None
+        self._instrumentation.finish(self)
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def record(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def annotate(self, **details):
+        self.details.update(details)
+
+
+class _Disabled(object):
+    """
+    Stands for both the operation and the stage when instrumentation is off, so it costs one call.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        pass
+
+    def stage(self, name):
+        return self
+
+    def annotate(self, **details):
+        pass
+
+
+DISABLED = _Disabled()
+
+
+class Instrumentation:
+    """
+    Times the operations of an Indexer stage by stage. Every finished operation is recorded in metrics
+    and passed to the hooks, callables taking the Operation. Operations slower than slow_query_seconds
+    are logged as JSON, with their stages and plan, to the indexer.slow_queries logger, which also
+    writes to slow_query_log when given.
+    """
+
+    def __init__(self, hooks=(), slow_query_seconds=None, slow_query_log=None):
+        self.metrics = Metrics()
+        self.hooks = list(hooks)
+        self.slow_query_seconds = slow_query_seconds
+        self._local = threading.local()
+        if slow_query_log:
+            path = os.path.abspath(slow_query_log)
+            with _slow_query_lock:
+                if path not in _slow_query_logs:
+                    _slow_query_logs.add(path)
+                    handler = logging.FileHandler(path)
+                    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+                    SLOW_QUERIES.addHandler(handler)
+                    SLOW_QUERIES.setLevel(logging.INFO)
+
+    def start(self, name, **details):
+        operation = Operation(self, name, details)
+        operation.parent = getattr(self._local, "operation", None)
+        self._local.operation = operation
+        return operation
+
+    def current(self):
+        return getattr(self._local, "operation", None)
+
+    def stage(self, name):
+        operation = self.current()
+        return operation.stage(name) if operation is not None else DISABLED
+
+    def annotate(self, **details):
+        operation = self.current()
+        if operation is not None:
+            operation.annotate(**details)
+
+    def roundtrip(self, seconds):
+        operation = self.current()
+        if operation is not None:
+            operation.roundtrips += 1
+            operation.record("db", seconds)
+
+    def finish(self, operation):
+        operation.seconds = time.time() - operation._start
+        self._local.operation = operation.parent
+        labels = {"operation": operation.name}
+        self.metrics.increment("indexer_operations_total", labels)
+        if operation.failed:
+            self.metrics.increment("indexer_errors_total", labels)
+        self.metrics.increment("indexer_db_roundtrips_total", labels, operation.roundtrips)
+        self.metrics.observe("indexer_operation_seconds", operation.seconds, labels)
+        for stage, seconds in operation.stages.iteritems():
+            self.metrics.observe("indexer_stage_seconds", seconds, {"operation": operation.name, "stage": stage})
+        if self.slow_query_seconds is not None and operation.seconds >= self.slow_query_seconds:
+            self.metrics.increment("indexer_slow_operations_total", labels)
+            SLOW_QUERIES.warning(json.dumps({
+                "operation": operation.name,
+                "seconds": operation.seconds,
+                "stages": operation.stages,
+                "roundtrips": operation.roundtrips,
+                "details": operation.details,
+            }, default=repr, sort_keys=True))
+        for hook in self.hooks:
+            hook(operation)
+
+
+def print_timings(operation):
+    """
+    Hook printing every operation the way the Indexer used to.
+    """
+    stages = ", ".join("{0} {1:.6f}".format(stage, seconds) for stage, seconds in sorted(operation.stages.iteritems()))
+    print "{0} took {1} seconds ({2}) {3}".format(operation.name, operation.seconds, stages,
+                                                 json.dumps(operation.details, default=repr, sort_keys=True))
+
+
+class TimedCursor(object):
+    """
+    Cursor proxy reporting every execute() and copy_expert() as a database round-trip of the current
+    operation.
+    """
+
+    def __init__(self, cursor, instrumentation):
+        self._cursor = cursor
+        self._instrumentation = instrumentation
+
+    def execute(self, *arguments):
+        start = time.time()
+        try:
+            return self._cursor.execute(*arguments)
+        finally:
+            self._instrumentation.roundtrip(time.time() - start)
+
+    def copy_expert(self, *arguments):
+        start = time.time()
+        try:
+            return self._cursor.copy_expert(*arguments)
+        finally:
+            self._instrumentation.roundtrip(time.time() - start)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
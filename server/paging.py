@@ -0,0 +1,118 @@
+# coding=utf-8
+import cgi
+import re
+
+from query import QueryError
+
+COLUMNS = ("id", "data", "fields", "timestamp", "length")
+SNIPPET_LENGTH = 160
+_ELLIPSIS = u"…"
+
+
+class Page:
+    """
+    Window of the matches that gets hydrated: limit results after skipping offset of them or, for
+    results in id order, the ones after the id after. columns restricts the fetched columns (id always
+    comes first), snippet adds an excerpt of about snippet characters around the first query term and
+    scores adds the score of every ranked result as the last column.
+    """
+
+    def __init__(self, limit=None, offset=0, after=None, columns=None, snippet=None, scores=False):
+        if columns is not None:
+            unknown = [column for column in columns if column not in COLUMNS]
+            if unknown:
+                raise QueryError("Unknown columns {0}!".format(", ".join(unknown)))
+            columns = ("id",) + tuple(column for column in columns if column != "id")
+        self.limit = limit
+        self.offset = offset or 0
+        self.after = after
+        self.columns = columns
+        self.snippet = snippet
+        self.scores = scores
+
+    @property
+    def window(self):
+        """
+        How many matches, from the start or from after, are needed to fill the page.
+        """
+        return self.offset + self.limit if self.limit else None
+
+    def key(self):
+        return self.limit, self.offset, self.after, self.columns, self.snippet, self.scores
+
+    def next_cursor(self, results, ranked):
+        """
+        Returns the cursor of the page following results, or None when results is the last page.
+        Ranked results are paged by offset, the others by the last id, which stays stable while
+        documents are indexed or removed.
+        """
+        if not self.limit or len(results) < self.limit:
+            return None
+        if ranked:
+            return "offset:{0}".format(self.offset + len(results))
+        return "after:{0}".format(results[-1][0])
+
+
+def from_cursor(cursor, limit=None, columns=None, snippet=None, scores=False):
+    """
+    Returns the Page a cursor returned by Page.next_cursor() points to.
+    """
+    if not cursor:
+        return Page(limit, columns=columns, snippet=snippet, scores=scores)
+    kind, separator, value = cursor.partition(":")
+    if kind not in ("offset", "after") or not value.isdigit():
+        raise QueryError("Invalid cursor {0}!".format(cursor))
+    if kind == "offset":
+        return Page(limit, int(value), columns=columns, snippet=snippet, scores=scores)
+    return Page(limit, after=int(value), columns=columns, snippet=snippet, scores=scores)
+
+
+def first_match(text, terms):
+    """
+    Returns the position of the first occurrence of any of the terms in text, ignoring case, or -1.
+    """
+    lowered = text.lower()
+    positions = [position for position in (lowered.find(term) for term in terms if term) if position >= 0]
+    return min(positions) if positions else -1
+
+
+def excerpt_start(text, terms, length):
+    """
+    Where an excerpt of length characters showing the first match of the terms starts.
+    """
+    return max(0, first_match(text, terms) - length // 4)
+
+
+def snippet(excerpt, clipped_start, clipped_end, terms):
+    """
+    Turns an excerpt cut out of a document into an HTML snippet: words cut in half at a clipped end
+    are dropped and replaced by an ellipsis and whole word occurrences of the terms are highlighted.
+    """
+    if isinstance(excerpt, str):
+        excerpt = excerpt.decode("utf8", "ignore")
+    if clipped_start and len(excerpt.split(None, 1)) > 1:
+        excerpt = excerpt.split(None, 1)[1]
+    if clipped_end and len(excerpt.rsplit(None, 1)) > 1:
+        excerpt = excerpt.rsplit(None, 1)[0]
+    words = sorted(set(term for term in terms if term), key=len, reverse=True)
+    escaped = cgi.escape(excerpt)
+    if words:
+        pattern = re.compile(r'\b(' + '|'.join(re.escape(cgi.escape(word)) for word in words) + r')\b',
+                             re.IGNORECASE | re.UNICODE)
+        escaped = pattern.sub(r'<b>\1</b>', escaped)
+    return (_ELLIPSIS if clipped_start else u"") + escaped + (_ELLIPSIS if clipped_end else u"")
+
+
+def project(row, page, terms, score=None):
+    """
+    Applies the columns, the snippet and the score of a page to a whole (id, data, fields, timestamp,
+    length) row.
+    """
+    projected = tuple(row) if page.columns is None else tuple(row[COLUMNS.index(column)] for column in page.columns)
+    if page.snippet:
+        text = row[1] or u""
+        start = excerpt_start(text, terms, page.snippet)
+        projected += (snippet(text[start:start + page.snippet], start > 0, len(text) > start + page.snippet, terms),)
+    if page.scores:
+        projected += (score or 0.0,)
+    return projected
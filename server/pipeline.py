@@ -0,0 +1,119 @@
+import multiprocessing
+import threading
+import time
+from collections import deque
+from Queue import Queue
+
+from analysis import analyze_batch
+
+
+def _analyze(arguments):
+    options, batch = arguments
+    start = time.time()
+    analysis = analyze_batch(batch, **options)
+    return analysis, time.time() - start
+
+
+class IngestPipeline:
+    """
+    Three stage ingestion: the pool's feeding thread reads documents into batches, a process pool
+    analyzes them with analyze_batch(batch, **options), n-grams included, and a writer thread hands
+    the analyzed batches to write(batch, analysis), which returns the number of documents written. At
+    most queue_size batches wait between the stages, so memory stays bounded.
+    """
+
+    def __init__(self, write, options, workers=None, batch_size=1000, queue_size=4):
+        self._write = write
+        self._options = options
+        self._workers = workers or multiprocessing.cpu_count()
+        self._batch_size = batch_size
+        self._queue_size = queue_size
+        self._in_flight = threading.BoundedSemaphore(self._workers + 2 * queue_size)
+        self._pending = deque()
+        self._error = None
+        self._counter = 0
+        self.stats = dict((stage, [0, 0.0]) for stage in ("read", "tokenize", "write"))
+
+    def _record(self, stage, documents, seconds):
+        self.stats[stage][0] += documents
+        self.stats[stage][1] += seconds
+
+    def _acquire(self):
+        # polled so that a failed writer cannot leave the pool's feeding thread blocked forever
+        while not self._in_flight.acquire(False):
+            if self._error is not None:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def _batches(self, iterable):
+        batch = []
+        start = time.time()
+        for item in iterable:
+            if isinstance(item, basestring):
+                data, fields = item, None
+            else:
+                data, fields = item
+            if not isinstance(data, basestring):
+                continue
+            batch.append((data.strip(), fields))
+            if len(batch) >= self._batch_size:
+                self._record("read", len(batch), time.time() - start)
+                if not self._acquire():
+                    return
+                self._pending.append(batch)
+                yield self._options, batch
+                batch = []
+                start = time.time()
+        if batch:
+            self._record("read", len(batch), time.time() - start)
+            if not self._acquire():
+                return
+            self._pending.append(batch)
+            yield self._options, batch
+
+    def _writer(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            batch, analysis = item
+            try:
+                if self._error is None:
+                    start = time.time()
+                    self._counter += self._write(batch, analysis)
+                    self._record("write", len(batch), time.time() - start)
+            except Exception as error:
+                # keep draining so the other stages are not blocked on a full queue
+                self._error = error
+            finally:
+                self._in_flight.release()
+
+    def run(self, iterable):
+        queue = Queue(self._queue_size)
+        writer = threading.Thread(target=self._writer, args=(queue,))
+        writer.start()
+        pool = multiprocessing.Pool(self._workers)
+        try:
+            for analysis, seconds in pool.imap(_analyze, self._batches(iterable)):
+                batch = self._pending.popleft()
+                self._record("tokenize", len(batch), seconds)
+                queue.put((batch, analysis))
+                if self._error is not None:
+                    break
+        finally:
+            queue.put(None)
+            writer.join()
+            pool.terminate()
+            pool.join()
+        if self._error is not None:
+            raise self._error
+        return self._counter
+
+    def report(self):
+        """
+        Returns {stage: (documents, busy seconds, documents per busy second)}; tokenize time is summed
+        over all worker processes.
+        """
+        return dict((stage, (documents, seconds, documents / seconds if seconds else 0))
+                    for stage, (documents, seconds) in self.stats.iteritems())
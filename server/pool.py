@@ -0,0 +1,33 @@
+import threading
+from contextlib import contextmanager
+
+from psycopg2.pool import ThreadedConnectionPool
+
+
+class ConnectionPool:
+    """
+    ThreadedConnectionPool that makes callers wait for a free connection instead of raising when
+    all of them are checked out.
+    """
+
+    def __init__(self, size, **connection_arguments):
+        self._pool = ThreadedConnectionPool(1, size, **connection_arguments)
+        self._available = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        self._available.acquire()
+        try:
+            connection = self._pool.getconn()
+            try:
+                yield connection
+            finally:
+                # whatever was not committed by the operation is discarded before reuse
+                if not connection.closed:
+                    connection.rollback()
+                self._pool.putconn(connection, close=bool(connection.closed))
+        finally:
+            self._available.release()
+
+    def close(self):
+        self._pool.closeall()
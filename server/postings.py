@@ -0,0 +1,86 @@
+from bisect import bisect_left
+
+
+def gallop(postings, target, low=0):
+    """
+    Returns the position of the first posting >= target, probing exponentially from low and
+    finishing with a binary search.
+    """
+    size = len(postings)
+    high = low
+    step = 1
+    while high < size and postings[high] < target:
+        low = high + 1
+        high += step
+        step <<= 1
+    return bisect_left(postings, target, low, min(high, size))
+
+
+def intersect(shorter, longer):
+    results = []
+    position = 0
+    size = len(longer)
+    for posting in shorter:
+        position = gallop(longer, posting, position)
+        if position == size:
+            break
+        if longer[position] == posting:
+            results.append(posting)
+            position += 1
+    return results
+
+
+def intersect_all(postings):
+    """
+    Intersects sorted posting lists starting from the shortest one and stops as soon as the running
+    result is empty.
+    """
+    if not postings:
+        return []
+    postings = sorted(postings, key=len)
+    results = postings[0]
+    for posting in postings[1:]:
+        if not results:
+            break
+        results = intersect(results, posting)
+    return results
+
+
+def _encode_varint(value, output):
+    while value >= 0x80:
+        output.append((value & 0x7f) | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def encode_block(ids, frequencies, previous=0):
+    """
+    Encodes sorted ids and their frequencies as alternating varints, every id stored as the delta
+    from the one before it (from previous for the first one).
+    """
+    output = bytearray()
+    for posting, frequency in zip(ids, frequencies):
+        _encode_varint(posting - previous, output)
+        _encode_varint(frequency, output)
+        previous = posting
+    return output
+
+
+def decode_block(data):
+    ids = []
+    frequencies = []
+    previous = value = shift = 0
+    is_id = True
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        if is_id:
+            previous += value
+            ids.append(previous)
+        else:
+            frequencies.append(value)
+        is_id = not is_id
+        value = shift = 0
+    return ids, frequencies
@@ -0,0 +1,375 @@
+import heapq
+import re
+from bisect import bisect_right
+
+from postings import gallop, intersect_all
+
+_QUERY = re.compile(r'"([^"]*)"|NEAR/(\d+)|(\S+)')
+
+
+class QueryError(Exception):
+    """
+    A query that is malformed or uses syntax the index cannot answer.
+    """
+
+
+def parse(data, tokenize):
+    """
+    Splits a query into its terms and its positional constraints: a quoted phrase becomes
+    ("phrase", terms) and "a NEAR/n b" becomes ("near", n, a, b), a and b being the terms of the word
+    or phrase on either side. Phrases and NEAR operands go through tokenize(text) so they match the
+    indexed positions; other words are kept as they are. Returns (terms, constraints), terms holding
+    the terms of the constraints too.
+    """
+    items = []
+    for phrase, distance, word in _QUERY.findall(data):
+        if distance:
+            items.append(("near", int(distance)))
+        elif word:
+            items.append(("word", word))
+        else:
+            items.append(("phrase", tuple(tokenize(phrase))))
+    terms = []
+    constraints = []
+    operands = set()
+    for i, item in enumerate(items):
+        if item[0] != "near":
+            continue
+        if i == 0 or i == len(items) - 1 or items[i - 1][0] == "near" or items[i + 1][0] == "near":
+            raise QueryError("NEAR/{0} needs a word or a phrase on both sides!".format(item[1]))
+        sides = []
+        for j in (i - 1, i + 1):
+            operands.add(j)
+            sides.append(items[j][1] if items[j][0] == "phrase" else tuple(tokenize(items[j][1])))
+        if sides[0] and sides[1]:
+            constraints.append(("near", item[1], sides[0], sides[1]))
+    for i, item in enumerate(items):
+        if item[0] == "phrase" or (item[0] == "word" and i in operands):
+            phrase = item[1] if item[0] == "phrase" else tuple(tokenize(item[1]))
+            terms.extend(phrase)
+            if item[0] == "phrase" and len(phrase) > 1:
+                constraints.append(("phrase", phrase))
+        elif item[0] == "word":
+            terms.append(item[1])
+    return list(set(terms)), constraints
+
+
+def constraint_terms(constraint):
+    if constraint[0] == "phrase":
+        return constraint[1]
+    return constraint[2] + constraint[3]
+
+
+def occurrences(phrase, positions):
+    """
+    Returns the sorted start positions of the phrase in a document, given {term: sorted positions}.
+    """
+    return intersect_all([[position - i for position in positions.get(term, [])] for i, term in enumerate(phrase)])
+
+
+def _follows(first, first_length, second, distance):
+    # an occurrence of second starting at most distance positions after an occurrence of first ends
+    for start in first:
+        end = start + first_length - 1
+        index = bisect_right(second, end)
+        if index < len(second) and second[index] - end <= distance:
+            return True
+    return False
+
+
+def satisfied(constraint, positions):
+    if constraint[0] == "phrase":
+        return bool(occurrences(constraint[1], positions))
+    distance, left, right = constraint[1:]
+    left_starts = occurrences(left, positions)
+    right_starts = occurrences(right, positions)
+    return (_follows(left_starts, len(left), right_starts, distance) or
+            _follows(right_starts, len(right), left_starts, distance))
+
+
+_BOOLEAN = re.compile(r'\b(?:AND|OR|NOT)\b|[()*]')
+_ITEMS = re.compile(r'"([^"]*)"|NEAR/(\d+)|([()])|([^\s()"]+)')
+MAX_EXPANSIONS = 1024
+
+
+def is_boolean(data):
+    return _BOOLEAN.search(data) is not None
+
+
+class _Parser:
+    """
+    Recursive descent parser of the boolean query language, from the loosest binding operator:
+    a OR b, a [AND] b, NOT a, a NEAR/n b, then (groups), "phrases", wild*cards and words.
+    """
+
+    def __init__(self, data, tokenize):
+        self._tokenize = tokenize
+        self._items = []
+        for phrase, distance, parenthesis, word in _ITEMS.findall(data):
+            if distance:
+                self._items.append(("near", int(distance)))
+            elif parenthesis:
+                self._items.append((parenthesis, None))
+            elif word:
+                self._items.append(("word", word))
+            else:
+                self._items.append(("phrase", phrase))
+        self._position = 0
+
+    def _peek(self):
+        return self._items[self._position] if self._position < len(self._items) else (None, None)
+
+    def _next(self):
+        item = self._peek()
+        if item[0] is None:
+            raise QueryError("Unexpected end of the query!")
+        self._position += 1
+        return item
+
+    def parse(self):
+        tree = self._or()
+        if self._peek()[0] is not None:
+            raise QueryError("Unexpected {0} in the query!".format(self._peek()[1] or self._peek()[0]))
+        return tree
+
+    def _or(self):
+        children = [self._and()]
+        while self._peek() == ("word", "OR"):
+            self._next()
+            children.append(self._and())
+        return children[0] if len(children) == 1 else ("or", tuple(children))
+
+    def _and(self):
+        children = [self._unary()]
+        while self._peek()[0] not in (None, ")") and self._peek() != ("word", "OR"):
+            if self._peek() == ("word", "AND"):
+                self._next()
+            children.append(self._unary())
+        return children[0] if len(children) == 1 else ("and", tuple(children))
+
+    def _unary(self):
+        if self._peek() == ("word", "NOT"):
+            self._next()
+            return ("not", self._unary())
+        return self._near()
+
+    def _operand(self, tree, distance):
+        if tree[0] == "phrase":
+            return tree[1]
+        if tree[0] == "term":
+            return tuple(self._tokenize(tree[1])) or (tree[1],)
+        raise QueryError("NEAR/{0} needs a word or a phrase on both sides!".format(distance))
+
+    def _near(self):
+        left = self._primary()
+        nears = []
+        while self._peek()[0] == "near":
+            distance = self._next()[1]
+            if self._peek()[0] is None:
+                raise QueryError("NEAR/{0} needs a word or a phrase on both sides!".format(distance))
+            right = self._primary()
+            nears.append(("near", distance, self._operand(left, distance), self._operand(right, distance)))
+            left = right
+        if not nears:
+            return left
+        return nears[0] if len(nears) == 1 else ("and", tuple(nears))
+
+    def _primary(self):
+        kind, value = self._next()
+        if kind == "(":
+            tree = self._or()
+            if self._peek()[0] != ")":
+                raise QueryError("Missing ) in the query!")
+            self._next()
+            return tree
+        if kind == "phrase":
+            terms = tuple(self._tokenize(value))
+            if not terms:
+                raise QueryError("Empty phrase in the query!")
+            return ("phrase", terms) if len(terms) > 1 else ("term", terms[0])
+        if kind == "word":
+            if "*" not in value:
+                return ("term", value)
+            if not value.strip("*"):
+                raise QueryError("A wildcard needs at least one character!")
+            return ("wildcard", value)
+        raise QueryError("Unexpected {0} in the query!".format(value if kind == "near" else kind))
+
+
+def parse_boolean(data, tokenize):
+    """
+    Parses a query using OR, NOT, (groups), wild*cards, "phrases" and NEAR/n into a tree of nested
+    tuples: ("or", children), ("and", children), ("not", child) and the leaves ("term", term),
+    ("wildcard", pattern), ("phrase", terms) and ("near", n, a, b).
+    """
+    return _Parser(data, tokenize).parse()
+
+
+def leaves(tree, negated=False):
+    """
+    Yields (leaf, negated) for every leaf of the tree.
+    """
+    if tree[0] in ("and", "or"):
+        for child in tree[1]:
+            for leaf in leaves(child, negated):
+                yield leaf
+    elif tree[0] == "not":
+        for leaf in leaves(tree[1], not negated):
+            yield leaf
+    else:
+        yield tree, negated
+
+
+class PostingIterator:
+    """
+    Leaf of an execution plan. Like every plan node it exposes the current doc (None once exhausted),
+    next(), seek(target) to the first doc >= target and an estimate of its cardinality.
+    """
+
+    def __init__(self, postings):
+        self._postings = postings
+        self._position = 0
+        self.estimate = len(postings)
+        self.doc = postings[0] if postings else None
+
+    def _update(self):
+        self.doc = self._postings[self._position] if self._position < len(self._postings) else None
+
+    def next(self):
+        self._position += 1
+        self._update()
+
+    def seek(self, target):
+        if self.doc is not None and self.doc < target:
+            self._position = gallop(self._postings, target, self._position)
+            self._update()
+
+
+class Intersection:
+    """
+    Leapfrogs its children from the one with the smallest estimate, seeking the others to it.
+    """
+
+    def __init__(self, children):
+        self._children = sorted(children, key=lambda child: child.estimate)
+        self.estimate = self._children[0].estimate
+        self._align()
+
+    def _align(self):
+        lead = self._children[0]
+        i = 1
+        while lead.doc is not None and i < len(self._children):
+            child = self._children[i]
+            child.seek(lead.doc)
+            if child.doc is None:
+                self.doc = None
+                return
+            if child.doc > lead.doc:
+                lead.seek(child.doc)
+                i = 1
+            else:
+                i += 1
+        self.doc = lead.doc
+
+    def next(self):
+        self._children[0].next()
+        self._align()
+
+    def seek(self, target):
+        self._children[0].seek(target)
+        self._align()
+
+
+class Union:
+    """
+    Merges its children through a heap ordered by their current doc.
+    """
+
+    def __init__(self, children):
+        self._children = children
+        self.estimate = sum(child.estimate for child in children)
+        self._heap = [(child.doc, i) for i, child in enumerate(children) if child.doc is not None]
+        heapq.heapify(self._heap)
+        self.doc = self._heap[0][0] if self._heap else None
+
+    def _advance(self, done, move):
+        while self._heap and done(self._heap[0][0]):
+            i = heapq.heappop(self._heap)[1]
+            move(self._children[i])
+            if self._children[i].doc is not None:
+                heapq.heappush(self._heap, (self._children[i].doc, i))
+        self.doc = self._heap[0][0] if self._heap else None
+
+    def next(self):
+        current = self.doc
+        self._advance(lambda doc: doc == current, lambda child: child.next())
+
+    def seek(self, target):
+        self._advance(lambda doc: doc < target, lambda child: child.seek(target))
+
+
+class Difference:
+    """
+    The docs of include that are not in exclude, exclude being only ever seeked forward.
+    """
+
+    def __init__(self, include, exclude):
+        self._include = include
+        self._exclude = exclude
+        self.estimate = include.estimate
+        self._skip()
+
+    def _skip(self):
+        while self._include.doc is not None:
+            self._exclude.seek(self._include.doc)
+            if self._exclude.doc != self._include.doc:
+                break
+            self._include.next()
+        self.doc = self._include.doc
+
+    def next(self):
+        self._include.next()
+        self._skip()
+
+    def seek(self, target):
+        self._include.seek(target)
+        self._skip()
+
+
+def compile_plan(tree, resolve):
+    """
+    Builds the execution plan of a parsed query. resolve(leaf) returns the sorted postings of a
+    term, phrase or NEAR leaf and a list of sorted postings, one per expanded term, for a wildcard.
+    """
+    kind = tree[0]
+    if kind == "and":
+        include = [compile_plan(child, resolve) for child in tree[1] if child[0] != "not"]
+        exclude = [compile_plan(child[1], resolve) for child in tree[1] if child[0] == "not"]
+        if not include:
+            raise QueryError("NOT needs terms to exclude documents from!")
+        plan = include[0] if len(include) == 1 else Intersection(include)
+        if exclude:
+            plan = Difference(plan, exclude[0] if len(exclude) == 1 else Union(exclude))
+        return plan
+    if kind == "or":
+        if any(child[0] == "not" for child in tree[1]):
+            raise QueryError("NOT needs terms to exclude documents from!")
+        return Union([compile_plan(child, resolve) for child in tree[1]])
+    if kind == "not":
+        raise QueryError("NOT needs terms to exclude documents from!")
+    if kind == "wildcard":
+        return Union([PostingIterator(postings) for postings in resolve(tree)])
+    return PostingIterator(resolve(tree))
+
+
+def execute(plan, limit=None, after=None):
+    """
+    Returns the first limit docs of the plan, or of its docs after the doc after.
+    """
+    if after is not None:
+        plan.seek(after + 1)
+    results = []
+    while plan.doc is not None and (not limit or len(results) < limit):
+        results.append(plan.doc)
+        plan.next()
+    return results
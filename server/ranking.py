@@ -0,0 +1,115 @@
+import heapq
+import math
+
+from postings import gallop
+
+
+class BM25:
+    def __init__(self, documents, average_length, k1=1.2, b=0.75):
+        self._documents = documents
+        self._average_length = float(average_length) or 1.0
+        self._k1 = k1
+        self._b = b
+
+    def idf(self, document_frequency):
+        return math.log(1 + (self._documents - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def score(self, idf, frequency, length):
+        norm = self._k1 * (1 - self._b + self._b * length / self._average_length)
+        return idf * frequency * (self._k1 + 1) / (frequency + norm)
+
+    def upper_bound(self, idf, max_frequency):
+        # the score grows with the frequency and is largest for an empty document
+        return idf * max_frequency * (self._k1 + 1) / (max_frequency + self._k1 * (1 - self._b))
+
+
+class TermCursor:
+    def __init__(self, postings, frequencies, idf, upper_bound):
+        self.postings = postings
+        self.frequencies = frequencies
+        self.idf = idf
+        self.upper_bound = upper_bound
+        self.position = 0
+
+    def exhausted(self):
+        return self.position >= len(self.postings)
+
+    def doc(self):
+        return self.postings[self.position]
+
+    def frequency(self):
+        return self.frequencies[self.position]
+
+    def upcoming(self, count):
+        return self.postings[self.position:self.position + count]
+
+    def next(self):
+        self.position += 1
+
+    def seek(self, target):
+        self.position = gallop(self.postings, target, self.position)
+
+
+class DocumentLengths:
+    """
+    Lazily loads document lengths through fetch(ids) -> {id: length}, prefetching the next
+    batch_size postings of the cursor that asked for them. The ids fetch leaves out get None.
+    """
+
+    def __init__(self, fetch, batch_size=256):
+        self._fetch = fetch
+        self._batch_size = batch_size
+        self._lengths = {}
+
+    def get(self, cursor):
+        doc = cursor.doc()
+        if doc not in self._lengths:
+            ids = [i for i in cursor.upcoming(self._batch_size) if i not in self._lengths]
+            lengths = self._fetch(ids)
+            self._lengths.update((i, lengths.get(i)) for i in ids)
+        return self._lengths[doc]
+
+
+def top_k(cursors, k, bm25, lengths, excluded=(), included=None, conjunctive=False):
+    """
+    WAND over the term cursors: documents whose summed upper bounds cannot beat the current k-th
+    best score are skipped without being scored. Returns [(score, id)] ordered by score, then by id
+    so that the results for k are always the first k of the results for any larger k.
+    With k=None every matching document is scored. Documents in excluded, or without a length, are
+    never returned, and when included is given only documents in it are. With conjunctive only the
+    documents found by every cursor match, the pivot being the last cursor.
+    """
+    heap = []
+    required = len(cursors) if conjunctive else 1
+    cursors = [cursor for cursor in cursors if not cursor.exhausted()]
+    while cursors and len(cursors) >= required:
+        cursors.sort(key=lambda cursor: cursor.doc())
+        threshold = heap[0][0] if k is not None and len(heap) >= k else 0
+        bound = 0
+        pivot = None
+        for i, cursor in enumerate(cursors):
+            bound += cursor.upper_bound
+            if bound > threshold and i + 1 >= required:
+                pivot = i
+                break
+        if pivot is None:
+            break
+        pivot_doc = cursors[pivot].doc()
+        if cursors[0].doc() == pivot_doc:
+            matched = [cursor for cursor in cursors if cursor.doc() == pivot_doc]
+            if pivot_doc not in excluded and (included is None or pivot_doc in included):
+                length = lengths.get(matched[0])
+                if length is not None:
+                    score = sum(bm25.score(cursor.idf, cursor.frequency(), length) for cursor in matched)
+                    # of two equal scores the lower id wins, like it does against the threshold
+                    if k is None or len(heap) < k:
+                        heapq.heappush(heap, (score, -pivot_doc))
+                    elif score > heap[0][0]:
+                        heapq.heapreplace(heap, (score, -pivot_doc))
+            for cursor in matched:
+                cursor.next()
+        else:
+            for cursor in cursors[:pivot]:
+                cursor.seek(pivot_doc)
+        cursors = [cursor for cursor in cursors if not cursor.exhausted()]
+    return [(score, -doc) for score, doc in sorted(heap, reverse=True)]
@@ -1,11 +1,27 @@
-from flask import Flask, jsonify
-from flask_restful import Resource, Api
+from flask import Flask, Response, jsonify, request
+from flask_restful import Resource, Api, abort
 
+from config import COMPACTION_INTERVAL, SHARD_DSNS, SLOW_QUERY_LOG, SLOW_QUERY_SECONDS, SNAPSHOT_PATH
 from indexer import Indexer
+from metrics import Instrumentation
+from query import QueryError
+from sharding import ShardedIndexer
+from snapshot import Snapshot
+
+MAX_PAGE_SIZE = 100
 
 app = Flask(__name__, static_folder="static/pages")
 api = Api(app)
-indexer = Indexer()
+instrumentation = Instrumentation(slow_query_seconds=SLOW_QUERY_SECONDS, slow_query_log=SLOW_QUERY_LOG)
+if SNAPSHOT_PATH:
+    indexer = Snapshot(SNAPSHOT_PATH, instrumentation=instrumentation)
+elif SHARD_DSNS:
+    indexer = ShardedIndexer(SHARD_DSNS, autocomplete=True, cache_size=10000, pool_size=16,
+                             instrumentation=instrumentation)
+else:
+    indexer = Indexer(autocomplete=True, cache_size=10000, pool_size=16, instrumentation=instrumentation)
+if COMPACTION_INTERVAL and not SNAPSHOT_PATH:
+    indexer.start_compaction(COMPACTION_INTERVAL)
 
 
 class Suggestions(Resource):
@@ -15,7 +31,26 @@ class Suggestions(Resource):
 
 class Search(Resource):
     def get(self, data):
-        return jsonify({"results": [i for i in indexer.search(data, limit=20)]})
+        """
+        Matches the documents holding every word of the query, best BM25 score first, or in id order
+        with ?ranked=false. Pages through the results with ?cursor= set to the cursor of the previous
+        page. ?limit= sets the page size, from 1 to MAX_PAGE_SIZE, ?columns=id,fields the returned
+        columns and ?snippet= the length of a highlighted excerpt added to every result. A query the
+        index cannot answer, e.g. a phrase without a positional index, is a 400.
+        """
+        limit = request.args.get("limit", 20, type=int)
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            abort(400, message="The limit must be between 1 and {0}!".format(MAX_PAGE_SIZE))
+        columns = request.args.get("columns")
+        try:
+            page = indexer.page(data, limit=limit,
+                                cursor=request.args.get("cursor"),
+                                ranked=request.args.get("ranked", "true") != "false",
+                                columns=columns.split(",") if columns else None,
+                                snippet=request.args.get("snippet", None, type=int))
+        except QueryError as error:
+            abort(400, message=str(error))
+        return jsonify(page)
 
 
 @app.route("/")
@@ -28,8 +63,16 @@ def script():
     return app.send_static_file("script.js")
 
 
+@app.route("/metrics")
+def metrics():
+    stats = indexer.cache_stats() if isinstance(indexer, (Indexer, ShardedIndexer)) else None
+    for name, value in (stats or {}).iteritems():
+        instrumentation.metrics.set("indexer_cache_" + name, value)
+    return Response(instrumentation.metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 api.add_resource(Suggestions, '/api/suggestions/<data>')
 api.add_resource(Search, '/api/search/<data>')
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=80)
+    app.run(host='0.0.0.0', port=80, threaded=True)
@@ -0,0 +1,151 @@
+import zlib
+from collections import Counter
+from itertools import izip_longest
+from multiprocessing.pool import ThreadPool
+
+from indexer import Indexer
+from paging import from_cursor
+from query import QueryError
+
+
+class ShardedIndexer:
+    """
+    Index spread over several databases, one Indexer per dsn. Documents go to the shard picked by a
+    hash of their text, and every shard numbers its documents so that shard_of(id) finds them again.
+    search(), page(), facets() and suggest() query all the shards in parallel and merge their answers:
+    matches by id, ranked matches by the BM25 score every shard gives its own top k. Shards score with
+    their own statistics, which hashing keeps close to the statistics of the whole index.
+
+    shards takes ready backends instead of dsns, e.g. Indexers created with shard=(i, n) or read-only
+    Snapshots exported from them; options are passed to the Indexer of every dsn.
+    """
+
+    def __init__(self, dsns=None, shards=None, **options):
+        if shards is None:
+            shards = [Indexer(shard=(i, len(dsns)), dsn=dsn, **options) for i, dsn in enumerate(dsns or [])]
+        if not shards:
+            raise Exception("A sharded index needs at least one shard!")
+        self._shards = list(shards)
+        self._workers = ThreadPool(len(self._shards))
+
+    def _scatter(self, call):
+        return self._workers.map(call, self._shards)
+
+    def _position(self, data):
+        if not isinstance(data, basestring):
+            return 0
+        if isinstance(data, unicode):
+            data = data.encode("utf8")
+        return (zlib.crc32(data.strip()) & 0xffffffff) % len(self._shards)
+
+    def shard_of(self, original_id):
+        return self._shards[(original_id - 1) % len(self._shards)]
+
+    def create_index(self, fields=None):
+        self._scatter(lambda shard: shard.create_index(fields))
+
+    def cache_stats(self):
+        stats = [shard_stats for shard_stats in self._scatter(lambda shard: shard.cache_stats()) if shard_stats]
+        if not stats:
+            return None
+        return dict((name, sum(shard_stats[name] for shard_stats in stats)) for name in stats[0])
+
+    def index(self, data, fields=None):
+        return self._shards[self._position(data)].index(data, fields)
+
+    def index_many(self, iterable, batch_size=1000):
+        """
+        Splits every batch_size documents per shard into the batches of the shards, which are written
+        in parallel.
+        """
+        counter = 0
+        chunk = []
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) >= batch_size * len(self._shards):
+                counter += self._index_chunk(chunk, batch_size)
+                chunk = []
+        if chunk:
+            counter += self._index_chunk(chunk, batch_size)
+        return counter
+
+    def _index_chunk(self, chunk, batch_size):
+        parts = dict((id(shard), []) for shard in self._shards)
+        for item in chunk:
+            shard = self._shards[self._position(item if isinstance(item, basestring) else item[0])]
+            parts[id(shard)].append(item)
+        return sum(self._scatter(lambda shard: shard.index_many(parts[id(shard)], batch_size)
+                                 if parts[id(shard)] else 0))
+
+    def remove_content_from_index(self, original_id, deferred=False):
+        return self.shard_of(original_id).remove_content_from_index(original_id, deferred)
+
+    def compact(self, batch_size=1000):
+        return sum(self._scatter(lambda shard: shard.compact(batch_size)))
+
+    def start_compaction(self, interval=60, batch_size=1000):
+        return [shard.start_compaction(interval, batch_size) for shard in self._shards]
+
+    def search(self, data, node="_general_index", limit=None, ranked=False, fuzzy=False, filters=None):
+        for result in self.page(data, limit, ranked=ranked, fuzzy=fuzzy, filters=filters, node=node)["results"]:
+            yield result
+
+    def page(self, data, limit=20, cursor=None, ranked=False, fuzzy=False, filters=None, columns=None, snippet=None,
+             node="_general_index", scores=False):
+        """
+        Same as Indexer.page(). Every shard returns the first offset + limit of its matches, after the id
+        of an after cursor, so the merged page is the one a single index would return.
+        """
+        page = from_cursor(cursor, limit, columns, snippet, scores)
+        if ranked and page.after is not None:
+            raise QueryError("Ranked results are paged by offset!")
+        options = {}
+        # only Indexer shards filter and match fuzzily, Snapshots answer the rest
+        if fuzzy:
+            options["fuzzy"] = fuzzy
+        if filters:
+            options["filters"] = filters
+        shard_cursor = "after:{0}".format(page.after) if page.after is not None else None
+        answers = self._scatter(lambda shard: shard.page(data, page.window, shard_cursor, ranked, columns=columns,
+                                                         snippet=snippet, node=node, scores=ranked or scores,
+                                                         **options)["results"])
+        rows = [row for results in answers for row in results]
+        if ranked:
+            rows.sort(key=lambda row: (-row[-1], row[0]))
+            if not scores:
+                rows = [row[:-1] for row in rows]
+        else:
+            rows.sort(key=lambda row: row[0])
+        results = rows[page.offset:page.window]
+        return {"results": results, "cursor": page.next_cursor(results, ranked)}
+
+    def facets(self, fields, data=None, filters=None, limit=10, fuzzy=False):
+        """
+        Same as Indexer.facets(), the counts of every value summed over the shards.
+        """
+        counts = {}
+        for results in self._scatter(lambda shard: shard.facets(fields, data, filters, None, fuzzy)):
+            for field, values in results.iteritems():
+                counts.setdefault(field, Counter()).update(dict(values))
+        results = {}
+        for field, values in counts.iteritems():
+            values = sorted(values.iteritems(), key=lambda pair: (-pair[1], pair[0]))
+            results[field] = values[:limit] if limit else values
+        return results
+
+    def suggest(self, data, node="_general_index", limit=None, relevant_suggestions=True):
+        """
+        Interleaves the suggestions of the shards, best of every shard first, without duplicates.
+        """
+        answers = self._scatter(lambda shard: list(shard.suggest(data, node, limit, relevant_suggestions)))
+        results = []
+        seen = set()
+        for suggestions in izip_longest(*answers):
+            for suggestion in suggestions:
+                if suggestion is not None and suggestion not in seen:
+                    seen.add(suggestion)
+                    results.append(suggestion)
+        if limit:
+            results = results[:limit]
+        for result in results:
+            yield result
@@ -0,0 +1,393 @@
+import json
+import mmap
+import struct
+from bisect import bisect_left, bisect_right
+
+from analysis import flatten_diacritics
+from metrics import DISABLED
+from paging import from_cursor, project
+from postings import intersect_all
+from query import QueryError
+from ranking import BM25, DocumentLengths, TermCursor, top_k
+
+MAGIC = 'IDXSNAP1'
+_UINT = struct.Struct('<I')
+_ULONG = struct.Struct('<Q')
+
+
+def _pack(code, values):
+    return struct.pack('<%d%s' % (len(values), code), *values)
+
+
+class MappedArray(object):
+    """
+    Read-only sequence of little endian integers living in a mapped buffer. Items are unpacked on
+    access, so bisect and the posting intersections only touch the pages they probe.
+    """
+    __slots__ = ('_buffer', '_offset', '_length', '_item')
+
+    def __init__(self, buffer, offset, length, item=_UINT):
+        self._buffer = buffer
+        self._offset = offset
+        self._length = length
+        self._item = item
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        return self._item.unpack_from(self._buffer, self._offset + self._item.size * index)[0]
+
+
+class SnapshotWriter:
+    """
+    Writes an immutable index snapshot. Sections are appended one after the other and located by
+    a JSON header stored at the end of the file, followed by its offset and the magic string.
+    Terms and n-grams must be added in byte order, documents in id order.
+    """
+
+    def __init__(self, path, diacritics_sensitive=False, deepindexing=False, gram_size=None):
+        self._file = open(path, 'wb')
+        self._sections = {}
+        self._options = {"diacritics_sensitive": diacritics_sensitive, "deepindexing": deepindexing,
+                         "gram_size": gram_size}
+        self._keys = []
+        self._key_offsets = [0]
+        self._value_offsets = [0]
+        self._max_frequencies = []
+        self._documents = []
+        self._lengths = []
+        self._row_offsets = [0]
+        self._streamed = None
+        self._streamed_start = 0
+
+    def _begin(self, name):
+        self._streamed = name
+        self._streamed_start = self._file.tell()
+
+    def _end(self):
+        self._sections[self._streamed] = (self._streamed_start, self._file.tell() - self._streamed_start)
+        self._streamed = None
+
+    def _section(self, name, data):
+        self._sections[name] = (self._file.tell(), len(data))
+        self._file.write(data)
+
+    def add_term(self, term, ids, frequencies, max_frequency):
+        """
+        Returns the ordinal of the term, which n-gram postings refer to.
+        """
+        if self._streamed is None:
+            self._begin('terms.postings')
+        self._file.write(_pack('I', ids))
+        self._file.write(_pack('I', frequencies))
+        self._add_key(term, 2 * len(ids))
+        self._max_frequencies.append(max_frequency or 0)
+        return len(self._keys) - 1
+
+    def add_ngram(self, ngram, ordinals):
+        if self._streamed is None:
+            self._begin('ngrams.postings')
+        self._file.write(_pack('I', ordinals))
+        self._add_key(ngram, len(ordinals))
+
+    def _add_key(self, key, values):
+        self._keys.append(key)
+        self._key_offsets.append(self._key_offsets[-1] + len(key))
+        self._value_offsets.append(self._value_offsets[-1] + values)
+
+    def _end_table(self, name):
+        if self._streamed is None:
+            self._begin(name + '.postings')
+        self._end()
+        self._section(name + '.keys', ''.join(self._keys))
+        self._section(name + '.key_offsets', _pack('Q', self._key_offsets))
+        self._section(name + '.value_offsets', _pack('Q', self._value_offsets))
+        count = len(self._keys)
+        self._keys = []
+        self._key_offsets = [0]
+        self._value_offsets = [0]
+        return count
+
+    def end_terms(self):
+        self._terms = self._end_table('terms')
+        self._section('terms.max_frequencies', _pack('I', self._max_frequencies))
+        self._max_frequencies = []
+
+    def end_ngrams(self):
+        self._ngrams = self._end_table('ngrams')
+
+    def add_document(self, row):
+        if self._streamed is None:
+            self._begin('documents.rows')
+        data = json.dumps(list(row))
+        self._file.write(data)
+        self._documents.append(row[0])
+        self._lengths.append(row[-1] or 0)
+        self._row_offsets.append(self._row_offsets[-1] + len(data))
+
+    def close(self):
+        if self._streamed is None:
+            self._begin('documents.rows')
+        self._end()
+        self._section('documents.ids', _pack('I', self._documents))
+        self._section('documents.lengths', _pack('I', self._lengths))
+        self._section('documents.row_offsets', _pack('Q', self._row_offsets))
+        header = json.dumps({
+            "sections": self._sections,
+            "terms": self._terms,
+            "ngrams": self._ngrams,
+            "documents": len(self._documents),
+            "length": sum(self._lengths),
+            "options": self._options,
+        })
+        offset = self._file.tell()
+        self._file.write(header)
+        self._file.write(_ULONG.pack(offset))
+        self._file.write(MAGIC)
+        self._file.close()
+
+
+class _Table:
+    def __init__(self, snapshot, name, count, value_item):
+        self._map = snapshot.map
+        self._count = count
+        self._keys = snapshot.section(name + '.keys')[0]
+        self._key_offsets = snapshot.array(name + '.key_offsets', _ULONG)
+        self._values = snapshot.section(name + '.postings')[0]
+        self._value_offsets = snapshot.array(name + '.value_offsets', _ULONG)
+        self._value_item = value_item
+
+    def __len__(self):
+        return self._count
+
+    def key(self, index):
+        return self._map[self._keys + self._key_offsets[index]:self._keys + self._key_offsets[index + 1]]
+
+    def lower_bound(self, key):
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, key):
+        index = self.lower_bound(key)
+        if index < self._count and self.key(index) == key:
+            return index
+        return None
+
+    def values(self, index):
+        start = self._value_offsets[index]
+        return MappedArray(self._map, self._values + 4 * start, self._value_offsets[index + 1] - start,
+                           self._value_item)
+
+
+class Snapshot:
+    """
+    Read-only search backend answering search() and suggest() from a snapshot written by
+    Indexer.export_snapshot(), with the analysis options of that Indexer. The file is memory mapped,
+    so every process serving it shares the same pages through the OS page cache and nothing is
+    loaded at startup. instrumentation times search and suggest calls like the Indexer does.
+    """
+
+    def __init__(self, path, instrumentation=None):
+        self._instrumentation = instrumentation
+        self._file = open(path, 'rb')
+        self.map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[-len(MAGIC):] != MAGIC:
+            raise Exception("{0} is not an index snapshot!".format(path))
+        offset = _ULONG.unpack_from(self.map, len(self.map) - len(MAGIC) - _ULONG.size)[0]
+        self._header = json.loads(self.map[offset:len(self.map) - len(MAGIC) - _ULONG.size])
+        options = self._header["options"]
+        self._diacritics_sensitive = options["diacritics_sensitive"]
+        self._deepindexing = options["deepindexing"]
+        self._gram_size = options["gram_size"]
+        self._terms = _Table(self, 'terms', self._header["terms"], _UINT)
+        self._ngrams = _Table(self, 'ngrams', self._header["ngrams"], _UINT)
+        self._max_frequencies = self.array('terms.max_frequencies', _UINT)
+        self._documents = self.array('documents.ids', _UINT)
+        self._lengths = self.array('documents.lengths', _UINT)
+        self._rows = self.section('documents.rows')[0]
+        self._row_offsets = self.array('documents.row_offsets', _ULONG)
+
+    def _operation(self, name, **details):
+        if self._instrumentation is None:
+            return DISABLED
+        return self._instrumentation.start(name, **details)
+
+    def _stage(self, name):
+        if self._instrumentation is None:
+            return DISABLED
+        return self._instrumentation.stage(name)
+
+    def section(self, name):
+        return self._header["sections"][name]
+
+    def array(self, name, item):
+        offset, size = self.section(name)
+        return MappedArray(self.map, offset, size // item.size, item)
+
+    def close(self):
+        self.map.close()
+        self._file.close()
+
+    def statistics(self):
+        return self._header["documents"], self._header["length"]
+
+    def postings(self, term):
+        """
+        Returns (ids, frequencies, max_frequency) of the term, or None.
+        """
+        index = self._terms.find(term)
+        if index is None:
+            return None
+        return self._term_postings(index)
+
+    def _term_postings(self, index):
+        values = self._terms.values(index)
+        count = len(values) // 2
+        return (MappedArray(self.map, values._offset, count), MappedArray(self.map, values._offset + 4 * count, count),
+                self._max_frequencies[index])
+
+    def _document_index(self, doc):
+        index = bisect_left(self._documents, doc)
+        if index < len(self._documents) and self._documents[index] == doc:
+            return index
+        return None
+
+    def _row(self, index):
+        start = self._rows + self._row_offsets[index]
+        return tuple(json.loads(self.map[start:self._rows + self._row_offsets[index + 1]]))
+
+    def lengths(self, ids):
+        lengths = {}
+        for doc in ids:
+            index = self._document_index(doc)
+            if index is not None:
+                lengths[doc] = self._lengths[index]
+        return lengths
+
+    def rows(self, ids):
+        rows = []
+        for doc in ids:
+            index = self._document_index(doc)
+            if index is not None:
+                rows.append(self._row(index))
+        return rows
+
+    def documents(self):
+        for index in xrange(len(self._documents)):
+            yield self._row(index)
+
+    def terms(self):
+        for index in xrange(len(self._terms)):
+            yield (self._terms.key(index),) + self._term_postings(index)
+
+    def prefix(self, data, limit=None):
+        results = []
+        index = self._terms.lower_bound(data)
+        while index < len(self._terms) and (not limit or len(results) < limit):
+            term = self._terms.key(index)
+            if not term.startswith(data):
+                break
+            results.append(term)
+            index += 1
+        return results
+
+    def substring(self, data, limit=None):
+        if self._gram_size and len(data) > self._gram_size:
+            grams = list(set(data[i:i + self._gram_size] for i in range(len(data) - self._gram_size + 1)))
+        else:
+            grams = [data]
+        indexes = [self._ngrams.find(gram) for gram in grams]
+        if None in indexes:
+            return []
+        terms = [self._terms.key(ordinal) for ordinal in intersect_all([self._ngrams.values(index)
+                                                                        for index in indexes])]
+        results = sorted((term for term in terms if data in term), key=lambda term: (term.find(data), len(term)))
+        return results[:limit] if limit else results
+
+    def _search_ids(self, terms, limit, ranked, after=None, scores=None):
+        with self._stage("lookup"):
+            postings = [self.postings(term) for term in terms]
+        # ranked or not, the documents matching all of the terms
+        if None in postings:
+            return []
+        if ranked:
+            with self._stage("ranking"):
+                documents, length = self.statistics()
+                bm25 = BM25(documents, float(length) / documents if documents else 0)
+                cursors = []
+                for row in postings:
+                    idf = bm25.idf(len(row[0]))
+                    cursors.append(TermCursor(row[0], row[1], idf, bm25.upper_bound(idf, row[2])))
+                scored = top_k(cursors, limit, bm25, DocumentLengths(self.lengths), conjunctive=True)
+            if scores is not None:
+                scores.update((doc, score) for score, doc in scored)
+            results = [doc for score, doc in scored]
+        else:
+            with self._stage("intersection"):
+                results = intersect_all([row[0] for row in postings])
+            if after is not None:
+                results = results[bisect_right(results, after):]
+            if limit:
+                results = results[:limit]
+        return results
+
+    def _search(self, terms, limit, ranked):
+        ids = self._search_ids(terms, limit, ranked)
+        with self._stage("hydration"):
+            return self.rows(ids)
+
+    def search(self, data, node="_general_index", limit=None, ranked=False):
+        with self._operation("search", query=data) as operation:
+            if self._diacritics_sensitive is False:
+                data = flatten_diacritics(data)
+            terms = list(set(data.split()))
+            results = self._search(terms, limit, ranked) if terms else []
+            operation.annotate(results=len(results))
+        for result in results:
+            yield result
+
+    def page(self, data, limit=20, cursor=None, ranked=False, columns=None, snippet=None, node="_general_index",
+             scores=False):
+        """
+        Same as Indexer.page(): one page of results as {"results": rows, "cursor": cursor}.
+        """
+        with self._operation("search", query=data, cursor=cursor) as operation:
+            if self._diacritics_sensitive is False:
+                data = flatten_diacritics(data)
+            terms = list(set(data.split()))
+            page = from_cursor(cursor, limit, columns, snippet, scores)
+            if ranked and page.after is not None:
+                raise QueryError("Ranked results are paged by offset!")
+            scored = {}
+            ids = self._search_ids(terms, page.window, ranked, page.after, scored)[page.offset:] if terms else []
+            with self._stage("hydration"):
+                results = [project(row, page, terms, scored.get(row[0])) for row in self.rows(ids)]
+            operation.annotate(results=len(results))
+        return {"results": results, "cursor": page.next_cursor(results, ranked)}
+
+    def suggest(self, data, node="_general_index", limit=None, relevant_suggestions=True):
+        if self._diacritics_sensitive is False:
+            data = flatten_diacritics(data)
+        data = data.split()[-1]
+        with self._operation("suggest", query=data) as operation:
+            with self._stage("lookup"):
+                if self._deepindexing:
+                    results = self.substring(data, limit)
+                else:
+                    results = self.prefix(data, limit)
+            operation.annotate(results=len(results))
+        for result in results:
+            yield result
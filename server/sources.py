@@ -0,0 +1,188 @@
+import codecs
+import hashlib
+import json
+import os
+
+CHUNK_SIZE = 1 << 20
+FINGERPRINT_SIZE = 1 << 16
+_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\r\n"
+_NUMBER = "0123456789+-.eE"
+
+
+def text_lines(f, offset=0):
+    """
+    Yields (line, end) for the lines of f from offset on, end being the offset right after the line.
+    """
+    f.seek(offset)
+    end = offset
+    while True:
+        line = f.readline()
+        if not line:
+            return
+        if end == 0 and line.startswith(codecs.BOM_UTF8):
+            line = line[len(codecs.BOM_UTF8):]
+            end += len(codecs.BOM_UTF8)
+        end += len(line)
+        yield line.strip(), end
+
+
+def jsonl_records(f, offset=0):
+    """
+    Yields (record, end) for the JSON records of f, one per line, from offset on.
+    """
+    for line, end in text_lines(f, offset):
+        if not line:
+            continue
+        try:
+            yield json.loads(line), end
+        except ValueError:
+            raise Exception("Invalid JSON in the line ending at offset {0}!".format(end))
+
+
+class _Buffer:
+    """
+    Window over a file holding what is left of the last chunk read and, at worst, one whole value.
+    """
+
+    def __init__(self, f, offset, chunk_size):
+        f.seek(offset)
+        self._f = f
+        self._chunk_size = chunk_size
+        self.data = ""
+        self.base = offset
+        self.position = 0
+        self.eof = False
+
+    def offset(self):
+        return self.base + self.position
+
+    def more(self):
+        if self.eof:
+            return False
+        # growing reads keep a value spanning many chunks from being decoded once per chunk
+        chunk = self._f.read(max(self._chunk_size, len(self.data) - self.position))
+        if not chunk:
+            self.eof = True
+            return False
+        self.data = self.data[self.position:] + chunk
+        self.base += self.position
+        self.position = 0
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character, or None at the end of the file.
+        """
+        while True:
+            while self.position < len(self.data) and self.data[self.position] in _WHITESPACE:
+                self.position += 1
+            if self.position < len(self.data):
+                return self.data[self.position]
+            if not self.more():
+                return None
+
+    def decode(self):
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.data, self.position)
+                if self.eof or not self._truncated(value, end):
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise Exception("Invalid JSON at offset {0}!".format(self.offset()))
+            self.more()
+
+    def _truncated(self, value, end):
+        """
+        Whether a value ending at end may go on in the next chunk: a number followed by nothing but
+        number characters up to the end of the data, e.g. 2 out of "2." or 1 out of "1e".
+        """
+        if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+            return False
+        while end < len(self.data) and self.data[end] in _NUMBER:
+            end += 1
+        return end == len(self.data)
+
+
+def json_array_records(f, offset=0, chunk_size=CHUNK_SIZE):
+    """
+    Yields (record, end) for the records of a JSON array, reading chunk_size bytes at a time. offset
+    is either 0 or an end yielded before.
+    """
+    buffer = _Buffer(f, offset, chunk_size)
+    if offset == 0:
+        while len(buffer.data) < len(codecs.BOM_UTF8) and buffer.more():
+            pass
+        if buffer.data.startswith(codecs.BOM_UTF8):
+            buffer.position += len(codecs.BOM_UTF8)
+        if buffer.peek() != "[":
+            raise Exception("Expected a JSON array at offset {0}!".format(buffer.offset()))
+        buffer.position += 1
+        if buffer.peek() == "]":
+            return
+        record = buffer.decode()
+        yield record, buffer.offset()
+    while True:
+        character = buffer.peek()
+        if character == "]":
+            return
+        if character != ",":
+            raise Exception("Expected , or ] at offset {0}!".format(buffer.offset()))
+        buffer.position += 1
+        buffer.peek()
+        record = buffer.decode()
+        yield record, buffer.offset()
+
+
+FORMATS = {
+    "text": text_lines,
+    "jsonl": jsonl_records,
+    "json": json_array_records,
+}
+EXTENSIONS = {
+    ".json": "json",
+    ".jsonl": "jsonl",
+    ".ndjson": "jsonl",
+}
+
+
+def fingerprint(f, position, size=FINGERPRINT_SIZE):
+    """
+    Returns the SHA-1 of the first and the last size bytes of f before position, which tells whether
+    what was read up to a checkpoint at position is still there. Appending to f keeps it.
+    """
+    digest = hashlib.sha1()
+    f.seek(0)
+    digest.update(f.read(min(size, position)))
+    f.seek(max(position - size, 0))
+    digest.update(f.read(min(size, position)))
+    return digest.hexdigest()
+
+
+def file_format(path):
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), "text")
+
+
+def read(f, format, offset=0):
+    """
+    Yields (item, end) for the lines or the records of f in format, from offset on.
+    """
+    if format not in FORMATS:
+        raise Exception("Unknown format {0}!".format(format))
+    return FORMATS[format](f, offset)
+
+
+def record_document(record, text=None):
+    """
+    Returns the (data, fields) document of a line or a record: a record is kept as the fields and its
+    text key, or all its string values joined, as the data. Other JSON values give (None, None).
+    """
+    if isinstance(record, basestring):
+        return record, None
+    if isinstance(record, dict):
+        if text is not None:
+            return record.get(text), record
+        return u" ".join(value for value in record.itervalues() if isinstance(value, basestring)), record
+    return None, None
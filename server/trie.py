@@ -0,0 +1,108 @@
+import heapq
+
+
+class _Node(object):
+    __slots__ = ('children', 'term', 'frequency', 'best')
+
+    def __init__(self):
+        self.children = {}
+        self.term = None
+        self.frequency = 0
+        self.best = []
+
+
+class SuggestionTrie:
+    """
+    Prefix trie over the indexed terms. Every node keeps the k most frequent terms below it as
+    (-frequency, term) pairs so completions are answered without walking the subtree.
+    """
+
+    def __init__(self, k=20):
+        self.k = k
+        self._root = _Node()
+
+    def _path(self, term, create=False):
+        node = self._root
+        path = [node]
+        for character in term:
+            child = node.children.get(character)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[character] = _Node()
+            node = child
+            path.append(node)
+        return path
+
+    def _refresh(self, node):
+        candidates = [entry for child in node.children.itervalues() for entry in child.best]
+        if node.frequency > 0:
+            candidates.append((-node.frequency, node.term))
+        node.best = heapq.nsmallest(self.k, candidates)
+
+    def build(self, frequencies):
+        """
+        Loads (term, frequency) pairs and computes every node's completions in one post-order pass.
+        """
+        for term, frequency in frequencies:
+            node = self._path(term, create=True)[-1]
+            node.term = term
+            node.frequency = frequency
+        stack = [(self._root, False)]
+        while stack:
+            node, visited = stack.pop()
+            if visited:
+                self._refresh(node)
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children.itervalues())
+
+    def add(self, term, delta=1):
+        path = self._path(term, create=delta > 0)
+        if path is None:
+            return
+        leaf = path[-1]
+        leaf.term = term
+        leaf.frequency = max(leaf.frequency + delta, 0)
+        if delta > 0:
+            entry = (-leaf.frequency, term)
+            for node in path:
+                best = [item for item in node.best if item[1] != term]
+                if len(best) < self.k or entry < best[-1]:
+                    best.append(entry)
+                    best.sort()
+                    node.best = best[:self.k]
+        else:
+            # a term losing documents can leave its ancestors with a slot to refill from below
+            for i in range(len(term), 0, -1):
+                node = path[i]
+                if node.frequency == 0 and not node.children:
+                    del path[i - 1].children[term[i - 1]]
+            for node in reversed(path):
+                self._refresh(node)
+
+    def within(self, term, edits):
+        """
+        Returns {candidate: edits} for the terms at most edits edits away from term. The trie is walked
+        as a Levenshtein automaton: a node is only entered while the distance of its prefix to some
+        prefix of term is at most edits.
+        """
+        results = {}
+        stack = [(self._root, range(len(term) + 1))]
+        while stack:
+            node, row = stack.pop()
+            if node.frequency > 0 and row[-1] <= edits:
+                results[node.term] = row[-1]
+            for character, child in node.children.iteritems():
+                next_row = [row[0] + 1]
+                for j in range(1, len(term) + 1):
+                    next_row.append(min(next_row[j - 1] + 1, row[j] + 1, row[j - 1] + (term[j - 1] != character)))
+                if min(next_row) <= edits:
+                    stack.append((child, next_row))
+        return results
+
+    def complete(self, prefix, limit=None):
+        path = self._path(prefix)
+        if path is None:
+            return []
+        return [term for frequency, term in path[-1].best[:limit]]
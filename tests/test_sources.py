@@ -0,0 +1,34 @@
+import json
+import unittest
+from cStringIO import StringIO
+
+from server.sources import json_array_records
+
+ARRAYS = [
+    '[1, 2.5, 3]',
+    '[-1e3,2E-2 , 0.125,\n10]',
+    '[{"a": [1, 2.5e1]}, "x, y]", true, null, 4, {"b": {"c": -0.5}}]',
+    '[]',
+    '\xef\xbb\xbf[ 7 ]',
+]
+
+
+class JsonArrayRecordsTest(unittest.TestCase):
+    def test_every_chunk_size_and_resume_offset(self):
+        for data in ARRAYS:
+            expected = json.loads(data.lstrip('\xef\xbb\xbf'))
+            for chunk_size in range(1, len(data) + 2):
+                records = list(json_array_records(StringIO(data), chunk_size=chunk_size))
+                self.assertEqual([record for record, end in records], expected, (data, chunk_size))
+                for index, (record, end) in enumerate(records):
+                    resumed = [record for record, end in json_array_records(StringIO(data), end, chunk_size)]
+                    self.assertEqual(resumed, expected[index + 1:], (data, chunk_size, end))
+
+    def test_invalid_array(self):
+        for data in ('{"a": 1}', '[1 2]', '[1, 2'):
+            with self.assertRaises(Exception):
+                list(json_array_records(StringIO(data), chunk_size=2))
+
+
+if __name__ == '__main__':
+    unittest.main()